@@ -0,0 +1,150 @@
+import contextvars, ctypes, sys, threading
+from contextlib import contextmanager
+
+# Arrays.
+#
+# An array value is a pointer to the descriptor of the memory holding its
+# elements:
+#
+#   {element* data, i64 length}
+#
+# The arrays given to the JIT-compiled functions get descriptors over the
+# buffers of the Python objects, NumPy arrays, bytearray, memoryview or
+# array.array for instance, so that the code reads and writes their memory in
+# place. With the bounds checks, an index out of bounds loads 0, stores
+# nothing, and is reported to the runtime through a symbol of the process:
+# the evaluator raises IndexError once the call returns. Each call collects
+# the indexes its own code reports, whatever the other threads call.
+
+INDEX_ERROR = 'kal.index_error'
+
+# Types of the elements of the arrays, with the buffer formats holding them.
+# The u8 elements are loaded as i64.
+ELEMENT_TYPES = ('f64', 'f32', 'i64', 'u8')
+FORMATS = {'f64': ('d',), 'f32': ('f',), 'i64': ('q', 'l'), 'u8': ('B',)}
+ITEM_SIZES = {'f64': 8, 'f32': 4, 'i64': 8, 'u8': 1}
+
+def array_type(element):
+    """Returns the type of the arrays of elements of the given type."""
+    return element + '[]'
+
+def is_array(type):
+    return isinstance(type, str) and type.endswith('[]')
+
+def element_type(type):
+    """Returns the type of the elements of an array type."""
+    return type[:-2]
+
+class ArrayDescriptor(ctypes.Structure):
+    _fields_ = [('data', ctypes.c_void_p), ('length', ctypes.c_int64)]
+
+def descriptor(value, type):
+    """Returns the descriptor of an array of the given type over the buffer
+    of value, with the ctypes object which keeps the buffer exported, and
+    thus in place, as long as it lives."""
+    element = element_type(type)
+    try:
+        view = memoryview(value)
+    except TypeError:
+        raise TypeError('An array of {0} needs a buffer, not {1}'.format(element,
+            value.__class__.__name__))
+    format = view.format.lstrip('@=' + ('<' if sys.byteorder == 'little' else '>'))
+    if format not in FORMATS[element] or view.itemsize != ITEM_SIZES[element]:
+        raise TypeError('An array of {0} needs a buffer of format {1}, not {2}'.format(
+            element, FORMATS[element][0], view.format))
+    if view.readonly or not view.c_contiguous:
+        raise TypeError('An array needs a writable contiguous buffer')
+    memory = (ctypes.c_char * view.nbytes).from_buffer(view)
+    return ArrayDescriptor(ctypes.addressof(memory), view.nbytes // view.itemsize), memory
+
+IndexErrorFunction = ctypes.CFUNCTYPE(None, ctypes.c_int64, ctypes.c_int64)
+
+class IndexErrors(object):
+    """Collects the indexes out of bounds reported by the JIT-compiled code,
+    which calls the ctypes function at address with the index and the length
+    of the array. The code run in a collect() block reports to its own slot,
+    a context variable, which the parallel loops run their chunks in too.
+    """
+    def __init__(self):
+        self.function = IndexErrorFunction(self.report)
+        self.address = ctypes.cast(self.function, ctypes.c_void_p).value
+        self._lock = threading.Lock()
+        self._slot = contextvars.ContextVar('index_errors', default=None)
+
+    def report(self, index, length):
+        slot = self._slot.get()
+        if slot is not None:
+            with self._lock:
+                if not slot:
+                    slot.append((index, length))
+
+    @contextmanager
+    def collect(self):
+        """Collect the indexes reported by the code run in the block, and
+        raise IndexError for the first one at its end. The indexes reported
+        out of any block are ignored."""
+        slot = []
+        token = self._slot.set(slot)
+        try:
+            yield
+        finally:
+            self._slot.reset(token)
+        if slot:
+            raise IndexError('Index {0} out of bounds of an array of {1}'.format(*slot[0]))
+
+_index_errors = None
+_index_errors_lock = threading.Lock()
+
+def index_errors():
+    """Returns the IndexErrors of the process."""
+    global _index_errors
+    with _index_errors_lock:
+        if _index_errors is None:
+            _index_errors = IndexErrors()
+        return _index_errors
+
+#---- Some unit tests ----#
+
+import unittest
+
+class TestArrays(unittest.TestCase):
+    def test_descriptor(self):
+        from array import array
+        values = array('d', [1, 2, 3])
+        desc, memory = descriptor(values, 'f64[]')
+        self.assertEqual(desc.length, 3)
+        self.assertEqual(desc.data, values.buffer_info()[0])
+        self.assertEqual(descriptor(bytearray(5), 'u8[]')[0].length, 5)
+        self.assertEqual(descriptor(memoryview(array('q', [1, 2])), 'i64[]')[0].length, 2)
+        for value, type in [(values, 'f32[]'), (b'abc', 'u8[]'), ([1.0], 'f64[]'),
+                (memoryview(values)[::2], 'f64[]')]:
+            with self.assertRaises(TypeError):
+                descriptor(value, type)
+
+    def test_index_errors(self):
+        errors = IndexErrors()
+        errors.function(1, 3)
+        with self.assertRaises(IndexError) as caught:
+            with errors.collect():
+                errors.function(5, 3)
+                errors.function(7, 3)
+        self.assertEqual(str(caught.exception), 'Index 5 out of bounds of an array of 3')
+        with errors.collect():
+            pass
+        # The calls of other threads report to their own slots
+        def other():
+            try:
+                with errors.collect():
+                    errors.function(9, 3)
+                    reported.set()
+                    done.wait()
+            except IndexError as e:
+                raised.append(str(e))
+        reported, done, raised = threading.Event(), threading.Event(), []
+        thread = threading.Thread(target=other)
+        with errors.collect():
+            thread.start()
+            reported.wait()
+            done.set()
+            thread.join()
+        self.assertEqual(raised, ['Index 9 out of bounds of an array of 3'])
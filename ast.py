@@ -27,6 +27,15 @@ class Variable(Expr):
     def flatten(self):
         return [self.__class__.__name__, self.name]            
 
+class Index(Expr):
+    """The element of an array variable at an index."""
+    def __init__(self, name, index):
+        self.name = name
+        self.index = index
+
+    def flatten(self):
+        return [self.__class__.__name__, self.name, self.index.flatten()]
+
 class Unary(Expr):
     def __init__(self, op, rhs):
         self.op = op
@@ -62,34 +71,62 @@ class If(Expr):
         return [self.__class__.__name__, self.cond_expr.flatten(), self.then_expr.flatten(), self.else_expr.flatten() ]    
 
 
+# Reduction operators of the loops, with their identity
+REDUCTIONS = {'+': 0.0, '*': 1.0, 'min': float('inf'), 'max': float('-inf')}
+
+# Types of the values, as named by the annotations. The values are f64 unless
+# annotated otherwise, or inferred from typed values. The arrays of elements of
+# these types, or of u8, are named with '[]' after them (see arrays.py).
+TYPES = ('f64', 'f32', 'i64', 'bool')
+TYPE_ALIASES = {'i1': 'bool'}
+DEFAULT_TYPE = 'f64'
+
+def annotated(name, type):
+    """Returns the flattened form of a name and its type annotation."""
+    return name if type is None else '{0}:{1}'.format(name, type)
+
 class For(Expr):
-    def __init__(self, id_name, start_expr, end_expr, step_expr, body):
+    def __init__(self, id_name, start_expr, end_expr, step_expr, body, reduction=None, id_type=None):
         self.id_name = id_name
+        # Type of the counter, when annotated
+        self.id_type = id_type
         self.start_expr = start_expr
         self.end_expr = end_expr
         self.step_expr = step_expr
         self.body = body
+        # When one of REDUCTIONS, the loop returns the reduction of the values
+        # of its body rather than the last value of its counter.
+        self.reduction = reduction
 
     def flatten(self):
-        return [
+        flattened = [
             self.__class__.__name__, 
-            self.id_name, 
+            annotated(self.id_name, self.id_type), 
             self.start_expr.flatten(), 
             self.end_expr.flatten(),
             self.step_expr.flatten() if self.step_expr else ["No step"],
             self.body.flatten()
         ]    
+        if self.reduction:
+            return flattened + ['reduce', self.reduction]
+        return flattened
+
+class ParFor(For):
+    """A 'for' loop whose iterations are independent, and may run at once."""
 
 class VarIn(Expr):
-    def __init__(self, vars, body):
-        # vars is a sequence of (name, expr) pairs
+    def __init__(self, vars, body, types=None):
+        # vars is a sequence of (name, expr) pairs, types maps the names
+        # annotated to their type
         self.vars = vars
         self.body = body
+        self.types = types or {}
 
     def flatten(self):
         return [
             self.__class__.__name__, 
-            [[var[0], var[1].flatten() if var[1] else None] for var in self.vars], 
+            [[annotated(var[0], self.types.get(var[0])), var[1].flatten() if var[1] else None]
+                for var in self.vars], 
             self.body.flatten()
         ]  
 
@@ -98,11 +135,22 @@ _ANONYMOUS = "_ANONYMOUS."
 DEFAULT_PREC = 30
 
 class Prototype(Node):
-    def __init__(self, name, argnames, isoperator=False, prec=DEFAULT_PREC):
+    def __init__(self, name, argnames, isoperator=False, prec=DEFAULT_PREC,
+            argtypes=None, return_type=None):
         self.name = name
         self.argnames = argnames
         self.isoperator = isoperator
         self.prec = prec
+        # Types of the arguments and of the result, f64 when not annotated.
+        # The result of an anonymous function has the type of its body.
+        self.argtypes = argtypes or [DEFAULT_TYPE] * len(argnames)
+        self.return_type = return_type
+
+    def is_typed(self):
+        """Whether the arguments or the result are annotated with types
+        other than f64."""
+        return any(type != DEFAULT_TYPE for type in self.argtypes) \
+            or self.return_type not in (None, DEFAULT_TYPE)
 
     def is_unary_op(self):
         return self.isoperator and len(self.argnames) == 1
@@ -125,16 +173,25 @@ class Prototype(Node):
         return self.name.startswith(_ANONYMOUS)    
 
     def flatten(self):
-        flattened = [self.__class__.__name__, self.name, '(' + ' '.join(self.argnames) + ')']
+        args = [annotated(name, None if type == DEFAULT_TYPE else type)
+            for name, type in zip(self.argnames, self.argtypes)]
+        flattened = [self.__class__.__name__, self.name, '(' + ' '.join(args) + ')']
+        if self.return_type not in (None, DEFAULT_TYPE):
+            flattened.append(':' + self.return_type)
         if self.prec != DEFAULT_PREC:
             return flattened + [self.prec]
         else :
             return flattened       
 
+# Number of results a memoized function keeps when not given.
+DEFAULT_MEMO_CAPACITY = 4096
+
 class Function(Node):
-    def __init__(self, proto, body):
+    def __init__(self, proto, body, memo=None):
         self.proto = proto
         self.body = body
+        # Number of results kept by a memoized function, None otherwise.
+        self.memo = memo
 
     def is_anonymous(self):
         return self.proto.is_anonymous()    
@@ -144,7 +201,18 @@ class Function(Node):
         return Function(Prototype.Anonymous(), body)
 
     def flatten(self):
-        return [self.__class__.__name__, self.proto.flatten(), self.body.flatten()]    
+        flattened = [self.__class__.__name__, self.proto.flatten(), self.body.flatten()]
+        if self.memo:
+            flattened.append(['memo', self.memo])
+        return flattened    
+
+class Import(Node):
+    def __init__(self, path):
+        # Path of the file imported, relative to the importing file
+        self.path = path
+
+    def flatten(self):
+        return [self.__class__.__name__, self.path]
 
 
 def dump(flattened, indent=0):
@@ -0,0 +1,299 @@
+import asyncio, itertools, multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from ast import *
+from parsing import *
+from codegen import *
+from codexec import KaleidoscopeEvaluator
+
+class WorkerError(Exception): pass
+
+def _replay(k, ast):
+    """Apply a definition made in another worker."""
+    if isinstance(ast, Function) and ast.proto.is_binary_op():
+        set_binop_info(ast.proto.get_op_name(), ast.proto.prec, Associativity.LEFT, k.operators)
+    k._eval_ast(ast)
+
+def _defined_name(ast):
+    """Returns the name of the function defined or declared by ast, or the
+    path of the file it imports."""
+    if isinstance(ast, Function):
+        return ast.proto.name
+    return ast.path if isinstance(ast, Import) else ast.name
+
+def _worker_main(conn, basiclib_file):
+    """Evaluation loop of a worker process.
+    Each request comes with the definitions of the session to replay, in
+    order, before its code. The reply holds the values of the toplevel
+    expressions, the definitions that were made, the error that stopped the
+    evaluation if any, and the (index, error) of the definitions that could
+    not be replayed, in which case the code is not evaluated."""
+    k = KaleidoscopeEvaluator(basiclib_file)
+    while True:
+        try:
+            others, codestr, options = conn.recv()
+        except EOFError:
+            break
+        failed = []
+        for index, ast in enumerate(others):
+            try:
+                _replay(k, ast)
+            except (ParseError, CodegenError) as err:
+                failed.append((index, err))
+        if failed:
+            conn.send(([], [], None, failed))
+            continue
+        values = []
+        definitions = []
+        error = None
+        try:
+            for result in k.eval_generator(codestr, options):
+                values.append(result.value)
+                if not (isinstance(result.ast, Function) and result.ast.is_anonymous()):
+                    definitions.append(result.ast)
+        except (ParseError, CodegenError) as err:
+            error = err
+        conn.send((values, definitions, error, []))
+
+class _Worker(object):
+    _idents = itertools.count()
+
+    def __init__(self):
+        self.process = None
+        self.conn = None
+
+    def start(self, context, basiclib_file):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, basiclib_file), daemon=True)
+        self.process.start()
+        child_conn.close()
+        # A new process only knows the basic library
+        self.ident = next(self._idents)
+        self.synced = 0
+        # Whether the process made definitions logged after others it has
+        # not replayed yet, and whether it must be replaced before its next
+        # request, holding a definition dropped from the log
+        self.ahead = False
+        self.stale = False
+
+    def kill(self):
+        """Terminate the process. Returns it, for the caller to join."""
+        process, self.process = self.process, None
+        if process:
+            process.terminate()
+        return process
+
+class AsyncKaleidoscopeEvaluator(object):
+    """Asyncio facade over a pool of KaleidoscopeEvaluator, each running in a
+    worker process of its own. Parsing, compilation and execution all happen in
+    the workers, so the event loop is never blocked and a worker stuck in an
+    endless loop can be killed when its deadline expires or its call is
+    cancelled. Requests run concurrently, up to one per worker.
+
+    Definitions made in one worker are logged in the order their requests
+    complete, and the workers replay the log in that order before their next
+    request, so that all of them share the same session: the last definition
+    logged of a function wins. A definition which cannot be replayed after the
+    ones logged before it, such as one made at the same time as a conflicting
+    one, is dropped from the session, and the request meeting it raises
+    WorkerError.
+    """
+    def __init__(self, basiclib_file = None, workers = 2, timeout = None):
+        """timeout: default deadline, in seconds, of each call. None means no limit."""
+        self.basiclib_file = basiclib_file
+        self.timeout = timeout
+        # Definitions made so far, as (worker ident, ast) pairs, and the
+        # positions of the ones dropped
+        self.definitions = []
+        self.dropped = set()
+        self._context = multiprocessing.get_context()
+        self._workers = [_Worker() for i in range(workers)]
+        self._executor = ThreadPoolExecutor(workers)
+        self._idle = None
+
+    def start(self):
+        """Start the worker processes ahead of the first call."""
+        for worker in self._workers:
+            if not worker.process:
+                worker.start(self._context, self.basiclib_file)
+
+    def close(self):
+        """Stop the worker processes, waiting for them to exit."""
+        for worker in self._workers:
+            process = worker.kill()
+            if process:
+                process.join()
+        self._executor.shutdown(wait=False)
+
+    async def aclose(self):
+        """Stop the worker processes, waiting for them to exit off the event
+        loop."""
+        loop = asyncio.get_event_loop()
+        for worker in self._workers:
+            process = worker.kill()
+            if process:
+                await loop.run_in_executor(None, process.join)
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def evaluate(self, codestr, options = dict(), timeout = None):
+        """Evaluates only the first top level expression in codestr."""
+        values = await self.eval_all(codestr, options, timeout)
+        return values[0]
+
+    async def eval_all(self, codestr, options = dict(), timeout = None):
+        """Evaluates all top level expressions in codestr. Returns the list of
+        their values, None for definitions and externs.
+        Raises asyncio.TimeoutError once the deadline is passed."""
+        if timeout is None:
+            timeout = self.timeout
+        return await asyncio.wait_for(self._eval_all(codestr, options), timeout)
+
+    async def _eval_all(self, codestr, options):
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for worker in self._workers:
+                self._idle.put_nowait(worker)
+        worker = await self._idle.get()
+        try:
+            while True:
+                if worker.stale:
+                    self._kill(worker)
+                if not worker.process:
+                    worker.start(self._context, self.basiclib_file)
+                pending = [position for position in range(worker.synced, len(self.definitions))
+                    if position not in self.dropped]
+                synced = len(self.definitions)
+                values, definitions, error, failed = await self._request(
+                    worker, [self.definitions[position][1] for position in pending], codestr, options)
+                if not failed:
+                    break
+                if worker.ahead:
+                    # Its own definitions came before the ones failing: a new
+                    # process replays the whole log in order
+                    worker.stale = True
+                    continue
+                messages = []
+                for index, err in failed:
+                    position = pending[index]
+                    self.dropped.add(position)
+                    origin, ast = self.definitions[position]
+                    for other in self._workers:
+                        if other.ident == origin:
+                            other.stale = True
+                    messages.append('{0}: {1}'.format(_defined_name(ast), err))
+                worker.synced = synced
+                raise WorkerError('Definitions made concurrently dropped, ' + '; '.join(messages))
+        finally:
+            self._idle.put_nowait(worker)
+
+        # Definitions logged by others in the meantime were made before the
+        # worker's own ones in its session, but come after them in the log
+        interleaved = len(self.definitions) != synced
+        self.definitions.extend((worker.ident, ast) for ast in definitions)
+        worker.ahead = interleaved and bool(definitions)
+        worker.synced = synced if interleaved else len(self.definitions)
+        if error:
+            raise error
+        return values
+
+    async def _request(self, worker, others, codestr, options):
+        """Send a request to a worker and returns its reply."""
+        worker.conn.send((others, codestr, options))
+        running = True
+        try:
+            try:
+                reply = await asyncio.get_event_loop().run_in_executor(
+                    self._executor, worker.conn.recv)
+            except EOFError:
+                raise WorkerError('Evaluation worker died')
+            running = False
+            return reply
+        finally:
+            # A worker still running has been cancelled or has died: kill it,
+            # a new one will be started with the next request.
+            if running:
+                self._kill(worker)
+
+    def _kill(self, worker):
+        """Kill a worker, its process being waited for off the event loop."""
+        process = worker.kill()
+        if process:
+            asyncio.get_event_loop().run_in_executor(None, process.join)
+
+#---- Some unit tests ----#
+
+import time, unittest
+
+class TestAsyncEvaluator(unittest.TestCase):
+    def _run(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_basic(self):
+        async def scenario():
+            async with AsyncKaleidoscopeEvaluator() as k:
+                self.assertEqual(await k.evaluate('2 + 3'), 5)
+                self.assertEqual(
+                    await k.eval_all('def binary % 60 (a b) a - b  def sq(x) x * x  sq(5 % 2)'),
+                    [None, None, 9])
+                # Definitions reach every worker
+                values = await asyncio.gather(*(k.evaluate('sq(4 % 1)') for i in range(6)))
+                self.assertEqual(values, [9] * 6)
+                with self.assertRaises(ParseError):
+                    await k.evaluate('def (')
+                with self.assertRaises(CodegenError):
+                    await k.evaluate('unknown(1)')
+        self._run(scenario())
+
+    def test_concurrent_definitions(self):
+        async def scenario():
+            async with AsyncKaleidoscopeEvaluator(workers=2) as k:
+                await k.evaluate('def f(x) 0')
+                # The workers agree on the definition logged last
+                await asyncio.gather(k.evaluate('def f(x) 1'), k.evaluate('def f(x) 2'))
+                values = await asyncio.gather(*(k.evaluate('f(0)') for i in range(6)))
+                self.assertEqual(values, [float(k.definitions[-1][1].body.val)] * 6)
+                # Definitions which conflict in log order are dropped and reported
+                await k.evaluate('def g(x) x')
+                await asyncio.gather(k.evaluate('def h(x) g(x)'), k.evaluate('def g(x y) x + y'))
+                results = await asyncio.gather(*(k.evaluate('1') for i in range(4)),
+                    return_exceptions=True)
+                # Each request meeting it, possibly several at once
+                self.assertTrue(all(r == 1 or isinstance(r, WorkerError) for r in results))
+                self.assertTrue(any(isinstance(r, WorkerError) for r in results))
+                self.assertEqual(len(k.dropped), 1)
+                dropped = k.definitions[k.dropped.pop()][1].proto.name
+                expected = 'h(1)' if dropped == 'g' else 'g(1, 2)'
+                values = await asyncio.gather(*(k.evaluate(expected) for i in range(6)))
+                self.assertEqual(values, [1 if dropped == 'g' else 3] * 6)
+        self._run(scenario())
+
+    def test_timeout_kills_worker(self):
+        async def scenario():
+            async with AsyncKaleidoscopeEvaluator(workers=2) as k:
+                await k.evaluate('def endless(x) for i = 0, i < 1, i in x  def sq(x) x * x')
+                start = time.time()
+                endless = asyncio.ensure_future(k.evaluate('endless(1)', timeout=1.0))
+                # A quick request is not held by the endless one
+                self.assertEqual(await k.evaluate('1 + 1'), 2)
+                self.assertLess(time.time() - start, 1.0)
+                with self.assertRaises(asyncio.TimeoutError):
+                    await endless
+                # The killed worker is replaced, and gets the session definitions
+                self.assertEqual(
+                    await asyncio.gather(k.evaluate('def cube(x) x * sq(x)'), k.evaluate('sq(2)')),
+                    [None, 4])
+                self.assertEqual(
+                    await asyncio.gather(*(k.evaluate('cube(2)') for i in range(4))),
+                    [8] * 4)
+        self._run(scenario())
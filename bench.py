@@ -0,0 +1,140 @@
+import subprocess, sys
+from time import perf_counter
+
+# Benchmarks comparing the backends: the LLVM JIT, and the bytecode VM.
+#
+#   python bench.py [workload ...]
+#
+# The startup dominated workloads create their evaluator, the compute dominated
+# ones only time the evaluation of an expression. Each time is the best of a
+# few runs.
+#
+#   python bench.py --fastmath [workload ...]
+#
+# compares the JIT code with and without all the fast-math flags, on compute
+# workloads, with the relative deviation of the fast-math results.
+
+BASICLIB = 'basiclib.kal'
+
+MANDELBROT = '''
+def mandelconverger(real imag iters creal cimag)
+    if iters > 255 | (real*real + imag*imag > 4) then
+        iters
+    else
+        mandelconverger(
+            real*real - imag*imag + creal,
+            2*real*imag + cimag,
+            iters+1, creal, cimag)
+
+def mandelconverge(real imag)
+    mandelconverger(real, imag, 0, real, imag)
+
+def mandelsum(xmin xmax xstep ymin ymax ystep)
+    var total in (for y = ymin, y < ymax, y + ystep in
+        (for x = xmin, x < xmax, x + xstep in
+            total = total + mandelconverge(x, y))) * 0 + total
+'''
+
+SCRIPT = '''
+def average(a b) (a + b) * 0.5
+def clamp(x low high) max(low, min(x, high))
+average(3, 4) : clamp(12, 0, 10) : factorial(6)
+'''
+
+REDUCTIONS = '''
+def sumsq(n) for i = 0, i < n reduce + in i * i * 0.5
+def poly(n) for i = 0, i < n reduce + in (i * 0.001 - 1) * (i * 0.001 + 2) * 0.25
+def peak(n) for i = 0, i < n reduce max in (i * 0.001 - 3) * (5 - i * 0.001)
+'''
+
+def create(backend):
+    if backend == 'vm':
+        import bytecode
+        return bytecode.BytecodeEvaluator(BASICLIB)
+    import codexec
+    return codexec.KaleidoscopeEvaluator(BASICLIB, fastmath=backend == 'fastmath')
+
+def evaluate_all(k, codestr):
+    result = None
+    for result in k.eval_generator(codestr):
+        pass
+    return result.value
+
+def process_startup(backend):
+    """A new process evaluating 2 + 3, imports included."""
+    start = perf_counter()
+    subprocess.run([sys.executable, sys.argv[0], '--startup', backend], check=True,
+        stdout=subprocess.DEVNULL)
+    return perf_counter() - start, None
+
+def short_script(backend):
+    """A new evaluator running a few definitions and expressions."""
+    start = perf_counter()
+    value = evaluate_all(create(backend), SCRIPT)
+    return perf_counter() - start, value
+
+def _compute(definitions, expression, warmup = None):
+    """warmup: an expression evaluated beforehand, so that the functions are
+    compiled before the timing."""
+    def workload(backend):
+        k = create(backend)
+        evaluate_all(k, definitions)
+        if warmup:
+            k.evaluate(warmup)
+        start = perf_counter()
+        value = k.evaluate(expression)
+        return perf_counter() - start, value
+    return workload
+
+WORKLOADS = [
+    ('process startup', process_startup),
+    ('short script', short_script),
+    ('fib(22)', _compute('def fib(n) if n < 2 then n else fib(n - 1) + fib(n - 2)', 'fib(22)')),
+    ('mandelbrot 39x24', _compute(MANDELBROT, 'mandelsum(-2.3, 1.6, 0.1, -1.3, 2.06, 0.14)')),
+]
+
+FASTMATH_WORKLOADS = [
+    ('mandelbrot 390x240', _compute(MANDELBROT, 'mandelsum(-2.3, 1.6, 0.01, -1.3, 2.06, 0.014)',
+        'mandelsum(0, 0, 1, 0, 0, 1)')),
+    ('sum 10M', _compute(REDUCTIONS, 'sumsq(10000000)', 'sumsq(1)')),
+    ('polynomial 10M', _compute(REDUCTIONS, 'poly(10000000)', 'poly(1)')),
+    ('max 10M', _compute(REDUCTIONS, 'peak(10000000)', 'peak(1)')),
+]
+
+def best(workload, backend, repeat = 3):
+    times, value = zip(*(workload(backend) for i in range(repeat)))
+    return min(times), value[0]
+
+def format_seconds(seconds):
+    return '{:10.2f} ms'.format(seconds * 1000)
+
+def main(names = None):
+    print('{:<20} {:>13} {:>13} {:>9}'.format('workload', 'jit', 'vm', 'vm/jit'))
+    for name, workload in WORKLOADS:
+        if names and name.split()[0] not in names:
+            continue
+        jit, jit_value = best(workload, 'jit')
+        vm, vm_value = best(workload, 'vm')
+        if jit_value != vm_value:
+            print('{}: the backends disagree, {} != {}'.format(name, jit_value, vm_value))
+        print('{:<20} {} {} {:9.1f}'.format(name, format_seconds(jit), format_seconds(vm), vm / jit))
+
+def fastmath_main(names = None):
+    print('{:<20} {:>13} {:>13} {:>9} {:>10}'.format(
+        'workload', 'strict', 'fastmath', 'speedup', 'deviation'))
+    for name, workload in FASTMATH_WORKLOADS:
+        if names and name.split()[0] not in names:
+            continue
+        strict, strict_value = best(workload, 'jit')
+        fast, fast_value = best(workload, 'fastmath')
+        deviation = abs(fast_value - strict_value) / abs(strict_value) if strict_value else abs(fast_value)
+        print('{:<20} {} {} {:9.2f} {:10.1e}'.format(
+            name, format_seconds(strict), format_seconds(fast), strict / fast, deviation))
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--startup']:
+        print(create(sys.argv[2]).evaluate('2 + 3'))
+    elif sys.argv[1:2] == ['--fastmath']:
+        fastmath_main(sys.argv[2:])
+    else:
+        main(sys.argv[1:])
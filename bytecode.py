@@ -0,0 +1,569 @@
+import math, sys
+from array import array
+from collections import namedtuple
+from time import perf_counter
+from ast import *
+from parsing import *
+
+# Bytecode backend.
+#
+# An alternative to the LLVM JIT, needing neither llvmlite nor a compiler: each
+# function is compiled into the code of a small stack machine, an array of
+# integers where the operands follow their opcode, with a pool of the double
+# constants it uses. The values computed are the ones of the JIT-compiled code,
+# Python floats being IEEE doubles.
+
+class BytecodeError(Exception): pass
+
+Result = namedtuple("Result", ['value', 'ast', 'rawIR', 'optIR'])
+Timing = namedtuple("Timing", ['value', 'compile_time', 'runs', 'min', 'median', 'p95'])
+
+# Opcodes, the most frequent first
+LOAD, CONST, JUMP_UNLESS, CALL, RETURN, ADD, SUB, MUL, LESS, STORE, POP, JUMP = range(12)
+OPCODES = ['LOAD', 'CONST', 'JUMP_UNLESS', 'CALL', 'RETURN', 'ADD', 'SUB', 'MUL', 'LESS',
+    'STORE', 'POP', 'JUMP']
+# Number of operands of each opcode
+OPERANDS = [1, 1, 1, 2, 0, 0, 0, 0, 0, 1, 0, 1]
+
+class BytecodeFunction(object):
+    """A function of the session: its bytecode, or the Python function standing
+    for it when native, or neither when only declared."""
+    def __init__(self, name, nargs, index):
+        self.name = name
+        self.nargs = nargs
+        # Position in the function table of the evaluator, the operand of CALL
+        self.index = index
+        self.code = array('l')
+        self.consts = array('d')
+        # Number of local variables, arguments included
+        self.nlocals = nargs
+        self.native = None
+
+    def is_declaration(self):
+        return not self.code and self.native is None
+
+    def disassemble(self, table):
+        lines = ['{0} ({1} args, {2} locals)'.format(self.name, self.nargs, self.nlocals)]
+        pc = 0
+        while pc < len(self.code):
+            op = self.code[pc]
+            operands = list(self.code[pc + 1:pc + 1 + OPERANDS[op]])
+            if op == CONST:
+                operands = [self.consts[operands[0]]]
+            elif op == CALL:
+                operands[0] = table[operands[0]].name
+            lines.append('{0:5} {1:<12} {2}'.format(pc, OPCODES[op], ' '.join(map(str, operands))))
+            pc += 1 + OPERANDS[op]
+        return '\n'.join(lines)
+
+def _putchard(x):
+    # As putchar(), only the low byte of the character code counts
+    sys.stdout.write(chr(int(x) & 0xff))
+    return 0.0
+
+def _libm(function):
+    """The C math function computed by a Python one: domain errors give NaN,
+    and overflows infinity."""
+    def call(*args):
+        try:
+            return float(function(*args))
+        except ValueError:
+            return math.nan
+        except OverflowError:
+            return math.inf
+    return call
+
+def _log(function):
+    return _libm(lambda x: -math.inf if x == 0 else function(x))
+
+def _integral(function):
+    return _libm(lambda x: function(x) if math.isfinite(x) else x)
+
+def _round(x):
+    # Halfway cases away from zero, as round() in C
+    whole = math.trunc(x)
+    return whole + math.copysign(1.0, x) if abs(x - whole) >= 0.5 else whole
+
+# Functions the extern declarations are bound to, as the JIT binds them to
+# the ones of the C library
+HOST_FUNCTIONS = {
+    'putchard': _putchard,
+    'fabs': math.fabs,
+    'fmod': _libm(math.fmod),
+    'fmax': lambda x, y: y if x != x else x if y != y else max(x, y),
+    'fmin': lambda x, y: y if x != x else x if y != y else min(x, y),
+    'exp': _libm(math.exp),
+    'exp2': _libm(lambda x: math.pow(2.0, x)),
+    'log': _log(math.log),
+    'log2': _log(math.log2),
+    'log10': _log(math.log10),
+    'sqrt': _libm(math.sqrt),
+    'cbrt': _libm(getattr(math, 'cbrt', lambda x: math.copysign(abs(x) ** (1.0 / 3), x))),
+    'hypot': _libm(math.hypot),
+    'pow': _libm(math.pow),
+    'sin': _libm(math.sin),
+    'cos': _libm(math.cos),
+    'tan': _libm(math.tan),
+    'asin': _libm(math.asin),
+    'acos': _libm(math.acos),
+    'atan': _libm(math.atan),
+    'atan2': _libm(math.atan2),
+    'ceil': _integral(math.ceil),
+    'floor': _integral(math.floor),
+    'trunc': _integral(math.trunc),
+    'round': _integral(_round),
+}
+
+class _FunctionCompiler(object):
+    """Compiles the body of a function into its bytecode."""
+    def __init__(self, evaluator, function, argnames):
+        self.evaluator = evaluator
+        self.function = function
+        self.code = function.code
+        self.constants = {}
+        self.scope = {name: i for i, name in enumerate(argnames)}
+
+    def compile(self, node):
+        getattr(self, '_compile_' + node.__class__.__name__)(node)
+
+    def _emit(self, *words):
+        self.code.extend(words)
+
+    def _label(self):
+        """Emit a jump target to be patched, returns its position."""
+        self.code.append(0)
+        return len(self.code) - 1
+
+    def _patch(self, position):
+        self.code[position] = len(self.code)
+
+    def _local(self):
+        self.function.nlocals += 1
+        return self.function.nlocals - 1
+
+    def _constant(self, value):
+        # Keyed by their bits, not to mix 0.0 and -0.0
+        key = value.hex()
+        if key not in self.constants:
+            self.constants[key] = len(self.function.consts)
+            self.function.consts.append(value)
+        self._emit(CONST, self.constants[key])
+
+    def _call(self, name, nargs):
+        self._emit(CALL, self.evaluator.functions[name].index, nargs)
+
+    def _compile_Number(self, node):
+        self._constant(float(node.val))
+
+    def _compile_Variable(self, node):
+        if node.name not in self.scope:
+            raise BytecodeError("Undefined variable: " + node.name)
+        self._emit(LOAD, self.scope[node.name])
+
+    def _compile_Binary(self, node):
+        if node.op == '=':
+            if not isinstance(node.lhs, Variable):
+                raise BytecodeError('lhs of "=" must be a variable')
+            self.compile(node.rhs)
+            if node.lhs.name not in self.scope:
+                raise BytecodeError("Undefined variable: " + node.lhs.name)
+            self._emit(STORE, self.scope[node.lhs.name])
+            return
+        self.compile(node.lhs)
+        self.compile(node.rhs)
+        builtin = {'+': ADD, '-': SUB, '*': MUL, '<': LESS}.get(node.op)
+        if builtin is not None:
+            self._emit(builtin)
+        elif 'binary' + node.op in self.evaluator.functions:
+            self._call('binary' + node.op, 2)
+        else:
+            raise BytecodeError('Unknown binary operator', node.op)
+
+    def _compile_Unary(self, node):
+        self.compile(node.rhs)
+        if 'unary' + node.op not in self.evaluator.functions:
+            raise BytecodeError("Undefined unary operator: " + node.op)
+        self._call('unary' + node.op, 1)
+
+    def _compile_Call(self, node):
+        callee = self.evaluator.functions.get(node.callee)
+        if callee is None:
+            raise BytecodeError('Call to unknown function', node.callee)
+        if callee.nargs != len(node.args):
+            raise BytecodeError('Call argument length mismatch', node.callee)
+        for arg in node.args:
+            self.compile(arg)
+        self._call(node.callee, len(node.args))
+
+    def _compile_If(self, node):
+        self.compile(node.cond_expr)
+        self._emit(JUMP_UNLESS)
+        to_else = self._label()
+        self.compile(node.then_expr)
+        self._emit(JUMP)
+        to_end = self._label()
+        self._patch(to_else)
+        self.compile(node.else_expr)
+        self._patch(to_end)
+
+    def _compile_Index(self, node):
+        raise BytecodeError('Only f64 values are supported: ' + node.name)
+
+    def _compile_For(self, node):
+        if node.id_type not in (None, DEFAULT_TYPE):
+            raise BytecodeError('Only f64 values are supported: ' + node.id_name)
+        # The start value can't see the counter
+        self.compile(node.start_expr)
+        counter = self._local()
+        self._emit(STORE, counter, POP)
+        if node.reduction:
+            accumulator = self._local()
+            self._constant(REDUCTIONS[node.reduction])
+            self._emit(STORE, accumulator, POP)
+        oldval = self.scope.get(node.id_name)
+        self.scope[node.id_name] = counter
+        loopcond = len(self.code)
+        self.compile(node.end_expr)
+        self._emit(JUMP_UNLESS)
+        to_after = self._label()
+        self.compile(node.body)
+        if node.reduction:
+            self._reduce(node.reduction, accumulator)
+        else:
+            self._emit(POP)
+        # The step gives the next value of the counter, by default one more
+        if node.step_expr is None:
+            self._emit(LOAD, counter)
+            self._constant(1.0)
+            self._emit(ADD)
+        else:
+            self.compile(node.step_expr)
+        self._emit(STORE, counter, POP, JUMP, loopcond)
+        self._patch(to_after)
+        if oldval is None:
+            del self.scope[node.id_name]
+        else:
+            self.scope[node.id_name] = oldval
+        # The 'for' expression returns the last value of the counter, or the
+        # reduction of the body values
+        self._emit(LOAD, accumulator if node.reduction else counter)
+
+    # The iterations of a parallel loop run one after the other
+    _compile_ParFor = _compile_For
+
+    def _reduce(self, reduction, accumulator):
+        """Pop a value and reduce it into the accumulator. min and max pick
+        the value when LESS does."""
+        if reduction in ('+', '*'):
+            self._emit(LOAD, accumulator, ADD if reduction == '+' else MUL, STORE, accumulator, POP)
+            return
+        value = self._local()
+        self._emit(STORE, value, POP)
+        if reduction == 'min':
+            self._emit(LOAD, value, LOAD, accumulator)
+        else:
+            self._emit(LOAD, accumulator, LOAD, value)
+        self._emit(LESS, JUMP_UNLESS)
+        to_end = self._label()
+        self._emit(LOAD, value, STORE, accumulator, POP)
+        self._patch(to_end)
+
+    def _compile_VarIn(self, node):
+        for name, type in node.types.items():
+            if type != DEFAULT_TYPE:
+                raise BytecodeError('Only f64 values are supported: ' + name)
+        old_bindings = []
+        for name, init in node.vars:
+            # The initializer can't see the variable it initializes
+            if init is not None:
+                self.compile(init)
+            else:
+                self._constant(0.0)
+            var = self._local()
+            self._emit(STORE, var, POP)
+            old_bindings.append(self.scope.get(name))
+            self.scope[name] = var
+        self.compile(node.body)
+        for (name, _), old in zip(node.vars, old_bindings):
+            if old is None:
+                del self.scope[name]
+            else:
+                self.scope[name] = old
+
+class BytecodeEvaluator(object):
+    """Evaluator compiling the code into bytecode, run by a loop of its own.
+    max_depth: highest number of nested calls, the JIT-compiled code being
+    rather limited by the size of the native stack.
+    """
+    def __init__(self, basiclib_file = None, max_depth = 100000):
+        self.basiclib_file = basiclib_file
+        self.max_depth = max_depth
+        self.reset()
+
+    def reset(self, history = []):
+        # Functions of the session by name, and by index for CALL
+        self.functions = {}
+        self.table = []
+        # Precedence table of the operators usable in the session
+        self.operators = operator_table()
+        self._declare('putchard', 1)
+        if self.basiclib_file:
+            with open(self.basiclib_file) as file:
+                for result in self.eval_generator(file.read()): pass
+        for ast in history:
+            self._eval_ast(ast)
+
+    def _declare(self, name, nargs):
+        function = BytecodeFunction(name, nargs, len(self.table))
+        function.native = HOST_FUNCTIONS.get(name)
+        self.functions[name] = function
+        self.table.append(function)
+        return function
+
+    def _forget(self, function):
+        del self.functions[function.name]
+        self.table.pop()
+
+    def evaluate(self, codestr, options = dict()):
+        """Evaluates only the first top level expression in codestr."""
+        return next(self.eval_generator(codestr, options)).value
+
+    def eval_generator(self, codestr, options = dict()):
+        """Iterator that evaluates all top level expression in codestr.
+        Yield a namedtuple Result, with the disassembled bytecode as rawIR."""
+        for ast in Parser(self.operators).parse_generator(codestr):
+            yield self._eval_ast(ast, **options)
+
+    def _eval_ast(self, ast, optimize=True, llvmdump=False, noexec=False, parseonly=False,
+            verbose=False, profile=False, fastmath=None):
+        """Evaluate a single top level expression given in ast form. The
+        options of the JIT evaluator are accepted; only parseonly, noexec
+        and verbose change anything."""
+        if parseonly:
+            return Result(ast.dump(), ast, None, None)
+        if isinstance(ast, Import):
+            raise BytecodeError('Imports are only supported by the JIT: ' + ast.path)
+        if isinstance(ast, Prototype):
+            self._compile_prototype(ast)
+            return Result(None, ast, None, None)
+
+        function = self._compile_function(ast)
+        code = function.disassemble(self.table) if noexec or verbose else None
+        if not ast.is_anonymous():
+            return Result(None, ast, code, None)
+        self._forget(function)
+        if noexec:
+            return Result(code, ast, code, None)
+        return Result(self.run(function), ast, code, None)
+
+    def _compile_prototype(self, node):
+        if node.is_typed():
+            raise BytecodeError('Only f64 values are supported: ' + node.name)
+        function = self.functions.get(node.name)
+        if function is None:
+            return self._declare(node.name, len(node.argnames))
+        if not function.is_declaration():
+            raise BytecodeError('Redifinition of {0}'.format(node.name))
+        if function.nargs != len(node.argnames):
+            raise BytecodeError('Redifinition with different number of arguments')
+        return function
+
+    def _compile_function(self, node):
+        was_declared = node.proto.name in self.functions
+        function = self._compile_prototype(node.proto)
+        try:
+            _FunctionCompiler(self, function, node.proto.argnames).compile(node.body)
+        except BytecodeError:
+            # Leave the session as it was before this definition
+            if was_declared:
+                del function.code[:], function.consts[:]
+                function.nlocals = function.nargs
+            else:
+                self._forget(function)
+            raise
+        function.code.append(RETURN)
+        return function
+
+    def run(self, function, args = ()):
+        """Run the bytecode of a function, returns its value."""
+        table = self.table
+        max_depth = self.max_depth
+        code, consts = function.code, function.consts
+        local = list(args) + [0.0] * (function.nlocals - len(args))
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        # Code, constants, locals and return position of the calling functions
+        frames = []
+        pc = 0
+        while True:
+            op = code[pc]
+            if op == LOAD:
+                push(local[code[pc + 1]])
+                pc += 2
+            elif op == CONST:
+                push(consts[code[pc + 1]])
+                pc += 2
+            elif op == JUMP_UNLESS:
+                # Ordered comparison with 0: NaN is false
+                value = pop()
+                if value != 0.0 and value == value:
+                    pc += 2
+                else:
+                    pc = code[pc + 1]
+            elif op == CALL:
+                callee = table[code[pc + 1]]
+                base = len(stack) - code[pc + 2]
+                pc += 3
+                if callee.code:
+                    if len(frames) >= max_depth:
+                        raise BytecodeError('Too many nested calls, in ' + callee.name)
+                    frames.append((code, consts, local, pc))
+                    local = stack[base:]
+                    if callee.nlocals > callee.nargs:
+                        local.extend([0.0] * (callee.nlocals - callee.nargs))
+                    del stack[base:]
+                    code, consts, pc = callee.code, callee.consts, 0
+                elif callee.native:
+                    args = stack[base:]
+                    del stack[base:]
+                    push(callee.native(*args))
+                else:
+                    raise BytecodeError('Call to undefined function: ' + callee.name)
+            elif op == RETURN:
+                if not frames:
+                    return pop()
+                code, consts, local, pc = frames.pop()
+            elif op == ADD:
+                value = pop()
+                stack[-1] += value
+                pc += 1
+            elif op == SUB:
+                value = pop()
+                stack[-1] -= value
+                pc += 1
+            elif op == MUL:
+                value = pop()
+                stack[-1] *= value
+                pc += 1
+            elif op == LESS:
+                # Unordered comparison: true when either operand is NaN
+                value = pop()
+                stack[-1] = 0.0 if stack[-1] >= value else 1.0
+                pc += 1
+            elif op == STORE:
+                local[code[pc + 1]] = stack[-1]
+                pc += 2
+            elif op == POP:
+                pop()
+                pc += 1
+            elif op == JUMP:
+                pc = code[pc + 1]
+            else:
+                raise BytecodeError('Bad opcode {0} in {1}'.format(op, function.name))
+
+    def timeit(self, codestr, repeat = None, warmup = 3, optimize = True, duration = 0.2,
+            fastmath = None):
+        """Time the toplevel expression of codestr, as the JIT evaluator does.
+        Returns a Timing."""
+        ast = Parser(self.operators).parse_toplevel(codestr)
+        if not (isinstance(ast, Function) and ast.is_anonymous()):
+            raise BytecodeError('Only a toplevel expression can be timed')
+        start = perf_counter()
+        function = self._compile_function(ast)
+        self._forget(function)
+        compile_time = perf_counter() - start
+
+        start = perf_counter()
+        value = self.run(function)
+        for i in range(warmup):
+            self.run(function)
+        if repeat is None:
+            run_time = (perf_counter() - start) / (warmup + 1)
+            repeat = max(5, min(int(duration / max(run_time, 1e-7)), 1000000))
+        times = []
+        for i in range(repeat):
+            start = perf_counter()
+            self.run(function)
+            times.append(perf_counter() - start)
+        times.sort()
+        return Timing(value, compile_time, repeat, times[0],
+            times[len(times) // 2], times[min(len(times) - 1, int(len(times) * 0.95))])
+
+#---- Some unit tests ----#
+
+import unittest
+
+class TestBytecodeEvaluator(unittest.TestCase):
+    def test_basic(self):
+        e = BytecodeEvaluator()
+        self.assertEqual(e.evaluate('3'), 3.0)
+        self.assertEqual(e.evaluate('3+3*4'), 15.0)
+        self.assertEqual(e.evaluate('(1 < 2) + (2 < 1) + (2 < 2)'), 1)
+        e.evaluate('def adder(a b) a + b')
+        self.assertEqual(e.evaluate('adder(5, 4) - 1'), 8)
+        self.assertEqual(e.evaluate('if adder(1, 0 - 1) then 1 else 2'), 2)
+
+    def test_loops_and_vars(self):
+        e = BytecodeEvaluator()
+        self.assertEqual(e.evaluate('for i = 1, i < 10, i + 4 in 0'), 13)
+        e.evaluate('def sum(n) var s in (for i = 0, i < n in s = s + i) * 0 + s')
+        self.assertEqual(e.evaluate('sum(100)'), 4950)
+        e.evaluate('def shadow(i) var x = i * 2, y = x + 1 in (for i = 0, i < y in 0) + i')
+        self.assertEqual(e.evaluate('shadow(3)'), 10)
+        # The parallel loops run sequentially
+        self.assertEqual(e.evaluate('parfor i = 0, i < 10 reduce + in i'), 45)
+        self.assertEqual(e.evaluate('parfor i = 5, i < 9 reduce min in 10 - i'), 2)
+        self.assertEqual(e.evaluate('parfor i = 0, i < 3 in 0'), 3)
+
+    def test_library_and_operators(self):
+        e = BytecodeEvaluator('basiclib.kal')
+        self.assertEqual(e.evaluate('factorial(5) : max(2, 3) + (4 > 3)'), 4)
+        self.assertEqual(e.evaluate('!0 + -2 + (2 ? 2) + (1 & 0) + (1 | 0)'), 1)
+        e.evaluate('def binary % 60 (a b) a - b')
+        self.assertEqual(e.evaluate('10 % 3 % 2'), 5)
+        self.assertEqual(e.evaluate('sqrt(16) + floor(-1.5) + round(2.5) + fmax(0 * log(0) * 0, 1)'), 6)
+        self.assertTrue(math.isnan(e.evaluate('sqrt(-1)')))
+
+    def test_recursion(self):
+        e = BytecodeEvaluator(max_depth=100)
+        e.evaluate('def fib(n) if n < 2 then n else fib(n - 1) + fib(n - 2)')
+        self.assertEqual(e.evaluate('fib(15)'), 610)
+        e.evaluate('extern odd(x)')
+        e.evaluate('def even(x) if x < 1 then 1 else odd(x - 1)')
+        with self.assertRaises(BytecodeError):
+            e.evaluate('even(3)')
+        e.evaluate('def odd(x) if x < 1 then 0 else even(x - 1)')
+        self.assertEqual(e.evaluate('even(50) + odd(51)'), 2)
+        with self.assertRaises(BytecodeError):
+            e.evaluate('even(500)')
+
+    def test_errors(self):
+        e = BytecodeEvaluator()
+        e.evaluate('def foo(x) x + 1')
+        for code in ['def foo(x) x', 'def bar(x) y', 'bar(1)', 'foo(1, 2)', '!1',
+                'var x in 1 = x', 'def count(n: i64) n', 'var k: i64 = 1 in k', 'def first(xs) xs[0]']:
+            with self.assertRaises(BytecodeError):
+                e.evaluate(code)
+        e.evaluate('extern bar(x)')
+        with self.assertRaises(BytecodeError):
+            e.evaluate('def bar(x) y')
+        e.evaluate('def bar(x) x + 2')
+        self.assertEqual(e.evaluate('bar(foo(1))'), 4)
+
+    def test_putchard(self):
+        import io, contextlib
+        e = BytecodeEvaluator()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            e.evaluate('for i = 65, i < 68 in putchard(i)')
+        self.assertEqual(output.getvalue(), 'ABC')
+
+    def test_noexec_and_timeit(self):
+        e = BytecodeEvaluator()
+        e.evaluate('def sq(x) x * x')
+        results = list(e.eval_generator('sq(2)', {'noexec': True}))
+        self.assertIn('CALL         sq 1', results[0].value)
+        timing = e.timeit('sq(3)', repeat=10)
+        self.assertEqual((timing.value, timing.runs), (9, 10))
+        self.assertLessEqual(timing.min, timing.median)
@@ -0,0 +1,56 @@
+import json, os, socket, sys
+
+# Thin client of the evaluation server (see server.py). It only needs the
+# standard library, so that one-shot commands skip the import and warm-up
+# costs the server has already paid.
+
+SERVER_ENV = 'KAL_SERVER'
+SESSION_ENV = 'KAL_SESSION'
+
+class ServerError(Exception): pass
+
+def server_address():
+    """Returns the socket path of the server given by the environment, if any."""
+    path = os.environ.get(SERVER_ENV)
+    return path if path and os.path.exists(path) else None
+
+def request(path, message):
+    """Send a request to the server listening on the unix socket path and
+    return its response."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        with sock.makefile('rw', encoding='utf-8') as stream:
+            stream.write(json.dumps(message) + '\n')
+            stream.flush()
+            line = stream.readline()
+    if not line:
+        raise ServerError('No response from server ' + path)
+    return json.loads(line)
+
+def evaluate(path, code, session = None):
+    """Evaluate code on the server. Returns the list of values, None for
+    definitions. Raises ServerError with the server message on failure."""
+    message = {'code': code}
+    if session:
+        message['session'] = session
+    response = request(path, message)
+    if 'error' in response:
+        raise ServerError('{type}: {message}'.format(**response['error']))
+    return response['values']
+
+def run(code):
+    """Run a one-shot command on the server given by the environment.
+    Returns None when no server is available, otherwise the exit status of
+    the command: 1 after an error, 0 otherwise."""
+    path = server_address()
+    if not path:
+        return None
+    try:
+        values = evaluate(path, code, os.environ.get(SESSION_ENV))
+    except (OSError, ServerError) as err:
+        print(err, file=sys.stderr)
+        return 1
+    for value in values:
+        if value is not None:
+            print(value)
+    return 0
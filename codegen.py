@@ -1,14 +1,144 @@
 from ast import *
+from collections import namedtuple
+from profiler import ProfileCounters
+from simd import VariantGenerator, is_pure, is_pure_extern, simd_name
+import parallel
+import arrays
+import memo
+from arrays import array_type, element_type, is_array
 import llvmlite.ir as ir
 import llvmlite.binding as llvm
 
 
+# Fast-math flags the floating point instructions may carry. They let LLVM
+# reassociate, contract into fused multiply-adds, assume no NaN, no infinity,
+# no signed zero, and replace divisions by multiplications by reciprocals.
+FASTMATH_FLAGS = ('reassoc', 'contract', 'nnan', 'ninf', 'nsz', 'arcp')
+
+def fastmath_flags(fastmath):
+    """Returns the tuple of the fast-math flags selected by fastmath: none for
+    a false value, all of them for True or 'fast', otherwise the flags named
+    by a comma separated string or a sequence of names."""
+    if not fastmath:
+        return ()
+    if fastmath is True or fastmath == 'fast':
+        return FASTMATH_FLAGS
+    if isinstance(fastmath, str):
+        fastmath = [flag.strip() for flag in fastmath.split(',') if flag.strip()]
+    for flag in fastmath:
+        if flag not in FASTMATH_FLAGS:
+            raise ValueError('Unknown fast-math flag: {0}'.format(flag))
+    # In the order of FASTMATH_FLAGS, not to tell apart the same selections
+    return tuple(flag for flag in FASTMATH_FLAGS if flag in fastmath)
+
 def irdouble(pyval):
     """Converts a python value into an IR double constant value"""
     return ir.Constant(ir.DoubleType(), pyval)
 
+def irint(pyval):
+    """Converts a python value into an IR 32 bits integer constant value"""
+    return ir.Constant(ir.IntType(32), pyval)
+
+# IR types of the values of each type
+IR_TYPES = {
+    'f64': ir.DoubleType(),
+    'f32': ir.FloatType(),
+    'i64': ir.IntType(64),
+    'bool': ir.IntType(1)}
+
+# The arrays are pointers to their descriptor, {element* data, i64 length}
+ELEMENT_IR_TYPES = {
+    'f64': ir.DoubleType(),
+    'f32': ir.FloatType(),
+    'i64': ir.IntType(64),
+    'u8': ir.IntType(8)}
+IR_TYPES.update({
+    array_type(element): ir.LiteralStructType([irtype.as_pointer(), ir.IntType(64)]).as_pointer()
+    for element, irtype in ELEMENT_IR_TYPES.items()})
+
+def type_name(irtype):
+    """Returns the type of the values of an IR type."""
+    for name, candidate in IR_TYPES.items():
+        if candidate == irtype:
+            return name
+    raise CodegenError('Not the type of a value: {0}'.format(irtype))
+
+def _is_float(irtype):
+    return isinstance(irtype, (ir.DoubleType, ir.FloatType))
+
+# Static types of the number literals: the integral ones take the type of the
+# values they compute with, the fractional ones only a floating point type.
+# They are f64 otherwise.
+INTEGRAL = 'integral'
+FRACTIONAL = 'fractional'
+
+def _common_type(a, b):
+    """Returns the type the builtin operators compute in, given the types of
+    their operands: the widest one, the booleans counting as i64."""
+    if is_array(a) or is_array(b):
+        raise CodegenError('Arrays are only computed with through their elements')
+    types = {a, b}
+    if 'f64' in types:
+        return 'f64'
+    if 'f32' in types:
+        return 'f32'
+    integers = types & {'i64', 'bool'}
+    if FRACTIONAL in types:
+        return 'f64' if integers else FRACTIONAL
+    if integers:
+        return 'i64'
+    return INTEGRAL
+
+def _branch_type(a, b):
+    """Returns the type of the values of two branches."""
+    return a if a == b else _common_type(a, b)
+
+def _resolved(type):
+    """Returns the type of the values of a static type."""
+    return DEFAULT_TYPE if type in (INTEGRAL, FRACTIONAL) else type
+
+def _stored_type(type):
+    """Returns the type of a variable inferred from the type of its value,
+    or of the accumulator of a reduction: only the typed numbers keep their
+    type, the booleans being counted as f64, as the literals."""
+    return type if type in ('i64', 'f32') or is_array(type) else DEFAULT_TYPE
+
+def _loaded_type(type):
+    """Returns the type of the elements loaded from an array type: the u8
+    ones are loaded as i64."""
+    if not is_array(type):
+        return DEFAULT_TYPE
+    element = element_type(type)
+    return 'i64' if element == 'u8' else element
+
+# Identities of the reductions of integers
+INT_REDUCTIONS = {'+': 0, '*': 1, 'min': 2 ** 63 - 1, 'max': -2 ** 63}
+
+def _identity(reduction, irtype):
+    """Returns the identity of a reduction, as an IR constant."""
+    if isinstance(irtype, ir.IntType):
+        return ir.Constant(irtype, INT_REDUCTIONS[reduction])
+    return ir.Constant(irtype, REDUCTIONS[reduction])
+
+def _is_arithmetic(node):
+    """Whether an expression only computes on numbers and variables with the
+    builtin operators, which neither assign nor call anything."""
+    if isinstance(node, (Number, Variable)):
+        return True
+    return isinstance(node, Binary) and node.op in ('+', '-', '*') \
+        and _is_arithmetic(node.lhs) and _is_arithmetic(node.rhs)
+
+# Type of the functions outlined from the parallel loops
+CHUNK_TYPE = ir.FunctionType(ir.VoidType(), 
+    [ir.DoubleType().as_pointer(), ir.IntType(64), ir.IntType(64), ir.DoubleType().as_pointer()])
+
 class CodegenError(Exception): pass
 
+# A function taken out of the module to be defined again: the IR functions of
+# its code, the ones outlined from its parallel loops, whether it is pure and
+# whether its code comes from elsewhere.
+Retired = namedtuple('Retired', ['functions', 'outlined', 'pure', 'prebuilt'])
+
 class LLVMCodeGenerator(object):
     def __init__(self):
         """Initialize the code generator.
@@ -28,16 +158,199 @@ class LLVMCodeGenerator(object):
         # names to ir.Value.
         self.func_symtab = {}
 
+        # The static types of the expressions of the function being
+        # generated, computed once: maps id(node) to (node, type).
+        self.types = {}
+
+        # Names of the functions only declared in the module, whose bodies
+        # come already compiled from elsewhere (a snapshot for instance).
+        self.prebuilt = set()
+
+        # When set, the named functions generated are instrumented to update
+        # their counters in this Profiler.
+        self.profiler = None
+        self.profile_address = None
+
+        # Keeps the tables of the memoized functions, and the names of the
+        # named functions generated without side effects, here or, for the
+        # prebuilt ones, where they were compiled.
+        self.memo_tables = None
+        self.pure = set()
+
+        # When set, the pure named functions also get a SIMD variant
+        # computing this many values at once.
+        self.simd_width = None
+
+        # Functions outlined from the parallel loops of each function, which
+        # are part of its code, and the name of the function being generated.
+        self.outlined = {}
+        self.function_name = None
+
+        # When set, the '+' and '*' reductions may be reassociated, and the
+        # reduction loops counting up to a bound run a fixed number of
+        # iterations: LLVM vectorizes them.
+        self.reassociate = False
+
+        # When set, the indexes out of the bounds of the arrays are reported
+        # to the runtime rather than accessing the memory.
+        self.bounds_check = True
+
+        # Fast-math flags of the floating point instructions and intrinsic
+        # calls generated.
+        self.fastmath = ()
+
     def generate_code(self, node):
         assert isinstance(node, (Prototype, Function))
         return self._codegen(node)
 
-    def _alloca(self, name):
-        """Create an alloca in the entry BB of the current function."""
+    def _alloca(self, name, type = None):
+        """Create an alloca in the entry BB of the current function, for a
+        double unless given another IR type."""
         with self.builder.goto_entry_block():
-            alloca = self.builder.alloca(ir.DoubleType(), size=None, name=name)
+            alloca = self.builder.alloca(type or ir.DoubleType(), size=None, name=name)
         return alloca
 
+    def _scope(self):
+        """Returns the types of the variables in scope."""
+        return {name: type_name(addr.type.pointee) for name, addr in self.func_symtab.items()}
+
+    def _type_of(self, node, scope = None):
+        """Returns the static type of an expression: the type of the values
+        the code generated for it computes, or INTEGRAL or FRACTIONAL for the
+        literals taking the type of the values they compute with. scope gives
+        the types of the variables, the ones in scope when None. The types
+        are kept in self.types, an expression always having the same scope
+        in the function generated."""
+        known = self.types.get(id(node))
+        if known is not None:
+            return known[1]
+        if scope is None:
+            scope = self._scope()
+        type = self._infer_type(node, scope)
+        self.types[id(node)] = node, type
+        return type
+
+    def _infer_type(self, node, scope):
+        if isinstance(node, Number):
+            return INTEGRAL if float(node.val).is_integer() else FRACTIONAL
+        if isinstance(node, Variable):
+            return scope.get(node.name, DEFAULT_TYPE)
+        if isinstance(node, Index):
+            return _loaded_type(scope.get(node.name))
+        if isinstance(node, Unary):
+            return self._return_type('unary' + node.op)
+        if isinstance(node, Binary):
+            if node.op == '=':
+                return self._type_of(node.lhs, scope)
+            if node.op == '<':
+                return 'bool'
+            if node.op in ('+', '-', '*'):
+                return _common_type(self._type_of(node.lhs, scope), self._type_of(node.rhs, scope))
+            return self._return_type('binary' + node.op)
+        if isinstance(node, Call):
+            if self._is_length(node, scope):
+                return 'i64'
+            return self._return_type(node.callee)
+        if isinstance(node, If):
+            return _branch_type(self._type_of(node.then_expr, scope), self._type_of(node.else_expr, scope))
+        if isinstance(node, For):
+            counter = self._counter_type(node, scope)
+            if node.reduction is None:
+                return counter
+            return _stored_type(self._type_of(node.body, dict(scope, **{node.id_name: counter})))
+        if isinstance(node, VarIn):
+            scope = dict(scope)
+            for name, init in node.vars:
+                scope[name] = self._var_type(node, name, init, scope)
+            return self._type_of(node.body, scope)
+        return DEFAULT_TYPE
+
+    def _is_length(self, node, scope = None):
+        """Whether a call is the length query of an array, len(array)."""
+        return node.callee == 'len' and len(node.args) == 1 \
+            and is_array(self._type_of(node.args[0], scope))
+
+    def _return_type(self, funcname):
+        func = self.module.globals.get(funcname)
+        if not isinstance(func, ir.Function):
+            return DEFAULT_TYPE
+        return type_name(func.function_type.return_type)
+
+    def _var_type(self, node, name, init, scope):
+        """Returns the type of a variable of a 'var' expression: its
+        annotation, or the one inferred from its initializer."""
+        type = node.types.get(name)
+        if type is None and init is not None:
+            type = _stored_type(self._type_of(init, scope))
+        return type or DEFAULT_TYPE
+
+    def _counter_type(self, node, scope):
+        """Returns the type of the counter of a loop: its annotation, or the
+        type of its start value when typed. An integral start counting up to
+        an i64 bound by a whole number makes an i64 counter too."""
+        type = node.id_type
+        if type is None:
+            start = self._type_of(node.start_expr, scope)
+            end = node.end_expr
+            increment = self._step_increment(node)
+            if start in ('i64', 'f32'):
+                type = start
+            elif start == INTEGRAL and increment is not None and increment.is_integer() \
+                    and isinstance(end, Binary) and end.op == '<' \
+                    and isinstance(end.lhs, Variable) and end.lhs.name == node.id_name \
+                    and node.id_name not in parallel.free_variables(end.rhs)[0] \
+                    and self._type_of(end.rhs, scope) == 'i64':
+                type = 'i64'
+        if type == 'bool' or is_array(type):
+            raise CodegenError('Loop counter cannot be a {0}: {1}'.format(type, node.id_name))
+        return type or DEFAULT_TYPE
+
+    def _codegen_as(self, node, type):
+        """Generate an expression, its value converted to the given type. The
+        number literals are generated in that type directly."""
+        if isinstance(node, Number) and not is_array(type):
+            irtype = IR_TYPES[type]
+            value = float(node.val)
+            if type == 'bool':
+                return ir.Constant(irtype, int(value != 0))
+            if isinstance(irtype, ir.IntType):
+                return ir.Constant(irtype, int(value))
+            return ir.Constant(irtype, value)
+        return self._convert(self._codegen(node), IR_TYPES[type])
+
+    def _convert(self, value, irtype, name = ''):
+        """Returns a value converted to another IR type. Numbers are true
+        when not zero, true is 1, and the floating point values are
+        truncated toward zero into integers."""
+        source = value.type
+        if source == irtype:
+            return value
+        if isinstance(source, ir.PointerType) or isinstance(irtype, ir.PointerType):
+            raise CodegenError('Cannot convert {0} to {1}'.format(
+                type_name(source), type_name(irtype)))
+        if irtype == IR_TYPES['bool']:
+            if _is_float(source):
+                return self.builder.fcmp_ordered(
+                    '!=', value, ir.Constant(source, 0.0), name, self.fastmath)
+            return self.builder.icmp_signed('!=', value, ir.Constant(source, 0), name)
+        if source == IR_TYPES['bool']:
+            if _is_float(irtype):
+                return self.builder.uitofp(value, irtype, name)
+            return self.builder.zext(value, irtype, name)
+        if _is_float(source) and _is_float(irtype):
+            if isinstance(source, ir.FloatType):
+                return self.builder.fpext(value, irtype, name)
+            return self.builder.fptrunc(value, irtype, name)
+        if _is_float(source):
+            return self.builder.fptosi(value, irtype, name)
+        return self.builder.sitofp(value, irtype, name)
+
+    def _call_args(self, func, args):
+        """Generate the arguments of a call, converted to the types of the
+        parameters."""
+        return [self._codegen_as(arg, type_name(param))
+            for arg, param in zip(args, func.function_type.args)]
+
     def _codegen(self, node):
         """Node visitor. Dispatches upon node type.
         For AST node of class Foo, calls self._codegen_Foo. Each visitor is
@@ -60,10 +373,81 @@ class LLVMCodeGenerator(object):
         return self.builder.load(self._varaddr(node.name), node.name)
 
     def _codegen_Assignment(self, lhs, rhs):
+        if isinstance(lhs, Index):
+            return self._codegen_Store(lhs, rhs)
         if not isinstance(lhs, Variable):
             raise CodegenError('lhs of "=" must be a variable')
-        value = self._codegen(rhs)
-        self.builder.store(value, self._varaddr(lhs.name))
+        addr = self._varaddr(lhs.name)
+        value = self._codegen_as(rhs, type_name(addr.type.pointee))
+        self.builder.store(value, addr)
+        return value
+
+    def _array(self, name):
+        """Returns the array of a variable, and its element type."""
+        addr = self._varaddr(name)
+        type = type_name(addr.type.pointee)
+        if not is_array(type):
+            raise CodegenError('Not an array: ' + name)
+        return self.builder.load(addr, name), element_type(type)
+
+    def _array_length(self, array):
+        return self.builder.load(self.builder.gep(array, [irint(0), irint(1)]), 'length')
+
+    def _element_access(self, node, access):
+        """Generate the access to an array element: access(address, element)
+        is called to generate it given the address and the type of the
+        element. With the bounds checks, it is only run for an index within
+        the bounds, the other ones being reported. Returns the value of the
+        access, or the zero of the element type for an index out of bounds."""
+        array, element = self._array(node.name)
+        index = self._codegen_as(node.index, 'i64')
+        data = self.builder.load(self.builder.gep(array, [irint(0), irint(0)]), 'data')
+        address = self.builder.gep(data, [index], name='element')
+        if not self.bounds_check:
+            return access(address, element)
+        # The negative indexes are huge unsigned ones
+        length = self._array_length(array)
+        inside = self.builder.icmp_unsigned('<', index, length, 'inbounds')
+        with self.builder.if_else(inside) as (then, otherwise):
+            with then:
+                value = access(address, element)
+                then_bb = self.builder.block
+            with otherwise:
+                self.builder.call(self._index_error(), [index, length])
+                else_bb = self.builder.block
+        if value is None:
+            return None
+        phi = self.builder.phi(value.type, 'element')
+        phi.add_incoming(value, then_bb)
+        phi.add_incoming(ir.Constant(value.type, 0), else_bb)
+        return phi
+
+    def _index_error(self):
+        function = self.module.globals.get(arrays.INDEX_ERROR)
+        if function is None:
+            i64 = ir.IntType(64)
+            function = ir.Function(self.module, ir.FunctionType(ir.VoidType(), [i64, i64]),
+                arrays.INDEX_ERROR)
+        return function
+
+    def _codegen_Index(self, node):
+        # An index out of bounds loads 0
+        def load(address, element):
+            value = self.builder.load(address)
+            if element == 'u8':
+                return self.builder.zext(value, ir.IntType(64))
+            return value
+        return self._element_access(node, load)
+
+    def _codegen_Store(self, lhs, rhs):
+        # An index out of bounds stores nothing
+        value = self._codegen_as(rhs, self._type_of(lhs))
+        def store(address, element):
+            if element == 'u8':
+                self.builder.store(self.builder.trunc(value, ELEMENT_IR_TYPES['u8']), address)
+            else:
+                self.builder.store(value, address)
+        self._element_access(lhs, store)
         return value
 
     def _codegen_Binary(self, node):
@@ -73,32 +457,44 @@ class LLVMCodeGenerator(object):
         if node.op == '=':
             return self._codegen_Assignment(node.lhs, node.rhs)
 
-        lhs = self._codegen(node.lhs)
-        rhs = self._codegen(node.rhs)
-
-        if node.op == '+':
-            return self.builder.fadd(lhs, rhs, 'addop')
-        elif node.op == '-':
-            return self.builder.fsub(lhs, rhs, 'subop')
-        elif node.op == '*':
-            return self.builder.fmul(lhs, rhs, 'multop')
-        elif node.op == '<':
-            cmp = self.builder.fcmp_unordered('<', lhs, rhs, 'ltop')
-            return self.builder.uitofp(cmp, ir.DoubleType(), 'ltoptodouble')
-        else:
+        if node.op not in ('+', '-', '*', '<'):
             # Not one of the predefined operators, so it must be a user-defined one.
             # Emit a call to it.
             func = self.module.get_global('binary{0}'.format(node.op))
             if func is None:
                 raise CodegenError('Unknown binary operator', node.op)
-            return self.builder.call(func, [lhs, rhs], 'userbinop')    
+            return self.builder.call(func, self._call_args(func, [node.lhs, node.rhs]), 'userbinop')
+
+        # The predefined operators compute in the widest type of their
+        # operands, '<' giving a bool.
+        type = _resolved(_common_type(self._type_of(node.lhs), self._type_of(node.rhs)))
+        lhs = self._codegen_as(node.lhs, type)
+        rhs = self._codegen_as(node.rhs, type)
+
+        if not _is_float(lhs.type):
+            if node.op == '+':
+                return self.builder.add(lhs, rhs, 'addop')
+            elif node.op == '-':
+                return self.builder.sub(lhs, rhs, 'subop')
+            elif node.op == '*':
+                return self.builder.mul(lhs, rhs, 'multop')
+            return self.builder.icmp_signed('<', lhs, rhs, 'ltop')
+        if node.op == '+':
+            return self.builder.fadd(lhs, rhs, 'addop', self.fastmath)
+        elif node.op == '-':
+            return self.builder.fsub(lhs, rhs, 'subop', self.fastmath)
+        elif node.op == '*':
+            return self.builder.fmul(lhs, rhs, 'multop', self.fastmath)
+        return self.builder.fcmp_unordered('<', lhs, rhs, 'ltop', self.fastmath)
 
 
     def _codegen_If(self, node):
+        # Both branches give values of the type of the expression
+        type = _resolved(self._type_of(node))
+
         # Emit comparison value
         cond_val = self._codegen(node.cond_expr)
-        cmp = self.builder.fcmp_ordered(
-            '!=', cond_val, irdouble(0.0), 'notnull')
+        cmp = self._convert(cond_val, IR_TYPES['bool'], 'notnull')
 
         # Create basic blocks to express the control flow
         then_bb = ir.Block(self.builder.function, 'then')
@@ -111,7 +507,7 @@ class LLVMCodeGenerator(object):
         # Emit the 'then' part
         self.builder.function.basic_blocks.append(then_bb)
         self.builder.position_at_start(then_bb)
-        then_val = self._codegen(node.then_expr)
+        then_val = self._codegen_as(node.then_expr, type)
         self.builder.branch(merge_bb)
         # Emission of then_val could have generated a new basic block 
         # (and thus modified the current basic block). 
@@ -121,35 +517,46 @@ class LLVMCodeGenerator(object):
         # Emit the 'else' part
         self.builder.function.basic_blocks.append(else_bb)
         self.builder.position_at_start(else_bb)
-        else_val = self._codegen(node.else_expr)
+        else_val = self._codegen_as(node.else_expr, type)
         self.builder.branch(merge_bb)
         else_bb = self.builder.block
 
         # Emit the merge block
         self.builder.function.basic_blocks.append(merge_bb)
         self.builder.position_at_start(merge_bb)
-        phi = self.builder.phi(ir.DoubleType(), 'ifval')
+        phi = self.builder.phi(IR_TYPES[type], 'ifval')
         phi.add_incoming(then_val, then_bb)
         phi.add_incoming(else_val, else_bb)
         return phi
 
 
     def _codegen_For(self, node):
+        scope = self._scope()
+        counter = self._counter_type(node, scope)
+        # The type of the body values reduced
+        reduced = node.reduction and _stored_type(
+            self._type_of(node.body, dict(scope, **{node.id_name: counter})))
+        if node.reduction and (self.reassociate or 'reassoc' in self.fastmath):
+            increment = self._counted_increment(node)
+            if increment and (counter != 'i64' or increment.is_integer()):
+                return self._codegen_CountedFor(node, increment, counter, reduced)
         # Output this as:
         #   ...
         #   start = startexpr
         #   goto loopcond
         # loopcond:
         #   variable = phi [start, loopheader], [nextvariable, loopbody]
+        #   accumulator = phi [identity, loopheader], [nextaccumulator, loopbody]
         #   step = stepexpr (or variable + 1)
         #   nextvariable = step
         #   endcond = endexpr
         #   br endcond, loopbody, loopafter
         # loopbody:
         #   bodyexpr
+        #   nextaccumulator = accumulator op bodyexpr
         #   jmp loopcond
         # loopafter:
-        #   return variable
+        #   return variable (or accumulator)
 
         # Define blocks
         loopcond_bb = ir.Block(self.builder.function, 'loopcond')
@@ -161,10 +568,10 @@ class LLVMCodeGenerator(object):
         #############
 
         # Allocate the variable on the stack
-        var_addr = self._alloca(node.id_name)
+        var_addr = self._alloca(node.id_name, IR_TYPES[counter])
 
         # Evaluate the starting value for the counter and store it
-        start_val = self._codegen(node.start_expr)
+        start_val = self._codegen_as(node.start_expr, counter)
         self.builder.store(start_val, var_addr)
 
         # Save the current block to tell the loop cond where we are coming from
@@ -181,6 +588,12 @@ class LLVMCodeGenerator(object):
         self.builder.function.basic_blocks.append(loopcond_bb)
         self.builder.position_at_start(loopcond_bb)
 
+        # The reduction of the body values is carried from one iteration to
+        # the next in a register
+        if node.reduction:
+            accumulator = self.builder.phi(IR_TYPES[reduced], 'accumulator')
+            accumulator.add_incoming(_identity(node.reduction, accumulator.type), loopheader_bb)
+
         # Set the symbol table to to reach de local counting variable. 
         # If it shadows an existing variable, save it before and restore it later.
         oldval = self.func_symtab.get(node.id_name)
@@ -188,7 +601,7 @@ class LLVMCodeGenerator(object):
 
         # Compute the end condition
         endcond = self._codegen(node.end_expr)
-        cmp = self.builder.fcmp_ordered( '!=', endcond, irdouble(0.0), 'loopcond')
+        cmp = self._convert(endcond, IR_TYPES['bool'], 'loopcond')
 
         # Goto loop body if condition satisfied, otherwise, exit.
         self.builder.cbranch(cmp, loopbody_bb, loopafter_bb)
@@ -201,17 +614,25 @@ class LLVMCodeGenerator(object):
         self.builder.function.basic_blocks.append(loopbody_bb)
         self.builder.position_at_start(loopbody_bb)
 
+        if self.profile_address:
+            self._profile_add('trips', ir.Constant(ir.IntType(64), 1))
+
         # Emit the body of the loop. 
-        # Note that we ignore the value computed by the body.
-        body_val = self._codegen(node.body)
+        # Note that we ignore the value computed by the body, unless reduced.
+        if node.reduction:
+            body_val = self._reduce(node.reduction, accumulator, self._codegen_as(node.body, reduced))
+        else:
+            self._codegen(node.body)
 
         # If the step is unknown, make it increment by 1
         if node.step_expr is None:
             node.step_expr = Binary("+",Variable(node.id_name), Number(1.0))
 
         # Evaluate the step and update the counter    
-        nextval = self._codegen(node.step_expr)
+        nextval = self._codegen_as(node.step_expr, counter)
         self.builder.store(nextval, var_addr)
+        if node.reduction:
+            accumulator.add_incoming(body_val, self.builder.block)
 
         # Goto loop cond
         self.builder.branch(loopcond_bb)
@@ -232,44 +653,359 @@ class LLVMCodeGenerator(object):
         else:
             self.func_symtab[node.id_name] = oldval
 
-        # The 'for' expression returns the last value of the counter
+        # The 'for' expression returns the last value of the counter, or the
+        # reduction of the body values
+        if node.reduction:
+            return accumulator
         return self.builder.load(var_addr)
 
+    def _counted_increment(self, node):
+        """Returns the number a loop adds to its counter when the loop runs a
+        number of iterations known at its start: its bound and counter are
+        left alone by the body, and the bound only computes on variables.
+        None otherwise."""
+        end = node.end_expr
+        if not (isinstance(end, Binary) and end.op == '<' and isinstance(end.lhs, Variable)
+                and end.lhs.name == node.id_name and _is_arithmetic(end.rhs)):
+            return None
+        used = parallel.free_variables(end.rhs)[0]
+        assigned = parallel.free_variables(node.body)[1]
+        if node.id_name in used or assigned & (used | {node.id_name}):
+            return None
+        return self._step_increment(node)
+
+    def _codegen_CountedFor(self, node, increment, counter, reduced):
+        # Output a loop running a number of iterations known at its start as:
+        #   ...
+        #   start = startexpr
+        #   bound = boundexpr
+        #   trips = ceil((bound - start) / increment), or 0
+        #   goto loopcond
+        # loopcond:
+        #   index = phi [0, loopheader], [index + 1, loopbody]
+        #   accumulator = phi [identity, loopheader], [nextaccumulator, loopbody]
+        #   br index < trips, loopbody, loopafter
+        # loopbody:
+        #   variable = start + index * increment
+        #   nextaccumulator = accumulator op bodyexpr
+        #   jmp loopcond
+        # loopafter:
+        #   return accumulator
+        # The integer index, unlike the counter, lets LLVM vectorize the loop.
+        var_addr = self._alloca(node.id_name, IR_TYPES[counter])
+        start = self._codegen_as(node.start_expr, counter)
+        trips = self._trip_count(start, self._codegen(node.end_expr.rhs), increment)
+        loopheader_bb = self.builder.block
+        loopcond_bb = self.builder.append_basic_block('loopcond')
+        loopbody_bb = self.builder.append_basic_block('loopbody')
+        loopafter_bb = self.builder.append_basic_block('loopafter')
+        self.builder.branch(loopcond_bb)
+
+        self.builder.position_at_start(loopcond_bb)
+        index = self.builder.phi(trips.type, 'index')
+        index.add_incoming(ir.Constant(trips.type, 0), loopheader_bb)
+        accumulator = self.builder.phi(IR_TYPES[reduced], 'accumulator')
+        accumulator.add_incoming(_identity(node.reduction, accumulator.type), loopheader_bb)
+        self.builder.cbranch(self.builder.icmp_signed('<', index, trips), loopbody_bb, loopafter_bb)
+
+        self.builder.position_at_start(loopbody_bb)
+        if self.profile_address:
+            self._profile_add('trips', ir.Constant(ir.IntType(64), 1))
+        oldval = self.func_symtab.get(node.id_name)
+        self.func_symtab[node.id_name] = var_addr
+        self.builder.store(self._counter_value(start, index, increment), var_addr)
+        body_val = self._reduce(node.reduction, accumulator, self._codegen_as(node.body, reduced))
+        accumulator.add_incoming(body_val, self.builder.block)
+        index.add_incoming(self.builder.add(index, ir.Constant(trips.type, 1)), self.builder.block)
+        self.builder.branch(loopcond_bb)
+
+        self.builder.position_at_start(loopafter_bb)
+        if oldval is None:
+            del self.func_symtab[node.id_name]
+        else:
+            self.func_symtab[node.id_name] = oldval
+        return accumulator
+
+    def _codegen_ParFor(self, node):
+        # Output this as a call to the parallel runtime, given the function
+        # outlined from the loop, which computes a chunk of the iterations:
+        #   ...
+        #   env = [start, variables used by the body]
+        #   trips = ceil((bound - start) / increment), or 0
+        #   count = runtime(chunk, env, trips, partials, capacity)
+        #   reduce partials[0] to partials[count - 1], in order
+        # The counter of the iteration k is start + k * increment. The values
+        # of env and partials are held in doubles, the i64 ones keeping their
+        # bits.
+        double = ir.DoubleType()
+        i64 = ir.IntType(64)
+        end = node.end_expr
+        if not (isinstance(end, Binary) and end.op == '<' and isinstance(end.lhs, Variable)
+                and end.lhs.name == node.id_name
+                and node.id_name not in parallel.free_variables(end.rhs)[0]):
+            raise CodegenError('parfor needs an end condition of the form {0} < bound'.format(node.id_name))
+        scope = self._scope()
+        counter = self._counter_type(node, scope)
+        increment = self._step_increment(node)
+        if increment is None or (counter == 'i64' and not increment.is_integer()):
+            raise CodegenError('parfor needs a step of the form {0} + positive number'.format(node.id_name))
+        used, assigned = parallel.free_variables(node.body, {node.id_name})
+        for name in sorted(assigned):
+            if name in self.func_symtab:
+                # The iterations would race to assign it
+                raise CodegenError('parfor body assigns an outer variable: ' + name)
+        captured = sorted(name for name in used if name in self.func_symtab)
+
+        reduced = node.reduction and _stored_type(
+            self._type_of(node.body, dict(scope, **{node.id_name: counter})))
+
+        start = self._codegen_as(node.start_expr, counter)
+        bound = self._codegen(end.rhs)
+        with self.builder.goto_entry_block():
+            env = self.builder.alloca(ir.ArrayType(double, 1 + len(captured)), name='env')
+        for index, value in enumerate(
+                [start] + [self.builder.load(self.func_symtab[name]) for name in captured]):
+            self.builder.store(self._to_slot(value), self.builder.gep(env, [irint(0), irint(index)]))
+        chunk = self._codegen_chunk(node, captured, increment, counter, reduced)
+
+        trips = self._trip_count(start, bound, increment)
+
+        capacity = parallel.runtime().workers
+        with self.builder.goto_entry_block():
+            partials = self.builder.alloca(ir.ArrayType(double, capacity), name='partials')
+        count = self.builder.call(self._parallel_runtime(), [
+            chunk,
+            self.builder.bitcast(env, double.as_pointer()),
+            trips,
+            self.builder.bitcast(partials, double.as_pointer()),
+            ir.Constant(i64, capacity)], 'chunks')
+
+        if node.reduction is None:
+            # The counter value past the last iteration, as 'for' returns
+            return self._counter_value(start, trips, increment)
+        return self._reduce_partials(node.reduction, partials, count, IR_TYPES[reduced])
+
+    def _step_increment(self, node):
+        """Returns the positive number a loop step adds to the counter, or
+        None for the other steps."""
+        step = node.step_expr
+        if step is None:
+            return 1.0
+        if isinstance(step, Binary) and step.op == '+':
+            for counter, number in [(step.lhs, step.rhs), (step.rhs, step.lhs)]:
+                if isinstance(counter, Variable) and counter.name == node.id_name \
+                        and isinstance(number, Number) and float(number.val) > 0:
+                    return float(number.val)
+        return None
+
+    def _trip_count(self, start, bound, increment):
+        """Returns the i64 number of iterations of a loop counting from start
+        while below bound: ceil((bound - start) / increment), or 0. NaNs give
+        no iterations. It is computed on doubles, whatever the types."""
+        double = ir.DoubleType()
+        i64 = ir.IntType(64)
+        start = self._convert(start, double)
+        bound = self._convert(bound, double)
+        trips = self.builder.fdiv(
+            self.builder.fsub(bound, start, '', self.fastmath), irdouble(increment), '', self.fastmath)
+        functype = ir.FunctionType(double, [double])
+        trips = self.builder.call(self.module.declare_intrinsic('llvm.ceil', [double], functype), [trips],
+            fastmath=self.fastmath)
+        positive = self.builder.fcmp_ordered('>', trips, irdouble(0.0), '', self.fastmath)
+        return self.builder.select(positive, self.builder.fptosi(trips, i64), ir.Constant(i64, 0), 'trips')
+
+    def _counter_value(self, start, index, increment):
+        """Returns the counter of the iteration index of a loop running a
+        known number of iterations: start + index * increment, in the type
+        of start."""
+        if not _is_float(start.type):
+            return self.builder.add(start, self.builder.mul(index, ir.Constant(index.type, int(increment))))
+        steps = self.builder.fmul(
+            self.builder.sitofp(index, start.type), ir.Constant(start.type, increment), '', self.fastmath)
+        return self.builder.fadd(start, steps, '', self.fastmath)
+
+    def _to_slot(self, value):
+        """Returns a value to store in a double shared with the parallel
+        runtime: the i64 ones and the arrays keep their bits."""
+        if isinstance(value.type, ir.PointerType):
+            value = self.builder.ptrtoint(value, IR_TYPES['i64'])
+        if value.type == IR_TYPES['i64']:
+            return self.builder.bitcast(value, ir.DoubleType())
+        return self._convert(value, ir.DoubleType())
+
+    def _from_slot(self, value, irtype):
+        """Returns the value of a given IR type stored by _to_slot."""
+        if isinstance(irtype, ir.PointerType):
+            return self.builder.inttoptr(self.builder.bitcast(value, IR_TYPES['i64']), irtype)
+        if irtype == IR_TYPES['i64']:
+            return self.builder.bitcast(value, irtype)
+        return self._convert(value, irtype)
+
+    def _parallel_runtime(self):
+        runtime = self.module.globals.get(parallel.RUNTIME)
+        if runtime is None:
+            double_ptr = ir.DoubleType().as_pointer()
+            i64 = ir.IntType(64)
+            runtime = ir.Function(self.module, ir.FunctionType(i64,
+                [CHUNK_TYPE.as_pointer(), double_ptr, i64, double_ptr, i64]), parallel.RUNTIME)
+        return runtime
+
+    def _codegen_chunk(self, node, captured, increment, counter, reduced):
+        """Outline the body of a parallel loop into a function computing a
+        chunk of its iterations. It lives in the module of the function."""
+        outlined = self.outlined.setdefault(self.function_name, [])
+        chunk = ir.Function(self.builder.function.module, CHUNK_TYPE,
+            parallel.outlined_name(self.function_name, len(outlined) + 1))
+        chunk.linkage = 'internal'
+        outlined.append(chunk)
+        types = {name: self.func_symtab[name].type.pointee for name in captured}
+        saved = self.builder, self.func_symtab, self.profile_address
+        # The counters being shared by the threads, the chunks aren't profiled
+        self.profile_address = None
+        try:
+            env, lo, hi, partial = chunk.args
+            self.builder = ir.IRBuilder(chunk.append_basic_block('entry'))
+            self.func_symtab = {}
+            start = self._from_slot(
+                self.builder.load(self.builder.gep(env, [irint(0)]), 'start'), IR_TYPES[counter])
+            for index, name in enumerate(captured):
+                self.func_symtab[name] = self._alloca(name, types[name])
+                value = self.builder.load(self.builder.gep(env, [irint(index + 1)]))
+                self.builder.store(self._from_slot(value, types[name]), self.func_symtab[name])
+            counter = self.func_symtab[node.id_name] = self._alloca(node.id_name, start.type)
+            if node.reduction:
+                accumulator = self._alloca('accumulator', IR_TYPES[reduced])
+                self.builder.store(_identity(node.reduction, IR_TYPES[reduced]), accumulator)
+
+            entry_bb = self.builder.block
+            cond_bb = chunk.append_basic_block('loopcond')
+            body_bb = chunk.append_basic_block('loopbody')
+            after_bb = chunk.append_basic_block('loopafter')
+            self.builder.branch(cond_bb)
+
+            self.builder.position_at_start(cond_bb)
+            index = self.builder.phi(lo.type, 'index')
+            index.add_incoming(lo, entry_bb)
+            self.builder.cbranch(self.builder.icmp_signed('<', index, hi), body_bb, after_bb)
+
+            self.builder.position_at_start(body_bb)
+            self.builder.store(self._counter_value(start, index, increment), counter)
+            if node.reduction:
+                value = self._codegen_as(node.body, reduced)
+                self.builder.store(
+                    self._reduce(node.reduction, self.builder.load(accumulator), value), accumulator)
+            else:
+                self._codegen(node.body)
+            index.add_incoming(self.builder.add(index, ir.Constant(lo.type, 1)), self.builder.block)
+            self.builder.branch(cond_bb)
+
+            self.builder.position_at_start(after_bb)
+            if node.reduction:
+                self.builder.store(self._to_slot(self.builder.load(accumulator)), partial)
+            self.builder.ret_void()
+        finally:
+            self.builder, self.func_symtab, self.profile_address = saved
+        return chunk
+
+    def _reduce(self, reduction, accumulator, value):
+        """Returns the reduction of an accumulated value and a new one. min
+        and max pick the new value when the language's '<' does."""
+        if not _is_float(value.type):
+            if reduction == '+':
+                return self.builder.add(accumulator, value, 'reduceop')
+            elif reduction == '*':
+                return self.builder.mul(accumulator, value, 'reduceop')
+            elif reduction == 'min':
+                less = self.builder.icmp_signed('<', value, accumulator)
+            else:
+                less = self.builder.icmp_signed('<', accumulator, value)
+            return self.builder.select(less, value, accumulator, 'reduceop')
+        flags = self.fastmath
+        if self.reassociate:
+            flags = fastmath_flags(flags + ('reassoc',))
+        if reduction == '+':
+            return self.builder.fadd(accumulator, value, 'reduceop', flags)
+        elif reduction == '*':
+            return self.builder.fmul(accumulator, value, 'reduceop', flags)
+        elif reduction == 'min':
+            less = self.builder.fcmp_unordered('<', value, accumulator, '', self.fastmath)
+        else:
+            less = self.builder.fcmp_unordered('<', accumulator, value, '', self.fastmath)
+        return self.builder.select(less, value, accumulator, 'reduceop', self.fastmath)
+
+    def _reduce_partials(self, reduction, partials, count, irtype):
+        """Reduce the first count values of the partials array, in order,
+        into a value of the given IR type."""
+        entry_bb = self.builder.block
+        cond_bb = ir.Block(self.builder.function, 'reducecond')
+        body_bb = ir.Block(self.builder.function, 'reducebody')
+        after_bb = ir.Block(self.builder.function, 'reduceafter')
+        self.builder.branch(cond_bb)
+
+        self.builder.function.basic_blocks.append(cond_bb)
+        self.builder.position_at_start(cond_bb)
+        index = self.builder.phi(count.type, 'index')
+        index.add_incoming(ir.Constant(count.type, 0), entry_bb)
+        accumulator = self.builder.phi(irtype, 'accumulator')
+        accumulator.add_incoming(_identity(reduction, irtype), entry_bb)
+        self.builder.cbranch(self.builder.icmp_signed('<', index, count), body_bb, after_bb)
+
+        self.builder.function.basic_blocks.append(body_bb)
+        self.builder.position_at_start(body_bb)
+        partial = self._from_slot(self.builder.load(self.builder.gep(partials, [irint(0), index])), irtype)
+        accumulator.add_incoming(self._reduce(reduction, accumulator, partial), body_bb)
+        index.add_incoming(self.builder.add(index, ir.Constant(count.type, 1)), body_bb)
+        self.builder.branch(cond_bb)
+
+        self.builder.function.basic_blocks.append(after_bb)
+        self.builder.position_at_start(after_bb)
+        return accumulator
 
     def _codegen_Call(self, node):
+        if self._is_length(node):
+            return self._array_length(self._codegen(node.args[0]))
         callee_func = self.module.globals.get(node.callee, None)
         if callee_func is None or not isinstance(callee_func, ir.Function):
             raise CodegenError('Call to unknown function', node.callee)
         if len(callee_func.args) != len(node.args):
             raise CodegenError('Call argument length mismatch', node.callee)
-        call_args = [self._codegen(arg) for arg in node.args]
+        call_args = self._call_args(callee_func, node.args)
         return self.builder.call(callee_func, call_args, 'calltmp')
 
 
     def _codegen_Prototype(self, node):
         funcname = node.name
         # Create a function type
-        functype = ir.FunctionType(ir.DoubleType(),
-                                  [ir.DoubleType()] * len(node.argnames))
+        functype = ir.FunctionType(IR_TYPES[node.return_type or DEFAULT_TYPE],
+                                  [IR_TYPES[type] for type in node.argtypes])
 
+        # Anonymous functions are thrown away once executed, so they are kept
+        # out of the module.
+        if node.is_anonymous():
+            func = ir.Function(ir.Module(), functype, funcname)
         # If a function with this name already exists in the module...
-        if funcname in self.module.globals:
+        elif funcname in self.module.globals:
             # We only allow the case in which a declaration exists and now the
             # function is defined (or redeclared) with the same number of args.
             func = existing_func = self.module.globals[funcname]
             if not isinstance(existing_func, ir.Function):
                 raise CodegenError('Function/Global name collision', funcname)
-            if not existing_func.is_declaration:
+            if not existing_func.is_declaration or funcname in self.prebuilt:
                 raise CodegenError('Redifinition of {0}'.format(funcname))
             if len(existing_func.function_type.args) != len(functype.args):
                 raise CodegenError(
                     'Redifinition with different number of arguments')
+            if existing_func.function_type != functype:
+                raise CodegenError('Redifinition with different types')
         else:
             # Otherwise create a new function
             func = ir.Function(self.module, functype, funcname)
-            # Name the arguments
+            # Name the arguments. The descriptors of the arrays are never
+            # written to, and so don't alias the memory written.
             for i, arg in enumerate(func.args):
                 arg.name = node.argnames[i]
+                if isinstance(arg.type, ir.PointerType):
+                    arg.add_attribute('noalias')
         
         return func
 
@@ -277,30 +1013,239 @@ class LLVMCodeGenerator(object):
         # Reset the symbol table. Prototype generation will pre-populate it with
         # function arguments.
         self.func_symtab = {}
+        self.types = {}
+        # An anonymous function returns the value of its body, in its type
+        if node.is_anonymous():
+            node.proto.return_type = _stored_type(self._type_of(node.body))
+        if node.memo:
+            self._check_memo(node)
         # Create the function skeleton from the prototype.
+        was_declared = node.proto.name in self.module.globals
         func = self._codegen(node.proto)
+        try:
+            self._codegen_FunctionBody(func, node)
+        except CodegenError:
+            # Leave the module as it was before this definition
+            if self.profile_address:
+                self.profiler.discard(func.name)
+            if node.memo and func.name in self.memo_tables.tables:
+                self.memo_tables.discard(func.name)
+            for outlined in self.outlined.pop(func.name, []):
+                if not node.is_anonymous():
+                    self.discard(outlined.name)
+            if was_declared:
+                del func.blocks[:]
+            elif not node.is_anonymous():
+                self.discard(func.name)
+            raise
+        if not node.is_anonymous() and is_pure(node.body, func.name, self._pure_callee):
+            self.pure.add(func.name)
+        # The variants of a memoized function wouldn't use its table
+        if self.simd_width and not node.is_anonymous() and not node.memo:
+            VariantGenerator(self.module, self.simd_width, self.prebuilt, self.fastmath).generate(node)
+        return func
+
+    def _codegen_FunctionBody(self, func, node):
+        self.function_name = func.name
         # Create the entry BB in the function and set a new builder to it.
         bb_entry = func.append_basic_block('entry')
         self.builder = ir.IRBuilder(bb_entry)
 
         # Add all arguments to the symbol table and create their allocas
         for i, arg in enumerate(func.args):
-            alloca = self._alloca(arg.name)
+            alloca = self._alloca(arg.name, arg.type)
             self.builder.store(arg, alloca)
             # We dont shadow existing variables names because there are no global variables...
             assert not self.func_symtab.get(arg.name) and "arg name redefined: " + arg.name
             self.func_symtab[arg.name] = alloca
 
+        # A result kept in the memo table is returned before anything else,
+        # the call not being profiled
+        if node.memo:
+            entry = self._memo_lookup(func, node)
+
+        self.profile_address = None
+        if self.profiler and not node.is_anonymous():
+            self.profile_address = self.profiler.address(func.name)
+            start = self._profile_entry()
+
         # Generate code for the body and then return the result
-        retval = self._codegen(node.body)
+        retval = self._codegen_as(node.body, type_name(func.function_type.return_type))
+        if self.profile_address:
+            self._profile_exit(start)
+        if node.memo:
+            self._memo_store(func, entry, retval)
         self.builder.ret(retval)
 
+    def is_pure(self, node, funcname = None):
+        """Whether an expression, of the function funcname if any, has no
+        side effects."""
+        return is_pure(node, funcname, self._pure_callee)
+
+    def _pure_callee(self, name):
+        """Whether calling a function has no side effects: it was generated
+        pure, here or where it was compiled, or is a pure extern."""
+        return name in self.pure or is_pure_extern(self.module, name, self.prebuilt)
+
+    def _check_memo(self, node):
+        """Raise CodegenError unless the function may be memoized."""
+        if self.memo_tables is None:
+            raise CodegenError('No memo table for {0}'.format(node.proto.name))
+        if node.proto.is_typed():
+            raise CodegenError('Only f64 functions can be memoized', node.proto.name)
+        if not is_pure(node.body, node.proto.name, self._pure_callee):
+            raise CodegenError('Only functions without side effects can be memoized', node.proto.name)
+
+    def _memo_hash(self, words):
+        """Returns the hash of i64 values, as memo.hash_words does."""
+        i64 = ir.IntType(64)
+        h = ir.Constant(i64, memo.HASH_SEED)
+        for word in words:
+            h = self.builder.mul(self.builder.xor(h, word), ir.Constant(i64, memo.HASH_MULTIPLIER))
+        return h
+
+    def _memo_check(self, keys, value):
+        return self.builder.or_(self._memo_hash(keys + [value]), ir.Constant(ir.IntType(64), 1))
+
+    def _memo_lookup(self, func, node):
+        """Return the result kept in the memo table for the arguments if
+        any. Returns the pointer to the entry of the arguments, whose bits
+        are the keys."""
+        i64 = ir.IntType(64)
+        address = self.memo_tables.address(func.name, len(func.args), node.memo)
+        table = self.memo_tables.tables[func.name]
+        words = ir.Constant(i64, address).inttoptr(i64.as_pointer())
+
+        keys = [self.builder.bitcast(arg, i64) for arg in func.args]
+        slot = ir.Constant(i64, 0)
+        if table.capacity > 1:
+            slot = self.builder.lshr(self._memo_hash(keys), ir.Constant(i64, table.shift))
+        start = self.builder.add(self.builder.mul(slot, ir.Constant(i64, table.entry_words)),
+            ir.Constant(i64, memo.HEADER_WORDS))
+        entry = self.builder.gep(words, [start], name='memo.entry')
+
+        def word(i):
+            return self.builder.gep(entry, [ir.Constant(i64, i)])
+        value = self.builder.load(word(len(keys) + 1), 'memo.value')
+        hit = self.builder.icmp_unsigned('==', self.builder.load(word(0)), self._memo_check(keys, value))
+        for i, key in enumerate(keys):
+            hit = self.builder.and_(hit, self.builder.icmp_unsigned('==', self.builder.load(word(i + 1)), key))
+
+        found = func.append_basic_block('memo.hit')
+        missing = func.append_basic_block('memo.miss')
+        self.builder.cbranch(hit, found, missing)
+        self.builder.position_at_end(found)
+        self._memo_count(words, 0)
+        self.builder.ret(self.builder.bitcast(value, ir.DoubleType()))
+        self.builder.position_at_end(missing)
+        self._memo_count(words, 1)
+        return entry
+
+    def _memo_count(self, words, i):
+        """Add 1 to the number of hits, or of misses."""
+        counter = self.builder.gep(words, [ir.Constant(ir.IntType(64), i)])
+        self.builder.store(self.builder.add(self.builder.load(counter), ir.Constant(ir.IntType(64), 1)), counter)
+
+    def _memo_store(self, func, entry, retval):
+        """Keep the result of the arguments in their entry, evicting the
+        one there. The check word comes last."""
+        i64 = ir.IntType(64)
+        keys = [self.builder.bitcast(arg, i64) for arg in func.args]
+        value = self.builder.bitcast(retval, i64)
+        for i, word in enumerate(keys + [value]):
+            self.builder.store(word, self.builder.gep(entry, [ir.Constant(i64, i + 1)]))
+        self.builder.store(self._memo_check(keys, value), self.builder.gep(entry, [ir.Constant(i64, 0)]))
+
+    def _profile_counter(self, field):
+        """Returns a pointer to a profiling counter of the current function."""
+        address = self.profile_address + getattr(ProfileCounters, field).offset
+        return ir.Constant(ir.IntType(64), address).inttoptr(ir.IntType(64).as_pointer())
+
+    def _profile_add(self, field, value):
+        """Add value to a profiling counter of the current function. Returns
+        the new counter value."""
+        counter = self._profile_counter(field)
+        total = self.builder.add(self.builder.load(counter), value)
+        self.builder.store(total, counter)
+        return total
+
+    def _read_cycle_counter(self):
+        functype = ir.FunctionType(ir.IntType(64), [])
+        return self.builder.call(
+            self.module.declare_intrinsic('llvm.readcyclecounter', fnty=functype), [])
+
+    def _profile_entry(self):
+        """Count a call, and return the cycle counter when reading it."""
+        one = ir.Constant(ir.IntType(64), 1)
+        self._profile_add('calls', one)
+        if self.profiler.cycles:
+            self._profile_add('depth', one)
+            return self._read_cycle_counter()
+
+    def _profile_exit(self, start):
+        """Count the cycles elapsed since start, unless returning to a
+        recursive call of the same function, which will count them."""
+        if not self.profiler.cycles:
+            return
+        zero = ir.Constant(ir.IntType(64), 0)
+        depth = self._profile_add('depth', ir.Constant(ir.IntType(64), -1))
+        elapsed = self.builder.sub(self._read_cycle_counter(), start)
+        outermost = self.builder.icmp_unsigned('==', depth, zero)
+        self._profile_add('cycles', self.builder.select(outermost, elapsed, zero))
+
+    def discard(self, funcname):
+        """Remove a function from the module."""
+        del self.module.globals[funcname]
+        self.module.scope._useset.discard(funcname)
+        self.prebuilt.discard(funcname)
+        self.pure.discard(funcname)
+
+    def retire(self, funcname):
+        """Take a function out of the module to define it again, along with
+        its SIMD variant and the functions outlined from it. Returns what
+        restore() needs to put them back."""
+        names = [funcname] + [outlined.name for outlined in self.outlined.get(funcname, [])]
+        if self.simd_width and simd_name(funcname, self.simd_width) in self.module.globals:
+            names.append(simd_name(funcname, self.simd_width))
+        retired = Retired([self.module.globals[name] for name in names],
+            self.outlined.pop(funcname, []), funcname in self.pure, funcname in self.prebuilt)
+        for name in names:
+            self.discard(name)
+        return retired
+
+    def restore(self, retired):
+        """Put back in the module a function taken out by retire(), in
+        place of any new definition of it."""
+        funcname = retired.functions[0].name
+        names = [funcname] + [outlined.name for outlined in self.outlined.pop(funcname, [])]
+        if self.simd_width:
+            names.append(simd_name(funcname, self.simd_width))
+        for name in names:
+            if name in self.module.globals:
+                self.discard(name)
+        for func in retired.functions:
+            self.module.scope.register(func.name)
+            self.module.add_global(func)
+        if retired.outlined:
+            self.outlined[funcname] = retired.outlined
+        if retired.pure:
+            self.pure.add(funcname)
+        if retired.prebuilt:
+            self.prebuilt.add(funcname)
+
+    def drop_body(self, funcname):
+        """Turn a defined function into a mere declaration, its code being
+        compiled elsewhere."""
+        del self.module.globals[funcname].blocks[:]
+        for outlined in self.outlined.pop(funcname, []):
+            self.discard(outlined.name)
+        self.prebuilt.add(funcname)
+
     def _codegen_Unary(self, node):
-        operand = self._codegen(node.rhs)
         func = self.module.get_global('unary{0}'.format(node.op))
         if not func:
             raise CodegenError("Undefined unary operator: " + node.op)
-        return self.builder.call(func, [operand], 'unop')
+        return self.builder.call(func, self._call_args(func, [node.rhs]), 'unop')
 
     def _codegen_VarIn(self, node):
         old_bindings = []
@@ -308,13 +1253,16 @@ class LLVMCodeGenerator(object):
         for name, init in node.vars:
             # Emit the initializer before adding the variable to scope. This
             # prevents the initializer from referencing the variable itself.
+            type = self._var_type(node, name, init, self._scope())
+            if init is None and is_array(type):
+                raise CodegenError('Array variable without a value: ' + name)
             if init is not None:
-                init_val = self._codegen(init)
+                init_val = self._codegen_as(init, type)
             else:
-                init_val = ir.Constant(ir.DoubleType(), 0.0)
+                init_val = ir.Constant(IR_TYPES[type], 0)
 
             # Create var on stack and initialize it.
-            var_addr = self._alloca(name)
+            var_addr = self._alloca(name, IR_TYPES[type])
             self.builder.store(init_val, var_addr)
 
             # Put var in symbol table; remember old bindings if any.
@@ -1,52 +1,326 @@
-from ctypes import CFUNCTYPE, c_double
+import os, re, threading
+from array import array
+from ctypes import CFUNCTYPE, POINTER, c_bool, c_double, c_float, c_int64, pointer
 from collections import namedtuple
+from contextlib import contextmanager
+from time import perf_counter
+from types import MappingProxyType
 import colorama ; colorama.init()
 from termcolor import colored, cprint
 from ast import *
+from ast import _ANONYMOUS
 from parsing import *
 from codegen import *
+from snapshot import *
+from profiler import Profiler
+from memo import MemoTables
+from resultcache import ResultCache, references, result_key
+from units import Unit, UnitCache, unit_imports, unit_key, interface
+from tiering import TieredCompiler, tier_name
+from interpreter import Interpreter
+import parallel
+import arrays
+from simd import simd_name, variant_width, batch_name, batch_IR, variant_type, host_width, host_target_machine
+import perfmap
 
 Result = namedtuple("Result", ['value', 'ast', 'rawIR', 'optIR'])
 
+# Timing of a toplevel expression: its value, the time spent compiling it, the
+# number of timed runs, and the minimum, median and 95th percentile of their
+# durations, all in seconds.
+Timing = namedtuple("Timing", ['value', 'compile_time', 'runs', 'min', 'median', 'p95'])
+
+# Memory held by a session: number of functions in the module, bytes of IR kept
+# for the functions not compacted yet, bytes of bitcode kept for the compacted
+# ones, bytes of JIT-compiled code, and bytes of Python heap when tracemalloc
+# is tracing (None otherwise).
+MemoryUsage = namedtuple("MemoryUsage", 
+    ['functions', 'ir_bytes', 'bitcode_bytes', 'jit_bytes', 'heap_bytes'])
+
+# Definition of a session function: its AST, with the fast-math flags and the
+# profiling it was compiled with, from which it is generated again when a
+# function it calls is redefined.
+Definition = namedtuple("Definition", ['ast', 'fastmath', 'profile'])
+
 def dump(str, filename):
     """Dump a string to a file name."""
     with open(filename, 'w') as file:
         file.write(str)
 
-def lastIR(module, index = -1):
-    """Returns the last bunch of code added to a module. 
-    Thus gets the lastly generated IR for the top-level expression"""
-    return str(module).split('\n\n')[index]
+def callees(func):
+    """Returns the names of the functions called by an IR function."""
+    return {instr.callee.name 
+        for block in func.blocks 
+            for instr in block.instructions 
+                if isinstance(instr, ir.CallInstr)}
+
+# A function defined again gets new symbols in the session engine, which keeps
+# the code of the previous definitions: the code of the second definition of f
+# is f.v2, and its SIMD variant, outlined loops, tier 0 code and batch driver
+# are f.v2.simd8, f.v2.parfor1, f.v2.tier0 and f.v2.batch.
+_SYMBOL_SUFFIX = re.compile(r'(simd\d+|parfor\d+|tier0|batch)$')
+
+def engine_symbol(name, versions):
+    """Returns the symbol of the code of a function in the session engine,
+    given the number of definitions of each name."""
+    base, dot, suffix = name.partition('.')
+    version = versions.get(base, 1)
+    if version < 2 or (dot and not _SYMBOL_SUFFIX.match(suffix)):
+        return name
+    return '{0}.v{1}{2}{3}'.format(base, version, dot, suffix)
+
+def function_name(symbol):
+    """Returns the name of the function whose code has the given symbol."""
+    return re.sub(r'^([^.]+)\.v\d+(?=\.|$)', r'\1', symbol)
+
+def declaration(func):
+    """Returns the IR declaration of a function, even of a defined one."""
+    functype = func.function_type
+    return 'declare {0} @"{1}"({2})'.format(
+        functype.return_type, func.name, ', '.join(str(arg) for arg in functype.args))
+
+_llvm_initialized = False
+
+# ctypes types of the values of each type
+CTYPES = {'f64': c_double, 'f32': c_float, 'i64': c_int64, 'bool': c_bool}
+CTYPES.update({arrays.array_type(element): POINTER(arrays.ArrayDescriptor)
+    for element in arrays.ELEMENT_TYPES})
+
+def signature(func):
+    """Returns the types of the result and of the arguments of an IR
+    function, or None when they are all f64, as FunctionInfo.types."""
+    functype = func.function_type
+    if variant_width(func.name) or functype == ir.FunctionType(
+            ir.DoubleType(), [ir.DoubleType()] * len(functype.args)):
+        return None
+    return [type_name(functype.return_type)] + [type_name(arg) for arg in functype.args]
+
+def initialize_llvm():
+    """Initialize LLVM and its native target, once per process."""
+    global _llvm_initialized
+    if not _llvm_initialized:
+        llvm.initialize()
+        llvm.initialize_native_target()
+        llvm.initialize_native_asmprinter()
+        # The parallel loops call their runtime through this symbol
+        llvm.add_symbol(parallel.RUNTIME, parallel.runtime().address)
+        # And the array accesses report the indexes out of bounds to this one
+        llvm.add_symbol(arrays.INDEX_ERROR, arrays.index_errors().address)
+        _llvm_initialized = True
+
+def create_pass_manager(opt_level = 2, inlining_threshold = None, target_machine = None):
+    """With a target machine, the optimizations know the vector registers
+    and instruction costs of the target, which the loop vectorizer needs."""
+    pmb = llvm.create_pass_manager_builder()
+    pmb.opt_level = opt_level
+    if inlining_threshold is not None:
+        pmb.inlining_threshold = inlining_threshold
+    pass_manager = llvm.create_module_pass_manager()
+    if target_machine:
+        target_machine.add_analysis_passes(pass_manager)
+        # The analysis refers to the machine
+        pass_manager.target_machine = target_machine
+    pmb.populate(pass_manager)
+    return pass_manager
+
+def add_builtins(module):
+    # The C++ tutorial adds putchard() simply by defining it in the host C++
+    # code, which is then accessible to the JIT. It doesn't work as simply
+    # for us; but luckily it's very easy to define new "C level" functions
+    # for our JITed code to use - just emit them as LLVM IR. This is what
+    # this function does.
+
+    # Add the declaration of putchar
+    putchar_ty = ir.FunctionType(ir.IntType(32), [ir.IntType(32)])
+    putchar = ir.Function(module, putchar_ty, 'putchar')
+
+    # Add putchard
+    putchard_ty = ir.FunctionType(ir.DoubleType(), [ir.DoubleType()])
+    putchard = ir.Function(module, putchard_ty, 'putchard')
+    irbuilder = ir.IRBuilder(putchard.append_basic_block('entry'))
+    ival = irbuilder.fptoui(putchard.args[0], ir.IntType(32), 'intcast')
+    irbuilder.call(putchar, [ival])
+    irbuilder.ret(ir.Constant(ir.DoubleType(), 0))
+
+def double_buffer(values):
+    """Returns a ctypes array of the doubles of values: over values itself
+    when it is a writable contiguous buffer of doubles, over a copy otherwise."""
+    try:
+        view = memoryview(values)
+    except TypeError:
+        view = None
+    if view is None or view.format != 'd' or view.readonly or not view.c_contiguous:
+        view = memoryview(array('d', values))
+    return (c_double * (view.nbytes // 8)).from_buffer(view)
+
+class SharedLibrary(object):
+    """Library of functions compiled once per process, with the builtins,
+    into an engine of its own. It is read only once loaded and shared by all
+    the evaluators using it: each of them only maps the library functions to
+    their code, and layers its own operators on top of the library ones.
+    """
+    _loaded = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def load(cls, filename, simd_width = None):
+        """Returns the library of the given file, compiling it the first time
+        it is needed, or when the file changed since. simd_width: width of
+        the SIMD variants of its pure functions, None for no variants."""
+        key = (os.path.abspath(filename), os.path.getmtime(filename), simd_width)
+        with cls._lock:
+            if key not in cls._loaded:
+                with open(filename) as file:
+                    cls._loaded[key] = cls(file.read(), simd_width)
+            return cls._loaded[key]
+
+    def __init__(self, codestr, simd_width = None):
+        initialize_llvm()
+        operators = operator_table()
+        codegen = LLVMCodeGenerator()
+        codegen.simd_width = simd_width
+        add_builtins(codegen.module)
+        self.builtin_names = frozenset(codegen.module.globals)
+        for ast in Parser(operators).parse_generator(codestr):
+            codegen.generate_code(ast)
+
+        llvmmod = llvm.parse_assembly(str(codegen.module))
+        llvmmod.verify()
+        create_pass_manager().run(llvmmod)
+        # Kept for the snapshots of the sessions using the library
+        self.bitcode = llvmmod.as_bitcode()
+
+        target_machine = host_target_machine(llvm.Target.from_default_triple())
+        self.engine = llvm.create_mcjit_compiler(llvmmod, target_machine)
+        buffers = []
+        self.engine.set_object_cache(lambda module, buffer: buffers.append(buffer))
+        self.engine.finalize_object()
+
+        # The builtin and intrinsic declarations are left out, as they are not
+        # double functions and the evaluators never call them.
+        self.functions = [
+            FunctionInfo(func.name, [arg.name for arg in func.args], func.is_declaration,
+                signature(func), func.name in codegen.pure)
+            for func in codegen.module.functions
+            if not (func.is_declaration and 
+                (func.name in self.builtin_names or func.name.startswith('llvm.')))
+            and not parallel.is_private(func.name)]
+        defined = [func for func in codegen.module.functions
+            if not (func.is_declaration or parallel.is_private(func.name))]
+        self.addresses = {func.name: self.engine.get_function_address(func.name) for func in defined}
+        # Name, address and size of each function, for the evaluators
+        # describing their code to perf
+        sizes = perfmap.function_sizes(buffers[0]) if buffers else {}
+        self.symbols = [(name, address, sizes.get(name, 0)) for name, address in self.addresses.items()]
+        self.declarations = '\n'.join(declaration(func) for func in defined)
+        self.operators = MappingProxyType(dict(operators))
 
 class KaleidoscopeEvaluator(object):
     """Evaluator for Kaleidoscope expressions.
     Once an object is created, calls to evaluate() add new expressions to the
-    module. Definitions (including externs) are only added into the IR - no
-    JIT compilation occurs. When a toplevel expression is evaluated, the whole
-    module is JITed and the result of the expression is returned.
+    module. Definitions (including externs) are only added into the IR, and
+    each defined function is JIT-compiled in its own small module the first
+    time a toplevel expression needs it. When a toplevel expression is
+    evaluated, only its own module is compiled and the result of the
+    expression is returned.
+    A function defined again replaces the previous definition: it is compiled
+    again along with the functions calling it, directly or not, the others
+    being left as they are.
     """
-    def __init__(self, basiclib_file = None):
-        llvm.initialize()
-        llvm.initialize_native_target()
-        llvm.initialize_native_asmprinter()
+    def __init__(self, basiclib_file = None, memory_budget = None, perf_map = False, jitdump = False,
+            tiered = False, hot_threshold = 1000, interpret = True, simd = False,
+            reassociate = False, fastmath = False, bounds_check = True, result_cache = 256,
+            unit_cache = None):
+        """memory_budget: bytes of IR the session may keep before the
+        functions already JIT-compiled get compacted. None means no limit.
+
+        perf_map, jitdump: describe each JIT-compiled function to the linux
+        perf tool, in /tmp/perf-<pid>.map and/or in a jitdump file of the
+        temporary directory. Either can also be given the path of the map
+        file, or the directory of the jitdump file.
+
+        tiered: compile functions with few optimizations first, and compile
+        them again with full ones, in the background, once called
+        hot_threshold times.
+
+        interpret: run the toplevel expressions estimated to be cheap with
+        an interpreter, calling the native code of the functions, instead of
+        JIT-compiling them.
+
+        simd: give the pure functions a variant computing as many values at
+        once as the vector registers of the host hold, which map() runs.
+        Generating the variants takes about as long as generating the
+        functions, so they are left out by default.
+
+        reassociate: let the '+' and '*' loop reductions add or multiply
+        their values in any order, so that they get vectorized. The results
+        may differ in their last bits.
+
+        fastmath: fast-math flags of the floating point instructions of the
+        functions defined, among codegen.FASTMATH_FLAGS: True for all of
+        them, or their names, comma separated or in a sequence. They let LLVM
+        compute faster, but differently, than IEEE arithmetic, and with the
+        nnan and ninf flags, the NaNs and infinities give undefined results.
+        Each evaluation can select other flags with its fastmath option.
+
+        bounds_check: check the indexes of the array elements accessed, an
+        index out of bounds loading 0 and storing nothing, and making call()
+        raise IndexError. Without the checks, such an index accesses any
+        memory.
+
+        result_cache: number of values of toplevel expressions without side
+        effects kept in self.results, so that evaluating them again computes
+        nothing. 0 keeps none.
+
+        unit_cache: directory keeping the compiled units of the files
+        imported, for the other processes. The units are kept in memory for
+        the process in any case.
+        """
+        initialize_llvm()
+        self.perf = []
+        if perf_map:
+            self.perf.append(perfmap.writer(perfmap.PerfMap, None if perf_map is True else perf_map))
+        if jitdump:
+            self.perf.append(perfmap.writer(perfmap.JitDump, None if jitdump is True else jitdump))
 
         self.basiclib_file = basiclib_file
+        self.memory_budget = memory_budget
         self.target = llvm.Target.from_default_triple()
+        self.pass_manager = create_pass_manager(target_machine=host_target_machine(self.target))
+        self.tiered = tiered
+        self.hot_threshold = hot_threshold
+        self.tiering = None
+        if tiered:
+            self.tier0_pass_manager = create_pass_manager(1)
+        self.interpreter = Interpreter() if interpret else None
+        self.simd_width = host_width() if simd else None
+        self.reassociate = reassociate
+        self.fastmath = fastmath_flags(fastmath)
+        self.bounds_check = bounds_check
+        self.result_cache = result_cache
+        self.unit_cache = UnitCache.shared(unit_cache)
+        # The batch drivers inline the variant they run
+        self.batch_pass_manager = create_pass_manager(2, 275)
+        # When a snapshot is loaded, it replaces the basic library
+        self.snapshot = None
+        self.library = None
+        self.engine = None
         self.reset()
 
     def reset(self, history = []):
-        self._reset_base();
-
-        if self.basiclib_file:
-            # Load basic language library
+        if self.basiclib_file and not self.snapshot:
+            # Load basic language library, compiled once for all the
+            # evaluators of the process
             try:
-                with open(self.basiclib_file) as file:
-                    for result in self.eval_generator(file.read()): pass
+                self.library = SharedLibrary.load(self.basiclib_file, self.simd_width)
             except (FileNotFoundError, ParseError, CodegenError) as err:
                 print(colored("Could not charge basic library:", 'red'), self.basiclib_file)
+                self.library = None
                 self._reset_base()
                 raise
 
+        self._reset_base();
+
         if history:       
             # Run history 
             try:
@@ -57,8 +331,542 @@ class KaleidoscopeEvaluator(object):
                 self._reset_base()
 
     def _reset_base(self):
+        if self.engine:
+            self._release_reported(self._reported)
+            self.engine.close()
+        # The execution engine keeping the compiled definitions of the session. 
+        # Each definition is handed to it as a module of its own.
+        self.engine = llvm.create_mcjit_compiler(
+            llvm.parse_assembly(''), host_target_machine(self.target))
+        self.jit_bytes = 0
+        self.engine.set_object_cache(self._notify_object)
+        if self.tiering:
+            self.tiering.close()
+        self.tiering = TieredCompiler(self.target, self.hot_threshold, reporters=self.perf,
+            symbol=self._symbol) if self.tiered else None
+        # Objects compiled and not yet described to perf, with the names of
+        # their functions, and the functions of the engine described to perf
+        self._jitted = []
+        self._reported = []
+        # IR of each function defined in the session, the functions it calls,
+        # and the names of the ones not handed to the engine yet.
+        self.function_ir = {}
+        self.ir_bytes = 0
+        self.callees = {}
+        self.uncompiled = set()
+        # Definition of each function defined in the session, and the module
+        # handed to the engine for each function or batch driver compiled
+        self.definitions = {}
+        self.modules = {}
+        # Bitcode of the compacted functions, whose IR was released
+        self.bitcode = {}
+        # Address and ctypes function of the functions called by the
+        # interpreted expressions, or by call()
+        self._natives = {}
+        # ctypes function of the batch driver of the functions given to map()
+        self._batches = {}
+
         self.codegen = LLVMCodeGenerator()
-        self._add_builtins(self.codegen.module)
+        self.codegen.simd_width = self.simd_width
+        self.codegen.reassociate = self.reassociate
+        self.codegen.fastmath = self.fastmath
+        self.codegen.bounds_check = self.bounds_check
+        # Counters of the functions defined while profiling
+        self.profiler = Profiler()
+        # Results kept by the memoized functions
+        self.memo = MemoTables()
+        self.codegen.memo_tables = self.memo
+        # Values of the toplevel expressions without side effects, and the
+        # version of each name defined
+        self.results = ResultCache(self.result_cache)
+        self.versions = {}
+        # Unit of each file imported, by absolute path
+        self.units = {}
+        # Functions compiled elsewhere defined in the session
+        self.shadowed = set()
+        # Precedence table of the operators usable in the session
+        self.operators = operator_table()
+        if self.library:
+            self._link_library(self.library)
+        else:
+            add_builtins(self.codegen.module)
+            self.builtin_names = set(self.codegen.module.globals)
+            for func in self.codegen.module.functions:
+                if not func.is_declaration:
+                    self._add_function(func)
+        if self.snapshot:
+            self._link_snapshot(self.snapshot)
+
+    def save_snapshot(self, filename):
+        """Save the compiled session so that load_snapshot() can restore it
+        later, possibly in another process, without any recompilation."""
+        if self.profiler.counters:
+            # Their code holds the address of their counters in this process
+            raise SnapshotError('Profiled functions cannot be saved: ' 
+                + ', '.join(sorted(self.profiler.counters)))
+        if self.memo.tables:
+            # So does the code of the memoized ones for their tables
+            raise SnapshotError('Memoized functions cannot be saved: '
+                + ', '.join(sorted(self.memo.tables)))
+        llvmmod = llvm.parse_assembly(str(self.codegen.module))
+        for prebuilt in [self.library, self.snapshot] + list(self.units.values()):
+            if prebuilt is None:
+                continue
+            module = llvm.parse_bitcode(prebuilt.bitcode)
+            # The code compiled elsewhere keeps calling its own functions
+            # defined again in the session, and their variants
+            for func in module.functions:
+                if func.name.partition('.')[0] in self.shadowed:
+                    func.name += '.shadowed'
+            llvmmod.link_in(module)
+        for bitcode in self.bitcode.values():
+            llvmmod.link_in(llvm.parse_bitcode(bitcode))
+        llvmmod.verify()
+        # Builtin functions stay private to the snapshot, they would otherwise
+        # collide with the ones of the restoring session, and so do the
+        # functions shadowed.
+        for func in llvmmod.functions:
+            if not func.is_declaration and (self._is_private(func.name)
+                    or func.name.endswith('.shadowed')):
+                func.linkage = 'internal'
+        self.pass_manager.run(llvmmod)
+
+        functions = [
+            FunctionInfo(
+                func.name, 
+                [arg.name for arg in func.args], 
+                func.is_declaration and func.name not in self.codegen.prebuilt,
+                signature(func),
+                func.name in self.codegen.pure)
+            for func in self.codegen.module.functions 
+            if not self._is_private(func.name)]
+
+        snapshot = Snapshot.from_module(
+            llvmmod, host_target_machine(self.target), functions, user_operators(self.operators))
+        snapshot.save(filename)
+        return snapshot
+
+    def load_snapshot(self, filename):
+        """Restore a session saved with save_snapshot(). 
+        The snapshot replaces the basic library until another one is loaded."""
+        self.snapshot = Snapshot.load(filename)
+        self.library = None
+        self.reset()
+        return self.snapshot
+
+    def _is_private(self, funcname):
+        return (funcname.startswith((_ANONYMOUS, 'llvm.')) 
+            or funcname in self.builtin_names or parallel.is_private(funcname))
+
+    def _declare_prebuilt(self, functions, codegen = None):
+        """Declare functions given as FunctionInfo, so that new code can call
+        them. The defined ones are compiled elsewhere, the pure ones being
+        recorded as such. A function already defined, or declared with
+        another type, is an error and leaves the module as it was."""
+        codegen = codegen or self.codegen
+        declared = []
+        for info in functions:
+            width = variant_width(info.name)
+            if width:
+                functype = variant_type(len(info.argnames) - 1, width)
+            elif info.types:
+                functype = ir.FunctionType(IR_TYPES[info.types[0]], [IR_TYPES[type] for type in info.types[1:]])
+            else:
+                functype = ir.FunctionType(ir.DoubleType(), [ir.DoubleType()] * len(info.argnames))
+            existing = codegen.module.globals.get(info.name)
+            if existing is not None:
+                if not existing.is_declaration or existing.name in codegen.prebuilt \
+                        or existing.function_type != functype:
+                    if info.is_declaration and existing.function_type == functype:
+                        continue
+                    raise CodegenError('Redifinition of {0}'.format(info.name))
+            declared.append((info, functype, existing))
+        for info, functype, existing in declared:
+            if existing is None:
+                func = ir.Function(codegen.module, functype, info.name)
+                for arg, argname in zip(func.args, info.argnames):
+                    arg.name = argname
+            if not info.is_declaration:
+                codegen.prebuilt.add(info.name)
+                if info.pure:
+                    codegen.pure.add(info.name)
+
+    def _link_library(self, library):
+        """Declare the library functions and map them to the library code."""
+        self._declare_prebuilt(library.functions)
+        self.builtin_names = set(library.builtin_names)
+        self.operators = operator_table(library.operators)
+        llvmmod = llvm.parse_assembly(library.declarations)
+        self.engine.add_module(llvmmod)
+        for func in llvmmod.functions:
+            self.engine.add_global_mapping(func, library.addresses[func.name])
+        for reporter in self.perf:
+            for symbol in library.symbols:
+                reporter.report(*symbol)
+
+    def _link_snapshot(self, snapshot):
+        """Declare the snapshot functions so that new code can call them, hand
+        the snapshot code to the engine, and restore the operator precedences
+        needed to parse new code."""
+        self._declare_prebuilt(snapshot.functions)
+
+        for op, info in snapshot.operators.items():
+            set_binop_info(op, *info, self.operators)
+        self._add_prebuilt(snapshot)
+
+    def _add_prebuilt(self, snapshot):
+        """Hand the code of a snapshot, or of a unit, to the engine."""
+        if snapshot.native_compatible():
+            self.engine.add_object_file(llvm.ObjectFileRef.from_data(snapshot.objcode))
+            self.jit_bytes += len(snapshot.objcode)
+            if self.perf:
+                self._jitted.append((snapshot.objcode, 
+                    [info.name for info in snapshot.functions if not info.is_declaration]))
+        else:
+            self.engine.add_module(llvm.parse_bitcode(snapshot.bitcode))
+
+    def _import(self, filename, directory = '', importing = ()):
+        """Link the unit of a file to the session, along with the units it
+        imports, and returns it. A unit is taken from the unit cache, or
+        compiled and put there when its key is not found."""
+        path = os.path.abspath(os.path.join(directory, filename))
+        if path in importing:
+            raise CodegenError('Import cycle', path)
+        try:
+            with open(path) as file:
+                source = file.read()
+        except OSError as e:
+            raise CodegenError('Cannot import: ' + (e.strerror or str(e)), path)
+        except UnicodeDecodeError:
+            raise CodegenError('Cannot import: not a text file', path)
+        imports = [self._import(name, os.path.dirname(path), importing + (path,))
+            for name in unit_imports(source)]
+        key = unit_key(source, [unit.interface for unit in imports], self._unit_options())
+        linked = self.units.get(path)
+        if linked:
+            if linked.key != key:
+                # Its functions already have code in the engine
+                raise CodegenError('Imported file changed, reset to import it again', path)
+            return linked
+        unit = self.unit_cache.get(key)
+        if unit is None:
+            unit = self._compile_unit(path, key, source, imports)
+            self.unit_cache.put(unit)
+        self._link_unit(unit)
+        self.units[path] = unit
+        return unit
+
+    def _unit_options(self):
+        """Returns the options of the session changing the code of the
+        units, with the interface of the basic library."""
+        library = self.library and interface(self.library.functions, self.library.operators)
+        return (self.simd_width, self.reassociate, self.fastmath, self.bounds_check, library)
+
+    def _compile_unit(self, path, key, source, imports):
+        """Compile the source of a file into a unit. The functions of the
+        basic library and of the units imported are merely declared."""
+        codegen = LLVMCodeGenerator()
+        codegen.simd_width = self.simd_width
+        codegen.reassociate = self.reassociate
+        codegen.fastmath = self.fastmath
+        codegen.bounds_check = self.bounds_check
+        if self.library:
+            builtin_names = self.library.builtin_names
+            operators = operator_table(self.library.operators)
+            self._declare_prebuilt(self.library.functions, codegen)
+        else:
+            # The unit gets builtins of its own
+            add_builtins(codegen.module)
+            builtin_names = frozenset(codegen.module.globals)
+            operators = operator_table()
+        for unit in imports:
+            self._declare_prebuilt(unit.functions, codegen)
+            for op, info in unit.operators.items():
+                set_binop_info(op, *info, operators)
+        imported = dict(operators.maps[0])
+        for ast in Parser(operators).parse_generator(source):
+            if isinstance(ast, Import):
+                continue
+            if isinstance(ast, Function) and ast.is_anonymous():
+                raise CodegenError('Toplevel expression in an imported file', path)
+            codegen.generate_code(ast)
+
+        llvmmod = llvm.parse_assembly(str(codegen.module))
+        llvmmod.verify()
+        for func in llvmmod.functions:
+            if not func.is_declaration and (
+                    func.name in builtin_names or parallel.is_private(func.name)):
+                func.linkage = 'internal'
+        self.pass_manager.run(llvmmod)
+        functions = [
+            FunctionInfo(func.name, [arg.name for arg in func.args], func.is_declaration,
+                signature(func), func.name in codegen.pure)
+            for func in codegen.module.functions
+            if not (func.name in codegen.prebuilt or func.name in builtin_names
+                or func.name.startswith('llvm.') or parallel.is_private(func.name))]
+        exported = {op: info for op, info in operators.maps[0].items()
+            if imported.get(op) != info}
+        return Unit.from_module(path, key, llvmmod, host_target_machine(self.target),
+            functions, exported)
+
+    def _link_unit(self, unit):
+        """Declare the unit functions so that new code can call them, and
+        hand the unit code to the engine."""
+        for info in unit.functions:
+            if not info.is_declaration and info.name in self.definitions:
+                raise CodegenError('Redifinition of {0}'.format(info.name))
+        self._declare_prebuilt(unit.functions)
+        self._add_prebuilt(unit)
+
+    def _add_function(self, func):
+        """Register a newly defined IR function for a later compilation. 
+        Its IR is rendered once and for all here, along with the functions
+        outlined from its parallel loops."""
+        outlined = self.codegen.outlined.get(func.name, [])
+        self.function_ir[func.name] = '\n'.join(str(f) for f in [func] + outlined)
+        self.ir_bytes += len(self.function_ir[func.name])
+        self.callees[func.name] = callees(func).union(*map(callees, outlined)) \
+            - {f.name for f in outlined}
+        self.uncompiled.add(func.name)
+
+    def _add_definition(self, func):
+        """Register a newly defined IR function, along with its SIMD variant
+        if it got one."""
+        self._add_function(func)
+        variant = self.simd_width and self.codegen.module.globals.get(
+            simd_name(func.name, self.simd_width))
+        if variant and variant.name not in self.function_ir:
+            self._add_function(variant)
+
+    def _shadows(self, funcname):
+        """Whether defining a function shadows one compiled elsewhere: in
+        the basic library, a snapshot or an imported unit. Its builtins
+        cannot be defined again."""
+        return funcname in self.codegen.prebuilt and funcname not in self.definitions \
+            and funcname not in self.builtin_names
+
+    def _redefine(self, ast):
+        """Generate a session function defined again, and generate again
+        the functions calling it, directly or not, from their definitions.
+        Returns the new IR function, which is registered by the caller. If
+        any of them fails, the previous definitions are left in place.
+        A function compiled elsewhere is shadowed the same way, but the code
+        compiled along with it keeps calling it."""
+        funcname = ast.proto.name
+        shadowed = self._shadows(funcname)
+        dependents = self._dependents(funcname)
+        options = self.codegen.fastmath, self.codegen.profiler
+        # The new code gets new tables and counters, the old ones being kept
+        # for the old code until the new one replaces it
+        tables, counters = dict(self.memo.tables), dict(self.profiler.counters)
+        retired = []
+        regenerated = []
+        try:
+            for name in [funcname] + dependents:
+                retired.append(self.codegen.retire(name))
+                self.memo.tables.pop(name, None)
+                self.profiler.counters.pop(name, None)
+                if name == funcname:
+                    func = self.codegen.generate_code(ast)
+                    continue
+                definition = self.definitions[name]
+                self.codegen.fastmath = definition.fastmath
+                self.codegen.profiler = self.profiler if definition.profile else None
+                regenerated.append(self.codegen.generate_code(definition.ast))
+        except CodegenError:
+            for previous in reversed(retired):
+                self.codegen.restore(previous)
+            self.memo.tables.clear()
+            self.memo.tables.update(tables)
+            self.profiler.counters.clear()
+            self.profiler.counters.update(counters)
+            raise
+        finally:
+            self.codegen.fastmath, self.codegen.profiler = options
+        if shadowed:
+            # Its symbol stays the one of the code compiled elsewhere: the
+            # new definition is the second one
+            self.shadowed.add(funcname)
+            self._defined(funcname)
+        for name in [funcname] + dependents:
+            self._forget(name)
+        for dependent in regenerated:
+            self._add_definition(dependent)
+            self._defined(dependent.name)
+        return func
+
+    def _forget(self, funcname):
+        """Drop the IR, the compiled code and the natives of a function
+        defined again, of its SIMD variant and of its batch driver."""
+        names = [funcname, batch_name(funcname)]
+        if self.simd_width:
+            names.append(simd_name(funcname, self.simd_width))
+        for name in names:
+            llvmmod = self.modules.pop(name, None)
+            if llvmmod is not None:
+                self.engine.remove_module(llvmmod)
+            if name in self.function_ir:
+                self.ir_bytes -= len(self.function_ir.pop(name))
+            self.callees.pop(name, None)
+            self.bitcode.pop(name, None)
+            self.uncompiled.discard(name)
+            self._natives.pop(name, None)
+        self._batches.pop(funcname, None)
+        if self.tiering:
+            self.tiering.reset(funcname)
+
+    def _discard_function(self, funcname):
+        """Forget an anonymous function once executed."""
+        self.ir_bytes -= len(self.function_ir.pop(funcname))
+        del self.callees[funcname]
+        self.codegen.outlined.pop(funcname, None)
+        self.uncompiled.discard(funcname)
+
+    def _notify_object(self, module, buffer):
+        self.jit_bytes += len(buffer)
+        self._notify_jitted(module, buffer)
+
+    def _notify_jitted(self, module, buffer):
+        if self.perf:
+            self._jitted.append(
+                (buffer, [func.name for func in module.functions if not func.is_declaration]))
+
+    def _report_jitted(self, engine):
+        """Describe to perf the functions compiled since the last call, now
+        that engine has placed them in memory. Returns their names and
+        addresses."""
+        reported = []
+        for buffer, names in self._jitted:
+            sizes = perfmap.function_sizes(buffer)
+            for name in names:
+                address = engine.get_function_address(name)
+                if address:
+                    reported.append((name, address))
+                    for reporter in self.perf:
+                        reporter.report(name, address, sizes.get(name, 0))
+        self._jitted = []
+        return reported
+
+    def _release_reported(self, reported):
+        """Tell perf the code of the given functions was freed."""
+        for reporter in self.perf:
+            for name, address in reported:
+                reporter.release(name, address)
+
+    def memory_usage(self):
+        """Returns the MemoryUsage of the session."""
+        import tracemalloc
+        return MemoryUsage(
+            len(self.codegen.module.globals),
+            self.ir_bytes,
+            sum(len(bitcode) for bitcode in self.bitcode.values()),
+            self.jit_bytes,
+            tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None)
+
+    def compact(self):
+        """Release the IR of the functions already JIT-compiled. Only their
+        bitcode is kept, for snapshots."""
+        for funcname in list(self.function_ir):
+            if funcname in self.uncompiled or funcname in self.builtin_names:
+                continue
+            self.bitcode[funcname] = llvm.parse_assembly(self._unit_IR(funcname, False)).as_bitcode()
+            self.ir_bytes -= len(self.function_ir.pop(funcname))
+            self.codegen.drop_body(funcname)
+
+    def _dependencies(self, funcname):
+        """Returns the names of the session functions transitively called by
+        the given function."""
+        found = []
+        seen = {funcname}
+        todo = [funcname]
+        while todo:
+            for callee in self.callees[todo.pop()]:
+                if callee not in seen and callee in self.callees:
+                    found.append(callee)
+                    todo.append(callee)
+                seen.add(callee)
+        return found
+
+    def _dependents(self, funcname):
+        """Returns the names of the functions defined in the session which
+        call the given function, directly or not, in order of definition."""
+        return [name for name in self.definitions if name != funcname
+            and any(funcname in self.callees[caller] for caller in [name] + self._dependencies(name))]
+
+    def _unit_IR(self, funcname, tiered = True):
+        """Returns the IR of a module holding only the given function, the
+        functions it calls being merely declared.
+        With tiered compilation, unless tiered is False, the session functions
+        called are reached through their stubs instead, and a named function
+        gets the symbol of its tier 0 code. The SIMD variants are not tiered."""
+        globals = self.codegen.module.globals
+        tiering = self.tiering if tiered and not variant_width(funcname) else None
+        lines = []
+        for name in sorted(self.callees[funcname]):
+            if tiering and name in self.callees:
+                lines.append(tiering.stub(name, globals[name].function_type))
+            elif name != funcname:
+                lines.append(declaration(globals[name]))
+        body = self.function_ir[funcname]
+        if tiering and not funcname.startswith(_ANONYMOUS):
+            body = body.replace(
+                '@"{0}"('.format(funcname), '@"{0}"('.format(tier_name(funcname, 0)), 1)
+        lines.append(body)
+        return '\n'.join(lines)
+
+    def _unit_module(self, funcname, optimize, llvmdump=False):
+        """Returns the llvm module of a single function, verified and
+        optimized if requested."""
+        unitIR = self._unit_IR(funcname)
+        if llvmdump: 
+            dump(unitIR, '__dump__unoptimized.ll')
+
+        # Convert LLVM IR into in-memory representation and verify the code
+        llvmmod = llvm.parse_assembly(unitIR)
+        llvmmod.verify()
+        self._link_symbols(llvmmod)
+
+        # Optimize the module
+        if optimize:
+            if self.tiering:
+                self.tier0_pass_manager.run(llvmmod)
+            else:
+                self.pass_manager.run(llvmmod)
+            if llvmdump:
+                dump(str(llvmmod), '__dump__optimized.ll')
+
+        return llvmmod
+
+    def _symbol(self, name):
+        """Returns the symbol of the code of a function in the engine."""
+        return engine_symbol(name, self.versions)
+
+    def _link_symbols(self, llvmmod):
+        """Rename the functions of a module handed to the engine, defined
+        or called, to their symbols."""
+        for func in llvmmod.functions:
+            symbol = self._symbol(func.name)
+            if symbol != func.name:
+                func.name = symbol
+
+    def _compile_dependencies(self, funcname, optimize=True):
+        """Hand to the engine the not yet compiled session functions called
+        by the given function."""
+        for name in self._dependencies(funcname):
+            if name in self.uncompiled:
+                self._compile(name, optimize)
+
+    def _compile(self, funcname, optimize=True, llvmdump=False):
+        """Hand a session function to the engine. Returns its module."""
+        llvmmod = self._unit_module(funcname, optimize, llvmdump)
+        self.engine.add_module(llvmmod)
+        self.modules[funcname] = llvmmod
+        self.uncompiled.discard(funcname)
+        if self.tiering and not variant_width(funcname):
+            dependencies = self._dependencies(funcname)
+            self.tiering.compiled(funcname, self._unit_IR(funcname, False), dependencies,
+                [name for name in self.callees[funcname] if name in self.codegen.prebuilt])
+        return llvmmod
 
     def evaluate(self, codestr, options = dict()):
         """Evaluates only the first top level expression in codestr.
@@ -71,10 +879,11 @@ class KaleidoscopeEvaluator(object):
         Yield a namedtuple Result with None for definitions and externs, and the evaluated expression
         value for toplevel expressions.
         """
-        for ast in Parser().parse_generator(codestr):
+        for ast in Parser(self.operators).parse_generator(codestr):
             yield self._eval_ast(ast, **options)
 
-    def _eval_ast(self, ast, optimize=True, llvmdump=False, noexec = False, parseonly = False, verbose = False):
+    def _eval_ast(self, ast, optimize=True, llvmdump=False, noexec = False, parseonly = False, verbose = False, profile = False,
+            fastmath = None):
         """ 
         Evaluate a single top level expression given in ast form
         
@@ -87,6 +896,12 @@ class KaleidoscopeEvaluator(object):
             parseonly: the code will only be parsed. Yields an AST dump.
 
             verbose: yields a quadruplet tuple: result, AST, non-optimized IR, optimized IR
+
+            profile: the functions defined are instrumented to count their calls,
+            loop iterations and cycles in self.profiler.
+
+            fastmath: fast-math flags of the generated code, as given to the
+            constructor, which gives them when None.
         
         """
         rawIR = None
@@ -94,79 +909,318 @@ class KaleidoscopeEvaluator(object):
         if parseonly:
             return Result(ast.dump(), ast, rawIR, optIR)
 
+        # An imported file gives its functions, and the operators it defines
+        if isinstance(ast, Import):
+            unit = self._import(ast.path)
+            for op, info in unit.operators.items():
+                set_binop_info(op, *info, self.operators)
+            return Result(None, ast, rawIR, optIR)
+
+        # The values of the toplevel expressions without side effects are
+        # kept, and computed once
+        cached = None
+        if isinstance(ast, Function) and ast.is_anonymous() \
+                and not (noexec or verbose or llvmdump or profile) \
+                and self.codegen.is_pure(ast.body):
+            key, dependencies = self._result_key(ast, fastmath)
+            value = self.results.get(key)
+            if value is not None:
+                return Result(value, ast, rawIR, optIR)
+            cached = key, dependencies
+
+        # Cheap toplevel expressions are interpreted rather than JIT-compiled
+        if self.interpreter and isinstance(ast, Function) and ast.is_anonymous() \
+                and not (noexec or verbose or llvmdump):
+            closure = self.interpreter.compile(
+                ast.body, lambda name: self._native_function(name, optimize))
+            if closure:
+                result = Result(closure(), ast, rawIR, optIR)
+                self._keep_budget()
+                if cached:
+                    self.results.put(cached[0], result.value, cached[1])
+                return result
+
         # Generate code
-        self.codegen.generate_code(ast)
+        self.codegen.profiler = self.profiler if profile else None
+        self.codegen.fastmath = self.fastmath if fastmath is None else fastmath_flags(fastmath)
+        if isinstance(ast, Function) and (ast.proto.name in self.definitions
+                or self._shadows(ast.proto.name)):
+            func = self._redefine(ast)
+        else:
+            func = self.codegen.generate_code(ast)
+        if isinstance(ast, Function):
+            if not ast.is_anonymous():
+                self.definitions[func.name] = Definition(ast, self.codegen.fastmath, profile)
+                self._defined(func.name)
+            self._add_definition(func)
         if noexec or verbose:
-            rawIR = lastIR(self.codegen.module)
+            # Only the new function is rendered, whatever the module size
+            rawIR = self.function_ir.get(func.name) or str(func)
 
         if noexec:
+            if isinstance(ast, Function) and ast.is_anonymous():
+                self._discard_function(func.name)
             return Result(rawIR, ast, rawIR, optIR)
 
-        if llvmdump: 
-            dump(str(self.codegen.module), '__dump__unoptimized.ll')
-
-        # If we're evaluating a definition or extern declaration, don't do
-        # anything else. If we're evaluating an anonymous wrapper for a toplevel
-        # expression, JIT-compile the module and run the function to get its
+        # If we're evaluating an extern declaration, don't do anything else.
+        # Definitions are only compiled once needed, unless verbose.
+        # If we're evaluating an anonymous wrapper for a toplevel
+        # expression, JIT-compile its module and run the function to get its
         # result.
-        def_or_extern = not (isinstance(ast, Function) and ast.is_anonymous())
-        if def_or_extern and not verbose:
+        if isinstance(ast, Prototype):
             return Result(None, ast, rawIR, optIR)
 
-        # Convert LLVM IR into in-memory representation and verify the code
-        llvmmod = llvm.parse_assembly(str(self.codegen.module))
-        llvmmod.verify()
-
-        # Optimize the module
-        if optimize:
-            pmb = llvm.create_pass_manager_builder()
-            pmb.opt_level = 2
-            pm = llvm.create_module_pass_manager()
-            pmb.populate(pm)
-            pm.run(llvmmod)
-
-            if llvmdump:
-                dump(str(llvmmod), '__dump__optimized.ll')
+        if not ast.is_anonymous():
+            if verbose or llvmdump:
+                llvmmod = self._compile(func.name, optimize, llvmdump)
+                symbol = self._symbol(tier_name(func.name, 0) if self.tiering else func.name)
+                optIR = str(llvmmod.get_function(symbol)) if verbose else None
+            return Result(None, ast, rawIR, optIR)
 
+        llvmmod = self._expression_module(func.name, optimize, llvmdump)
+        self._keep_budget()
         if verbose:
-            optIR = lastIR(llvmmod, -2)
-            if def_or_extern:
-                return Result(None, ast, rawIR, optIR)
+            optIR = str(llvmmod.get_function(func.name))
 
         # Create a MCJIT execution engine to JIT-compile the module. Note that
         # ee takes ownership of target_machine, so it has to be recreated anew
-        # each time we call create_mcjit_compiler.
-        target_machine = self.target.create_target_machine()
-        with llvm.create_mcjit_compiler(llvmmod, target_machine) as ee:
-            ee.finalize_object()
-
+        # each time we call create_mcjit_compiler. The engine, and thus the
+        # machine code of the expression, is released once it has run.
+        target_machine = host_target_machine(self.target)
+        with self._expression_engine(llvmmod, target_machine) as ee:
             if llvmdump:
                 dump(target_machine.emit_assembly(llvmmod), '__dump__assembler.asm')
                 print(colored("Code dumped in local directory", 'yellow'))
 
-            fptr = CFUNCTYPE(c_double)(ee.get_function_address(ast.proto.name))
+            fptr = CFUNCTYPE(CTYPES[ast.proto.return_type])(ee.get_function_address(ast.proto.name))
 
             result = fptr()
+            if cached:
+                self.results.put(cached[0], result, cached[1])
             return Result(result, ast, rawIR, optIR) 
 
-    def _add_builtins(self, module):
-        # The C++ tutorial adds putchard() simply by defining it in the host C++
-        # code, which is then accessible to the JIT. It doesn't work as simply
-        # for us; but luckily it's very easy to define new "C level" functions
-        # for our JITed code to use - just emit them as LLVM IR. This is what
-        # this method does.
+    def _result_key(self, ast, fastmath = None):
+        """Returns the key of the value of a toplevel expression in the
+        result cache, and the names of the session functions it calls,
+        directly or not."""
+        dependencies = references(ast.body)
+        for name in list(dependencies):
+            if name in self.callees:
+                dependencies.update(self._dependencies(name))
+        versions = [(name, self.versions.get(name, 0)) for name in dependencies]
+        flags = self.fastmath if fastmath is None else fastmath_flags(fastmath)
+        return result_key(ast.body, versions, flags), dependencies
 
-        # Add the declaration of putchar
-        putchar_ty = ir.FunctionType(ir.IntType(32), [ir.IntType(32)])
-        putchar = ir.Function(module, putchar_ty, 'putchar')
+    def _defined(self, funcname):
+        """Note a new definition of a function, whose callers' values are
+        no longer valid."""
+        self.versions[funcname] = self.versions.get(funcname, 0) + 1
+        self.results.invalidate(funcname)
 
-        # Add putchard
-        putchard_ty = ir.FunctionType(ir.DoubleType(), [ir.DoubleType()])
-        putchard = ir.Function(module, putchard_ty, 'putchard')
-        irbuilder = ir.IRBuilder(putchard.append_basic_block('entry'))
-        ival = irbuilder.fptoui(putchard.args[0], ir.IntType(32), 'intcast')
-        irbuilder.call(putchar, [ival])
-        irbuilder.ret(ir.Constant(ir.DoubleType(), 0))
+    def _expression_module(self, funcname, optimize=True, llvmdump=False):
+        """Returns the llvm module of a toplevel expression, once the session
+        functions it needs are compiled. The expression is forgotten by the
+        session."""
+        try:
+            self._compile_dependencies(funcname, optimize)
+            self._finalize()
+            return self._unit_module(funcname, optimize, llvmdump)
+        finally:
+            self._discard_function(funcname)
+
+    def _keep_budget(self):
+        if self.memory_budget is not None and self.ir_bytes > self.memory_budget:
+            self.compact()
+
+    def _finalize(self):
+        """Have the engine place in memory the functions handed to it."""
+        self.engine.finalize_object()
+        self._reported.extend(self._report_jitted(self.engine))
+        if self.tiering:
+            self.tiering.link(self.engine)
+
+    def _native_function(self, name, optimize=True, typed=False):
+        """Returns a ctypes function running the native code of a function,
+        compiling first the session functions it needs. Returns None for an
+        unknown function, one merely declared, or unless typed, one not
+        computing on doubles only."""
+        native = self._natives.get(name)
+        if native and not self.tiering:
+            # The code stays where it is until the function is redefined,
+            # which drops its native
+            return native[1]
+        func = self.codegen.module.globals.get(name)
+        if not isinstance(func, ir.Function) or (signature(func) and not typed):
+            return None
+        if name in self.callees:
+            for dep in [name] + self._dependencies(name):
+                if dep in self.uncompiled:
+                    self._compile(dep, optimize)
+        elif name not in self.codegen.prebuilt:
+            return None
+        # The engine may also hold code not placed in memory yet, a snapshot's
+        self._finalize()
+        if self.tiering and name in self.callees:
+            address = self.tiering.tiers[name].slot.code
+        else:
+            address = self.engine.get_function_address(self._symbol(name))
+        if not address:
+            return None
+        if native is None or native[0] != address:
+            types = signature(func) or [DEFAULT_TYPE] * (len(func.args) + 1)
+            functype = CFUNCTYPE(*[CTYPES[type] for type in types])
+            native = self._natives[name] = (address, functype(address))
+        return native[1]
+
+    def call(self, funcname, *args):
+        """Calls a function with Python values, numbers for its numeric
+        parameters, and for its arrays, buffers of their element type: NumPy
+        arrays, bytearray, memoryview or array.array for instance, which the
+        function reads and writes in place. Returns its result."""
+        func = self.codegen.module.globals.get(funcname)
+        if not isinstance(func, ir.Function):
+            raise CodegenError('Call to unknown function', funcname)
+        if len(func.args) != len(args):
+            raise CodegenError('Call argument length mismatch', funcname)
+        types = signature(func) or [DEFAULT_TYPE] * (len(args) + 1)
+        if arrays.is_array(types[0]):
+            raise CodegenError('An array cannot be returned to Python', funcname)
+        values, buffers = [], []
+        for arg, type in zip(args, types[1:]):
+            if arrays.is_array(type):
+                descriptor, memory = arrays.descriptor(arg, type)
+                buffers.append(memory)
+                values.append(pointer(descriptor))
+            else:
+                values.append(int(arg) if type == 'i64' else float(arg))
+        native = self._native_function(funcname, typed=True)
+        if native is None:
+            raise CodegenError('Call to unknown function', funcname)
+        with arrays.index_errors().collect():
+            return native(*values)
+
+    def map(self, funcname, *args):
+        """Returns the array('d') of the values of a function for the elements
+        of arrays of arguments: map('f', xs, ys)[i] is f(xs[i], ys[i]). A
+        number stands for an array repeating it. The arrays are buffers of
+        doubles, array('d') or NumPy arrays for instance, read in place, or
+        sequences of numbers. A pure function runs through its SIMD variant,
+        on several elements at once."""
+        func = self.codegen.module.globals.get(funcname)
+        if not isinstance(func, ir.Function) or func.function_type != ir.FunctionType(
+                ir.DoubleType(), [ir.DoubleType()] * len(func.args)):
+            raise CodegenError('Call to unknown function', funcname)
+        if len(func.args) != len(args):
+            raise CodegenError('Call argument length mismatch', funcname)
+        arrays = [None if isinstance(arg, (int, float)) else double_buffer(arg) for arg in args]
+        lengths = {len(buffer) for buffer in arrays if buffer is not None}
+        if len(lengths) > 1:
+            raise ValueError('Arrays of different lengths: ' + ', '.join(map(str, sorted(lengths))))
+        n = lengths.pop() if lengths else 1
+        arrays = [double_buffer(array('d', [arg]) * n) if buffer is None else buffer
+            for arg, buffer in zip(args, arrays)]
+        values = array('d', bytes(8 * n))
+        self._batch_function(funcname)(double_buffer(values), n, *arrays)
+        return values
+
+    def _batch_function(self, funcname, optimize=True):
+        """Returns the ctypes function of the driver running a function over
+        arrays, compiling it and the session functions it needs first."""
+        batch = self._batches.get(funcname)
+        if batch:
+            return batch
+        func = self.codegen.module.globals[funcname]
+        variant = self.simd_width and self.codegen.module.globals.get(
+            simd_name(funcname, self.simd_width))
+        callee = variant or func
+        if callee.name in self.callees:
+            for dep in [callee.name] + self._dependencies(callee.name):
+                if dep in self.uncompiled:
+                    self._compile(dep, optimize)
+        elif callee.name not in self.codegen.prebuilt and not llvm.address_of_symbol(funcname):
+            # Merely declared, and not a function of the process either
+            raise CodegenError('Call to unknown function', funcname)
+        if self.tiering and callee.name in self.callees and not variant:
+            head = self.tiering.stub(funcname, func.function_type)
+        elif variant and variant.name in self.function_ir:
+            # A copy of the variant, which the driver loop can inline
+            head = self._unit_IR(variant.name).replace('define ', 'define internal ', 1)
+        else:
+            head = declaration(callee)
+        width = variant.function_type.return_type.count if variant else None
+        llvmmod = llvm.parse_assembly(head + '\n' + batch_IR(callee, funcname, width))
+        llvmmod.verify()
+        self._link_symbols(llvmmod)
+        if optimize:
+            self.batch_pass_manager.run(llvmmod)
+        self.engine.add_module(llvmmod)
+        self.modules[batch_name(funcname)] = llvmmod
+        self._finalize()
+        functype = CFUNCTYPE(None, POINTER(c_double), c_int64, *[POINTER(c_double)] * len(func.args))
+        batch = self._batches[funcname] = functype(
+            self.engine.get_function_address(self._symbol(batch_name(funcname))))
+        return batch
+
+    @contextmanager
+    def _expression_engine(self, llvmmod, target_machine):
+        """Gives an engine holding the compiled module of a toplevel
+        expression, closed on exit."""
+        ee = llvm.create_mcjit_compiler(llvmmod, target_machine)
+        if self.perf:
+            ee.set_object_cache(self._notify_jitted)
+        # The session functions still called are resolved to their code
+        # in the session engine.
+        for callee in llvmmod.functions:
+            name = function_name(callee.name)
+            if callee.is_declaration and (
+                    name in self.callees or name in self.codegen.prebuilt):
+                ee.add_global_mapping(callee, self.engine.get_function_address(callee.name))
+        ee.finalize_object()
+        reported = self._report_jitted(ee)
+        try:
+            with ee:
+                yield ee
+        finally:
+            self._release_reported(reported)
+
+    def timeit(self, codestr, repeat = None, warmup = 3, optimize = True, duration = 0.2,
+            fastmath = None):
+        """Time the toplevel expression of codestr. It is compiled once, with
+        the session functions it needs, then its native code is run warmup
+        times, and repeat times while being timed. When repeat is None, it is
+        calibrated so that the timed runs last about duration seconds.
+        Returns a Timing. Each run includes the cost of a ctypes call, which
+        dominates for the simplest expressions. fastmath only applies to the
+        expression, as in evaluate()."""
+        ast = Parser(self.operators).parse_toplevel(codestr)
+        if not (isinstance(ast, Function) and ast.is_anonymous()):
+            raise CodegenError('Only a toplevel expression can be timed')
+
+        start = perf_counter()
+        self.codegen.fastmath = self.fastmath if fastmath is None else fastmath_flags(fastmath)
+        func = self.codegen.generate_code(ast)
+        self._add_function(func)
+        llvmmod = self._expression_module(func.name, optimize)
+        with self._expression_engine(llvmmod, host_target_machine(self.target)) as ee:
+            fptr = CFUNCTYPE(CTYPES[ast.proto.return_type])(ee.get_function_address(ast.proto.name))
+            compile_time = perf_counter() - start
+
+            start = perf_counter()
+            value = fptr()
+            for i in range(warmup):
+                fptr()
+            if repeat is None:
+                run_time = (perf_counter() - start) / (warmup + 1)
+                repeat = max(5, min(int(duration / max(run_time, 1e-7)), 1000000))
+
+            times = []
+            for i in range(repeat):
+                start = perf_counter()
+                fptr()
+                times.append(perf_counter() - start)
+        times.sort()
+        return Timing(value, compile_time, repeat, times[0],
+            times[len(times) // 2], times[min(len(times) - 1, int(len(times) * 0.95))])
 
 
 #---- Some unit tests ----#
@@ -319,6 +1373,831 @@ class TestEvaluator(unittest.TestCase):
             ''')
         self.assertEqual(e.evaluate('foo(5)'), 30)
 
+    def test_mutual_recursion(self):
+        e = KaleidoscopeEvaluator()
+        e.evaluate('extern odd(n)')
+        e.evaluate('def even(n) if n < 1 then 1 else odd(n - 1)')
+        e.evaluate('def odd(n) if n < 1 then 0 else even(n - 1)')
+        self.assertEqual(e.evaluate('even(10)'), 1)
+        self.assertEqual(e.evaluate('odd(7)'), 1)
+
+    def test_verbose_renders_only_new_function(self):
+        e = KaleidoscopeEvaluator()
+        e.evaluate('def sq(x) x * x')
+        result = next(e.eval_generator('def quad(x) sq(sq(x))', {'verbose': True}))
+        self.assertIn('@"quad"', result.rawIR)
+        self.assertNotIn('define double @"sq"', result.rawIR)
+        self.assertIn('define double @quad', result.optIR)
+        result = next(e.eval_generator('quad(3)', {'verbose': True}))
+        self.assertEqual(result.value, 81)
+        self.assertTrue(result.rawIR.startswith('define double @"_ANONYMOUS.'))
+
+    def test_anonymous_functions_are_released(self):
+        e = KaleidoscopeEvaluator()
+        e.evaluate('def sq(x) x * x')
+        e.evaluate('sq(2)')
+        usage = e.memory_usage()
+        for i in range(20):
+            self.assertEqual(e.evaluate('sq({0})'.format(i)), i * i)
+        self.assertEqual(e.memory_usage()[:3], usage[:3])
+        self.assertFalse([name for name in e.codegen.module.globals if name.startswith(_ANONYMOUS)])
+
+    def test_codegen_error_leaves_module_intact(self):
+        e = KaleidoscopeEvaluator()
+        with self.assertRaises(CodegenError):
+            e.evaluate('def foo(x) y')
+        e.evaluate('def foo(x) x + 1')
+        self.assertEqual(e.evaluate('foo(1)'), 2)
+        e.evaluate('extern bar(x)')
+        with self.assertRaises(CodegenError):
+            e.evaluate('def bar(x) y')
+        e.evaluate('def bar(x) x + 2')
+        self.assertEqual(e.evaluate('bar(1)'), 3)
+
+    def test_compact(self):
+        import os, tempfile
+        e = KaleidoscopeEvaluator(memory_budget=0)
+        e.evaluate('def sq(x) x * x')
+        e.evaluate('def unused(x) x')
+        self.assertEqual(e.evaluate('sq(3)'), 9)
+        usage = e.memory_usage()
+        self.assertEqual(usage.ir_bytes, len(e.function_ir['unused']) + len(e.function_ir['putchard']))
+        self.assertGreater(usage.bitcode_bytes, 0)
+        self.assertGreater(usage.jit_bytes, 0)
+        self.assertIn('sq', e.codegen.prebuilt)
+        e.evaluate('def quad(x) sq(sq(x))')
+        self.assertEqual(e.evaluate('quad(3)'), 81)
+        # A compacted function can be defined again
+        e.evaluate('def sq(x) x + x')
+        self.assertEqual(e.evaluate('quad(3)'), 12)
+        handle, filename = tempfile.mkstemp('.snap')
+        os.close(handle)
+        try:
+            e.save_snapshot(filename)
+            k = KaleidoscopeEvaluator()
+            k.load_snapshot(filename)
+        finally:
+            os.remove(filename)
+        self.assertEqual(k.evaluate('quad(2) + unused(1)'), 9)
+
+    def test_snapshot(self):
+        import os, tempfile
+        e = KaleidoscopeEvaluator()
+        e.evaluate('def binary % 60 (a b) a - b')
+        e.evaluate('def twice(x) x * 2')
+        e.evaluate('extern ceil(x)')
+        self.assertEqual(e.evaluate('twice(ceil(3 % 0.5))'), 6)
+        handle, filename = tempfile.mkstemp('.snap')
+        os.close(handle)
+        try:
+            e.save_snapshot(filename)
+            k = KaleidoscopeEvaluator()
+            k.load_snapshot(filename)
+        finally:
+            os.remove(filename)
+        self.assertIn('twice', k.codegen.prebuilt)
+        self.assertEqual(k.evaluate('twice(ceil(3 % 0.5))'), 6)
+        self.assertEqual(k.evaluate('1 + 3 % 1'), 3)
+        k.evaluate('def quad(x) twice(twice(x))')
+        self.assertEqual(k.evaluate('quad(2)'), 8)
+        k.evaluate('def twice(x) x + x + 1')
+        self.assertEqual(k.evaluate('quad(2)'), 11)
+        # A file is read as data only, never run
+        import builtins, pickle
+        class Payload(object):
+            def __reduce__(self):
+                return (exec, ('import builtins; builtins.kal_payload_ran = True',))
+        handle, filename = tempfile.mkstemp('.snap')
+        os.close(handle)
+        try:
+            for data in [pickle.dumps((1, Payload())), SNAPSHOT_MAGIC + bytes(12)]:
+                with open(filename, 'wb') as file:
+                    file.write(data)
+                with self.assertRaises(SnapshotError):
+                    k.load_snapshot(filename)
+        finally:
+            os.remove(filename)
+        self.assertFalse(hasattr(builtins, 'kal_payload_ran'))
+
+    def test_snapshot_bitcode_fallback(self):
+        import os, tempfile
+        e = KaleidoscopeEvaluator()
+        e.evaluate('def twice(x) x * 2')
+        handle, filename = tempfile.mkstemp('.snap')
+        os.close(handle)
+        try:
+            snapshot = e.save_snapshot(filename)
+            snapshot.signature = None
+            snapshot.save(filename)
+            k = KaleidoscopeEvaluator()
+            k.load_snapshot(filename)
+        finally:
+            os.remove(filename)
+        self.assertEqual(k.evaluate('twice(4)'), 8)
+
+    def test_timeit(self):
+        e = KaleidoscopeEvaluator()
+        e.evaluate('def fib(n) if n < 2 then n else fib(n - 1) + fib(n - 2)')
+        timing = e.timeit('fib(10)', repeat=20)
+        self.assertEqual(timing.value, 55)
+        self.assertEqual(timing.runs, 20)
+        self.assertGreater(timing.compile_time, 0)
+        self.assertTrue(0 < timing.min <= timing.median <= timing.p95)
+        self.assertGreaterEqual(e.timeit('fib(5)', duration=0.01).runs, 5)
+        # The timed expression is not kept
+        self.assertEqual(set(e.function_ir), {'putchard', 'fib'})
+        with self.assertRaises(CodegenError):
+            e.timeit('def foo(x) x')
+
+    def test_perf_map(self):
+        import os, tempfile
+        with tempfile.TemporaryDirectory() as tmpdir:
+            mapfile = os.path.join(tmpdir, 'perf.map')
+            e = KaleidoscopeEvaluator('basiclib.kal', perf_map=mapfile, jitdump=tmpdir, interpret=False)
+            e.evaluate('def sq(x) x * x')
+            self.assertEqual(e.evaluate('sq(3) : 1'), 1)
+            with open(mapfile) as file:
+                symbols = {line.split()[2]: line.split()[:2] for line in file}
+            self.assertTrue(os.path.getsize(os.path.join(tmpdir, 'jit-{0}.dump'.format(os.getpid()))) > 40)
+        self.assertIn('sq', symbols)
+        self.assertIn('binary:', symbols)
+        self.assertTrue(any(name.startswith(_ANONYMOUS) for name in symbols))
+        address, size = symbols['sq']
+        self.assertEqual(int(address, 16), e.engine.get_function_address('sq'))
+        self.assertGreater(int(size, 16), 0)
+        # The code of the expressions is forgotten once freed
+        reporter = e.perf[0]
+        self.assertFalse(any(name.startswith(_ANONYMOUS) for name, address in reporter.reported))
+        e.reset()
+        self.assertNotIn(('sq', int(address, 16)), reporter.reported)
+
+    def test_profile(self):
+        e = KaleidoscopeEvaluator()
+        profile = {'profile': True}
+        e.evaluate('def fib(n) if n < 2 then n else fib(n - 1) + fib(n - 2)', profile)
+        e.evaluate('def loop(n) for i = 0, i < n in fib(5)', profile)
+        e.evaluate('def plain(x) x')
+        with self.assertRaises(CodegenError):
+            e.evaluate('def broken(x) y', profile)
+        self.assertEqual(sorted(e.profiler.counters), ['fib', 'loop'])
+        self.assertEqual(e.evaluate('loop(10) + fib(10) + plain(1)'), 66)
+        entries = {entry.name: entry for entry in e.profiler.report()}
+        self.assertEqual(entries['loop'].calls, 1)
+        self.assertEqual(entries['loop'].trips, 10)
+        self.assertEqual(entries['fib'].calls, 10 * 15 + 177)
+        self.assertEqual(entries['fib'].trips, 0)
+        self.assertGreater(entries['fib'].cycles, 0)
+        e.profiler.clear()
+        self.assertEqual(e.profiler.report(), [])
+        with self.assertRaises(SnapshotError):
+            e.save_snapshot('unused.snap')
+
+    def test_shared_library(self):
+        import os, tempfile
+        e = KaleidoscopeEvaluator('basiclib.kal')
+        k = KaleidoscopeEvaluator('basiclib.kal')
+        self.assertIs(e.library, k.library)
+        self.assertIn('factorial', e.codegen.prebuilt)
+        # The library only gets SIMD variants for the evaluators asking for
+        # them, its pure functions being recorded either way
+        s = KaleidoscopeEvaluator('basiclib.kal', simd=True)
+        self.assertIsNot(s.library, e.library)
+        self.assertTrue(any(variant_width(info.name) for info in s.library.functions))
+        self.assertFalse(any(variant_width(info.name) for info in e.library.functions))
+        self.assertIn('factorial', e.codegen.pure)
+        self.assertEqual(e.evaluate('factorial(5) : max(2, 3) + (4 > 3)'), 4)
+        # Each evaluator keeps its own definitions and operators
+        e.evaluate('def binary % 60 (a b) a - b')
+        e.evaluate('def fact3(x) factorial(x % 1) * 3')
+        self.assertEqual(e.evaluate('fact3(4)'), 18)
+        with self.assertRaises(ParseError):
+            k.evaluate('4 % 1')
+        with self.assertRaises(CodegenError):
+            k.evaluate('fact3(4)')
+        # Snapshots take the library along, as it is replaced by them
+        handle, filename = tempfile.mkstemp('.snap')
+        os.close(handle)
+        try:
+            e.save_snapshot(filename)
+            k.load_snapshot(filename)
+        finally:
+            os.remove(filename)
+        self.assertIsNone(k.library)
+        self.assertEqual(k.evaluate('fact3(4 % -1) ? min(72, 1000)'), 1)
+        self.assertTrue({'fact3', 'factorial', 'min'} <= k.codegen.pure)
+
+    def test_tiered(self):
+        import os, tempfile
+        e = KaleidoscopeEvaluator('basiclib.kal', tiered=True, hot_threshold=50)
+        e.tiering.close()     # Promote by hand below
+        e.evaluate('def fib(n) if n < 2 then n else fib(n - 1) + fib(n - 2)')
+        e.evaluate('extern odd(x)')
+        e.evaluate('def even(x) if x < 1 then 1 else odd(x - 1)')
+        e.evaluate('def odd(x) if x < 1 then 0 else even(x - 1)')
+        e.evaluate('def sum(n) for i = 0, i < n in fib(i) + max(i, 1)')
+        self.assertEqual(e.evaluate('fib(10) : even(7) + odd(7) : fib(10)'), 55)
+        self.assertEqual(e.tiering.levels(), {'fib': 0, 'even': 0, 'odd': 0})
+        tier0 = e.tiering.slot('fib')
+        tier0_code = e.tiering.tiers['fib'].slot.code
+        # The interpreted expression calls fib directly, not through its stub
+        self.assertEqual(e.tiering.tiers['fib'].slot.calls, 2 * 176)
+        self.assertEqual(sorted(e.tiering.promote_hot()), ['fib'])
+        self.assertEqual(e.tiering.slot('fib'), tier0)
+        self.assertNotEqual(e.tiering.tiers['fib'].slot.code, tier0_code)
+        self.assertEqual(e.evaluate('fib(15) + even(100) + odd(100)'), 611)
+        self.assertEqual(sorted(e.tiering.promote_hot()), ['even', 'odd'])
+        self.assertEqual(e.evaluate('even(301) : sum(5)'), 5)
+        self.assertEqual(e.tiering.levels(), {'fib': 1, 'even': 1, 'odd': 1, 'sum': 0})
+        # Snapshots hold the plain units
+        handle, filename = tempfile.mkstemp('.snap')
+        os.close(handle)
+        try:
+            e.save_snapshot(filename)
+            k = KaleidoscopeEvaluator()
+            k.load_snapshot(filename)
+        finally:
+            os.remove(filename)
+        self.assertEqual(k.evaluate('fib(15) + sum(5)'), 615)
+
+    def test_simd(self):
+        import os, tempfile
+        from array import array
+        from simd import simd_name
+        e = KaleidoscopeEvaluator('basiclib.kal', simd=True)
+        e.evaluate('''
+            def mandelconverger(real imag iters creal cimag)
+                if iters > 255 | (real*real + imag*imag > 4) then iters
+                else mandelconverger(real*real - imag*imag + creal, 2*real*imag + cimag,
+                    iters+1, creal, cimag)''')
+        e.evaluate('def mandelconverge(real imag) mandelconverger(real, imag, 0, real, imag)')
+        e.evaluate('def count(n) var a in (for i = 0, i < n in a = a + if i < 3 then 1 else 0.5) * 0 + a')
+        e.evaluate('def show(x) putchard(x)')
+        self.assertIn(simd_name('mandelconverger', e.simd_width), e.codegen.module.globals)
+        self.assertNotIn(simd_name('show', e.simd_width), e.codegen.module.globals)
+        # The last elements of an array run under a mask
+        reals = [x * 0.125 - 2 for x in range(27)]
+        imags = [x * 0.0625 - 0.75 for x in range(27)]
+        expected = [e.evaluate('mandelconverge({0}, {1})'.format(*point)) for point in zip(reals, imags)]
+        self.assertEqual(list(e.map('mandelconverge', reals, imags)), expected)
+        self.assertEqual(list(e.map('count', array('d', range(-1, 6)))), [0, 0, 1, 2, 3, 3.5, 4])
+        self.assertEqual(list(e.map('factorial', [1, 2, 5])), [1, 2, 120])
+        self.assertEqual(list(e.map('max', 3, [1, 5])), [3, 5])
+        # Without a variant, the elements are computed one at a time
+        self.assertEqual(list(e.map('sqrt', [4, 9])), [2, 3])
+        k = KaleidoscopeEvaluator('basiclib.kal')
+        k.evaluate('def count(n) var a in (for i = 0, i < n in a = a + if i < 3 then 1 else 0.5) * 0 + a')
+        self.assertEqual(list(k.map('count', range(-1, 6))), [0, 0, 1, 2, 3, 3.5, 4])
+        with self.assertRaises(CodegenError):
+            e.map('nothere', [1])
+        with self.assertRaises(CodegenError):
+            e.map('max', [1])
+        with self.assertRaises(ValueError):
+            e.map('max', [1], [1, 2])
+        # Snapshots keep the variants
+        handle, filename = tempfile.mkstemp('.snap')
+        os.close(handle)
+        try:
+            e.save_snapshot(filename)
+            k = KaleidoscopeEvaluator(tiered=True, simd=True)
+            k.load_snapshot(filename)
+        finally:
+            os.remove(filename)
+        self.assertEqual(list(k.map('mandelconverge', reals, imags)), expected)
+        # The variants are left out of tiered compilation
+        k.evaluate('def sq(x) x * x')
+        self.assertEqual(list(k.map('sq', [1, 2, 3])), [1, 4, 9])
+        self.assertEqual(k.evaluate('sq(3)'), 9)
+        self.assertEqual(list(k.tiering.tiers), ['sq'])
+        k.tiering.close()
+
+    def test_reduction(self):
+        from bytecode import BytecodeEvaluator
+        vm = BytecodeEvaluator('basiclib.kal')
+        e = KaleidoscopeEvaluator('basiclib.kal', interpret=False)
+        k = KaleidoscopeEvaluator('basiclib.kal', interpret=False, reassociate=True)
+        definitions = [
+            'def sumsq(n) for i = 0, i < n reduce + in i * i',
+            'def fact(n) for i = 1, i < n + 1 reduce * in i',
+            'def peak(n) for i = 0, i < n, i + 0.5 reduce max in sin(i)',
+            'def low(n) for x = 1, x < n, x * 2 reduce min in x - 5 * sqrt(x)',
+            'def shrink(n) var b = n in for i = 0, i < b reduce + in b = b - 1']
+        for codestr in definitions:
+            for evaluator in (vm, e, k):
+                evaluator.evaluate(codestr)
+        for codestr in ['sumsq(1000)', 'sumsq(0)', 'fact(10)', 'peak(10)', 'low(1000)',
+                'shrink(10)', 'for i = 0, i < 7, i + 3 reduce + in i']:
+            self.assertEqual(e.evaluate(codestr), vm.evaluate(codestr), codestr)
+            self.assertEqual(k.evaluate(codestr), vm.evaluate(codestr), codestr)
+        self.assertEqual(e.evaluate('sumsq(4)'), 14)
+        # The reassociated sums are vectorized
+        result = next(k.eval_generator('def sumsq2(n) for i = 0, i < n reduce + in i * i',
+            {'verbose': True}))
+        self.assertIn(' x double>', result.optIR)
+        result = next(e.eval_generator('def sumsq2(n) for i = 0, i < n reduce + in i * i',
+            {'verbose': True}))
+        self.assertNotIn(' x double>', result.optIR)
+        self.assertEqual(list(e.map('sumsq', [0, 2, 4])), [0, 1, 14])
+
+    def test_fastmath(self):
+        self.assertEqual(fastmath_flags(True), FASTMATH_FLAGS)
+        self.assertEqual(fastmath_flags('nsz, contract'), ('contract', 'nsz'))
+        self.assertEqual(fastmath_flags(None), ())
+        with self.assertRaises(ValueError):
+            fastmath_flags('fast,loose')
+        e = KaleidoscopeEvaluator('basiclib.kal', fastmath='contract,nsz')
+        result = next(e.eval_generator('def axpy(a x y) a * x + y', {'noexec': True}))
+        self.assertIn('fmul contract nsz double', result.rawIR)
+        # Each evaluation can select other flags
+        result = next(e.eval_generator('def axpy2(a x y) a * x + y', {'noexec': True, 'fastmath': False}))
+        self.assertIn('fmul double', result.rawIR)
+        result = next(e.eval_generator('def root(x) if x < 0 then 0 else ceil(x)',
+            {'noexec': True, 'fastmath': 'fast'}))
+        self.assertIn('fcmp reassoc contract nnan ninf nsz arcp ult', result.rawIR)
+        self.assertEqual(e.evaluate('axpy(2, 3, 4)'), 10)
+        # The reductions are reassociated, and vectorized
+        k = KaleidoscopeEvaluator('basiclib.kal', fastmath=True)
+        k.evaluate('def sumsq(n) for i = 0, i < n reduce + in i * i * 0.5')
+        result = next(k.eval_generator('def peak(n) for i = 0, i < n reduce max in i * (9 - i)',
+            {'verbose': True}))
+        self.assertIn(' x double>', result.optIR)
+        self.assertAlmostEqual(k.evaluate('sumsq(100000)'), sum(i * i * 0.5 for i in range(100000)),
+            delta=1e-9 * sum(i * i * 0.5 for i in range(100000)))
+        self.assertEqual(k.evaluate('peak(10)'), 20)
+        self.assertEqual(list(k.map('sumsq', [3, 4])), [2.5, 7])
+        self.assertEqual(k.timeit('sumsq(4)', repeat=5, fastmath=False).value, 7)
+
+    def test_parfor(self):
+        import os, tempfile
+        from bytecode import BytecodeEvaluator
+        # Run the loops in 4 chunks, whatever the number of processors
+        runtime = parallel.runtime()
+        workers, runtime.workers = runtime.workers, 4
+        try:
+            e = KaleidoscopeEvaluator('basiclib.kal')
+            vm = BytecodeEvaluator('basiclib.kal')
+            definitions = [
+                'def sum(n) parfor i = 0, i < n reduce + in i',
+                'def spread(n k) (parfor i = 0, i < n reduce max in (i - k) * (i - k)) - '
+                    '(parfor i = 0, i < n reduce min in (i - k) * (i - k))',
+                'def odd(n) parfor i = 1, i < n, i + 2 reduce * in i',
+                'def pairs(n) parfor i = 0, i < n reduce + in parfor j = 0, j < i reduce + in 1',
+                'def last(n) parfor i = 0.5, i < n in sum(i)']
+            for codestr in definitions:
+                e.evaluate(codestr)
+                vm.evaluate(codestr)
+            for codestr in ['sum(1000)', 'sum(0)', 'sum(3)', 'spread(100, 30)', 'odd(12)',
+                    'pairs(50)', 'last(10)', 'last(0)', 'parfor i = 0, i < 10 reduce + in sum(i)']:
+                self.assertEqual(e.evaluate(codestr), vm.evaluate(codestr), codestr)
+            self.assertEqual(e.evaluate('sum(1000)'), 499500)
+            self.assertEqual(e.evaluate('pairs(50)'), 1225)
+            self.assertEqual(e.evaluate('last(10)'), 10.5)
+            # The iterations can't race on the variables of the function
+            with self.assertRaises(CodegenError):
+                e.evaluate('def bad(n) var s in parfor i = 0, i < n in s = s + i')
+            with self.assertRaises(CodegenError):
+                e.evaluate('def bad(n) parfor i = 0, i < n, i * 2 in i')
+            with self.assertRaises(CodegenError):
+                e.evaluate('def bad(n) parfor i = 0, n > i in i')
+            self.assertEqual(e.evaluate('def bad(n) n'), None)
+            self.assertNotIn(parallel.outlined_name('bad', 1), e.codegen.module.globals)
+            # The loop bodies stay out of the function list, but in the snapshots
+            e.compact()
+            self.assertEqual(e.evaluate('pairs(10)'), 45)
+            handle, filename = tempfile.mkstemp('.snap')
+            os.close(handle)
+            try:
+                e.save_snapshot(filename)
+                # The calls to the pure twice() must not come from the cache
+                k = KaleidoscopeEvaluator(tiered=True, hot_threshold=10, interpret=False,
+                    result_cache=0)
+                k.load_snapshot(filename)
+            finally:
+                os.remove(filename)
+            self.assertNotIn(parallel.outlined_name('pairs', 1),
+                [info.name for info in k.snapshot.functions])
+            self.assertEqual(k.evaluate('pairs(50)'), 1225)
+            k.evaluate('def twice(n) parfor i = 0, i < n reduce + in 2 * sum(i)')
+            for i in range(k.tiering.threshold):
+                self.assertEqual(k.evaluate('twice(4)'), 8)
+            self.assertEqual(k.tiering.promote_hot(), ['twice'])
+            self.assertEqual(k.evaluate('twice(4)'), 8)
+            k.tiering.close()
+        finally:
+            runtime.workers = workers
+
+    def test_types(self):
+        import os, tempfile
+        e = KaleidoscopeEvaluator('basiclib.kal')
+        e.evaluate('def fib(n: i64) : i64 if n < 2 then n else fib(n - 1) + fib(n - 2)')
+        self.assertEqual(e.evaluate('fib(20)'), 6765)
+        self.assertIsInstance(e.evaluate('fib(20)'), int)
+        result = next(e.eval_generator('def fib2(n: i64) : i64 if n < 2 then n else fib2(n - 1)',
+            {'noexec': True}))
+        self.assertIn('icmp slt i64', result.rawIR)
+        self.assertNotIn('double', result.rawIR)
+        # The counter of a loop up to an i64 bound is an i64, as the sum
+        e.evaluate('def count(n: i64) for i = 0, i < n reduce + in i')
+        self.assertEqual(e.evaluate('count(10)'), 45)
+        # but not when it counts by fractions
+        e.evaluate('def half(n: i64) for i = 0, i < n, i + 0.5 reduce + in 1')
+        self.assertEqual(e.evaluate('half(3)'), 6)
+        e.evaluate('def twice(n: i64) for i = 0, i < n, i + 2 reduce + in i')
+        self.assertEqual(e.evaluate('twice(7)'), 12)
+        # Each expression is typed once, however deep
+        typed = []
+        infer = e.codegen._infer_type
+        e.codegen._infer_type = lambda node, scope: typed.append(id(node)) or infer(node, scope)
+        e.evaluate('def poly(x: i64 n) for i = 0, i < n reduce + in '
+            + ' + '.join('x * i * {0}'.format(k) for k in range(50)))
+        del e.codegen._infer_type
+        self.assertEqual(len(typed), len(set(typed)))
+        self.assertEqual(e.evaluate('poly(1, 3)'), 3675)
+        self.assertEqual(e.evaluate('var k: i64 = 7 in k * 0.5'), 3.5)
+        self.assertEqual(e.evaluate('var k: i64 = 7.9 in k'), 7)
+        self.assertEqual(e.evaluate('var k: i64 = 7, j = k in j = j * 0.5'), 3)
+        e.evaluate('def tenth(n: i64) : f32 var h: f32 = 0.1 in for i = 0, i < n reduce + in h')
+        self.assertNotEqual(e.evaluate('tenth(10)'), 1.0)
+        self.assertAlmostEqual(e.evaluate('tenth(10)'), 1.0, places=5)
+        e.evaluate('def both(a: bool b: i1) : bool if a then b else 0')
+        self.assertEqual(e.evaluate('both(2, 3) + both(0, 1)'), 1)
+        e.evaluate('extern labs(x: i64) : i64')
+        self.assertEqual(e.evaluate('labs(0 - 5)'), 5)
+        # Untyped code calls typed functions with its doubles
+        e.evaluate('def fibs(n) for i = 0, i < n reduce + in fib(i)')
+        self.assertEqual(e.evaluate('fibs(10)'), 88.0)
+        self.assertEqual(list(e.map('fibs', [5, 10])), [7, 88])
+        with self.assertRaises(CodegenError):
+            e.map('fib', [5])
+        e.evaluate('extern later(x: i64)')
+        with self.assertRaises(CodegenError):
+            e.evaluate('def later(x) x')
+        with self.assertRaises(CodegenError):
+            e.evaluate('for b: bool = 0, b < 1 in b')
+        # Integer reductions are vectorized too
+        k = KaleidoscopeEvaluator('basiclib.kal', reassociate=True)
+        result = next(k.eval_generator('def peak(n: i64) : i64 for i = 0, i < n reduce max in i * (9 - i)',
+            {'verbose': True}))
+        self.assertIn(' x i64>', result.optIR)
+        self.assertEqual(k.evaluate('peak(1000)'), 20)
+
+        runtime = parallel.runtime()
+        workers, runtime.workers = runtime.workers, 4
+        try:
+            e.evaluate('def scaled(n: i64 k: i64) : i64 parfor i = 0, i < n reduce + in i * k')
+            e.evaluate('def low(n: i64 x: f32) parfor i = 0, i < n reduce min in (i - x) * (i - x)')
+            self.assertEqual(e.evaluate('scaled(100, 3)'), 14850)
+            self.assertAlmostEqual(e.evaluate('low(10, 2.5)'), 0.25)
+        finally:
+            runtime.workers = workers
+
+        # Typed functions are tiered, and kept in the snapshots
+        handle, filename = tempfile.mkstemp('.snap')
+        os.close(handle)
+        try:
+            e.save_snapshot(filename)
+            k = KaleidoscopeEvaluator(tiered=True, hot_threshold=10, interpret=False)
+            k.load_snapshot(filename)
+        finally:
+            os.remove(filename)
+        self.assertEqual(k.evaluate('fib(20)'), 6765)
+        k.evaluate('def fact(n: i64) : i64 if n < 2 then 1 else n * fact(n - 1)')
+        for i in range(k.tiering.threshold):
+            self.assertEqual(k.evaluate('fact(20)'), 2432902008176640000)
+        # Its recursive calls may have had it promoted already
+        k.tiering.promote_hot()
+        self.assertEqual(k.tiering.levels()['fact'], 1)
+        self.assertEqual(k.evaluate('fact(20)'), 2432902008176640000)
+        k.tiering.close()
+
+    def test_arrays(self):
+        from array import array
+        e = KaleidoscopeEvaluator('basiclib.kal')
+        e.evaluate('def scale(xs: f64[] k) for i = 0, i < len(xs) in xs[i] = xs[i] * k')
+        e.evaluate('def total(xs: f64[]) for i = 0, i < len(xs) reduce + in xs[i]')
+        values = array('d', [1, 2, 3])
+        e.call('scale', values, 2)
+        self.assertEqual(list(values), [2, 4, 6])
+        self.assertEqual(e.call('total', values), 12)
+        self.assertEqual(e.call('total', array('d')), 0)
+        e.evaluate('def sum(data: u8[]) : i64 for i = 0, i < len(data) reduce + in data[i]')
+        e.evaluate('def upper(data: u8[]) for i = 0, i < len(data) in '
+            'if 96 < data[i] then if data[i] < 123 then data[i] = data[i] - 32 else 0 else 0')
+        text = bytearray(b'hello, world')
+        e.call('upper', text)
+        self.assertEqual(text, b'HELLO, WORLD')
+        self.assertEqual(e.call('sum', text), sum(text))
+        self.assertEqual(e.call('sum', memoryview(text)[7:]), sum(b'WORLD'))
+        # The indexes out of bounds are reported, and access nothing
+        e.evaluate('def get(xs: f64[] i: i64) xs[i]')
+        e.evaluate('def put(xs: f64[] i: i64 x) xs[i] = x')
+        self.assertEqual(e.call('get', values, 1), 4)
+        for name, args in [('get', (3,)), ('get', (-1,)), ('put', (5, 1))]:
+            with self.assertRaises(IndexError):
+                e.call(name, values, *args)
+        self.assertEqual(list(values), [2, 4, 6])
+        with self.assertRaises(TypeError):
+            e.call('scale', array('f', [1]), 2)
+        for codestr in ['def bad(xs: f64[]) xs + 1', 'def bad(xs: f64[]) var ys: f64[] in ys',
+                'def bad(x) x[0]', 'def bad(xs: f64[] ys: i64[]) xs = ys']:
+            with self.assertRaises(CodegenError):
+                e.evaluate(codestr)
+        # Without the checks, the loops over arrays get vectorized
+        k = KaleidoscopeEvaluator('basiclib.kal', bounds_check=False)
+        result = next(k.eval_generator(
+            'def scale(xs: f64[] k) for i = 0, i < len(xs) in xs[i] = xs[i] * k', {'verbose': True}))
+        self.assertIn(' x double>', result.optIR)
+        k.call('scale', values, 0.5)
+        self.assertEqual(list(values), [1, 2, 3])
+
+        runtime = parallel.runtime()
+        workers, runtime.workers = runtime.workers, 4
+        try:
+            e.evaluate('def square(xs: f64[]) parfor i = 0, i < len(xs) in xs[i] = xs[i] * xs[i]')
+            e.evaluate('def count(xs: i64[] x: i64) : i64 parfor i = 0, i < len(xs) reduce + in '
+                'if xs[i] < x then 1 else 0')
+            squares = array('d', range(100))
+            e.call('square', squares)
+            self.assertEqual(list(squares), [i * i for i in range(100)])
+            self.assertEqual(e.call('count', array('q', range(100)), 42), 42)
+            # The index out of bounds of the last chunk, run by another
+            # thread, is reported to the call
+            e.evaluate('def shift(xs: f64[]) parfor i = 0, i < len(xs) in xs[i] = xs[i + 1]')
+            with self.assertRaises(IndexError):
+                e.call('shift', squares)
+        finally:
+            runtime.workers = workers
+        # Concurrent calls only see the indexes their own code reported
+        from concurrent.futures import ThreadPoolExecutor
+        e.evaluate('def slow(xs: f64[] i: i64) xs[i] + for j = 0, j < 200000 reduce + in xs[0]')
+        def slow(i):
+            try:
+                return e.call('slow', values, i % 2 * 3)
+            except IndexError:
+                return None
+        with ThreadPoolExecutor(8) as pool:
+            self.assertEqual(list(pool.map(slow, range(200))), [200001, None] * 100)
+        try:
+            import numpy
+        except ImportError:
+            return
+        grid = numpy.arange(12.0).reshape(3, 4)
+        e.call('scale', grid, 2)
+        self.assertEqual(grid.tolist(), (numpy.arange(12.0) * 2).reshape(3, 4).tolist())
+        self.assertEqual(e.call('count', numpy.arange(10), 3), 3)
+
+    def test_memo(self):
+        e = KaleidoscopeEvaluator('basiclib.kal')
+        e.evaluate('def memo fib(n) if n < 2 then n else fib(n - 1) + fib(n - 2)')
+        e.evaluate('def square(x) x * x')
+        e.evaluate('def memo 2 hyp(x y) sqrt(square(x) + square(y))')
+        self.assertEqual(e.evaluate('fib(70)'), 190392490709135)
+        table = e.memo.tables['fib']
+        self.assertEqual((table.misses, table.hits), (71, 68))
+        # Some arguments may share a slot
+        fibs = [0, 1]
+        while len(fibs) < 71:
+            fibs.append(fibs[-1] + fibs[-2])
+        entries = table.entries()
+        self.assertGreater(len(entries), 60)
+        self.assertEqual(entries, {(n,): fibs[int(n)] for n, in entries})
+        self.assertEqual(e.evaluate('fib(70) + 1'), 190392490709136)
+        self.assertEqual(table.hits, 69)
+        # The results of other arguments evict the older ones
+        for x in range(10):
+            self.assertEqual(e.evaluate('hyp({0}, 0)'.format(x)), x)
+        self.assertLessEqual(len(e.memo.tables['hyp']), 2)
+        self.assertEqual([entry.name for entry in e.memo.report()], ['fib', 'hyp'])
+        e.memo.clear()
+        self.assertEqual((len(table), table.hits, table.misses), (0, 0, 0))
+        self.assertEqual(e.evaluate('fib(20)'), 6765)
+        # The threads of parallel loops share the tables
+        runtime = parallel.runtime()
+        workers, runtime.workers = runtime.workers, 4
+        try:
+            self.assertEqual(e.evaluate('parfor i = 0, i < 40 reduce + in fib(i)'), 165580140)
+        finally:
+            runtime.workers = workers
+        for codestr in ['def memo bad(x) putchard(x)', 'def memo bad(x: i64) x',
+                'def memo bad(x) var y = 0 in (for i = 0, i < x in y = y + putchard(i)) + y']:
+            with self.assertRaises(CodegenError):
+                e.evaluate(codestr)
+        self.assertEqual(sorted(e.memo.tables), ['fib', 'hyp'])
+        with self.assertRaises(SnapshotError):
+            e.save_snapshot('unused.snap')
+
+    def test_result_cache(self):
+        e = KaleidoscopeEvaluator('basiclib.kal')
+        e.evaluate('def square(x) x * x')
+        e.evaluate('def sum(n) for i = 0, i < n reduce + in square(i)')
+        e.evaluate('def noisy(x) putchard(0) + x')
+        self.assertEqual(e.evaluate('sum(10)'), 285)
+        self.assertEqual((len(e.results), e.results.hits, e.results.misses), (1, 0, 1))
+        self.assertEqual(e.evaluate('sum( 10 )'), 285)
+        self.assertEqual(e.results.hits, 1)
+        # Neither the expressions with side effects nor the ones failing to
+        # compile are kept, or looked up
+        for codestr in ['noisy(1)', 'sum(10) + noisy(1)', 'unknown(1)']:
+            try:
+                e.evaluate(codestr)
+            except CodegenError:
+                pass
+        self.assertEqual((len(e.results), e.results.hits, e.results.misses), (1, 1, 1))
+        # The values depend on the options they are computed with
+        self.assertEqual(e.evaluate('sum(10)', {'fastmath': True}), 285)
+        self.assertEqual(len(e.results), 2)
+        # A new definition of a function drops the values of the expressions
+        # calling it, directly or not, and changes their keys
+        self.assertEqual(e.evaluate('square(3)'), 9)
+        self.assertEqual(e.evaluate('1 + 2'), 3)
+        e.evaluate('def cube(x) x * x * x')
+        self.assertEqual(len(e.results), 4)
+        ast = Parser(e.operators).parse_toplevel('sum(10)')
+        key = e._result_key(ast)[0]
+        e.evaluate('def square(x) x * x * 1')
+        self.assertEqual(len(e.results), 1)
+        self.assertNotEqual(e._result_key(ast)[0], key)
+        # The library functions are known to be pure without SIMD variants
+        self.assertEqual(e.evaluate('max(1, 2) + factorial(5)'), 122)
+        self.assertEqual(e.evaluate('max(1, 2) + factorial(5)'), 122)
+        self.assertEqual(e.results.hits, 2)
+        k = KaleidoscopeEvaluator('basiclib.kal', result_cache=0)
+        self.assertEqual(k.evaluate('1 + 2'), 3)
+        self.assertEqual(len(k.results), 0)
+
+    def test_redefinition(self):
+        import os, tempfile
+        e = KaleidoscopeEvaluator('basiclib.kal', simd=True)
+        e.evaluate('def f(x) x + 1')
+        e.evaluate('def g(x) f(x) * 2')
+        e.evaluate('def h(x) x - 1')
+        e.evaluate('def memo m(x) g(x)')
+        e.evaluate('def p(n) parfor i = 0, i < n reduce + in g(i)')
+        self.assertEqual([e.evaluate(code) for code in ['g(1)', 'h(1)', 'm(1)', 'p(10)']], [4, 0, 4, 110])
+        self.assertEqual(list(e.map('g', [1, 2])), [4, 6])
+        h = e.modules['h']
+        # Only the function and the ones calling it are compiled again
+        e.evaluate('def f(y) y + 10')
+        self.assertLessEqual({'f', 'g', 'm', 'p'}, e.uncompiled)
+        self.assertNotIn('h', e.uncompiled)
+        self.assertEqual([e.evaluate(code) for code in ['g(1)', 'h(1)', 'm(1)', 'p(10)']], [22, 0, 22, 290])
+        self.assertEqual(list(e.map('g', [1, 2])), [22, 24])
+        self.assertEqual(e.call('g', 2), 24)
+        self.assertIs(e.modules['h'], h)
+        self.assertEqual(e.memo.tables['m'].entries(), {(1.0,): 22})
+        # A definition breaking the functions calling it leaves the previous
+        # one in place
+        for codestr in ['def f(x) y', 'def f(x) putchard(x)', 'def f(x y) x + y']:
+            with self.assertRaises(CodegenError):
+                e.evaluate(codestr)
+        self.assertEqual([e.evaluate(code) for code in ['g(2)', 'm(2)', 'p(10)']], [24, 24, 290])
+        e.compact()
+        e.evaluate('def f(x) x * 100')
+        self.assertEqual([e.evaluate(code) for code in ['g(3)', 'm(3)', 'p(10)']], [600, 600, 9000])
+        # The functions of the basic library are shadowed: the session
+        # functions calling them are generated again, while the library
+        # keeps calling its own
+        l = KaleidoscopeEvaluator('basiclib.kal', simd=True)
+        l.evaluate('def fact3(x) factorial(x) * 3')
+        self.assertEqual(l.evaluate('fact3(4)'), 72)
+        l.evaluate('def factorial(n) n + 1')
+        self.assertEqual([l.evaluate('factorial(4)'), l.evaluate('fact3(4)'), l.call('fact3', 4)], [5, 15, 15])
+        l.evaluate('def factorial(n) n + 2')
+        self.assertEqual(l.evaluate('fact3(4)'), 18)
+        l.evaluate('def unary - (x) 100')
+        self.assertEqual([l.evaluate('-3'), l.evaluate('abs(0 - 3)')], [100, 3])
+        with self.assertRaises(CodegenError):
+            l.evaluate('def factorial(n m) n')
+        self.assertEqual(l.evaluate('fact3(4)'), 18)
+        with self.assertRaises(CodegenError):
+            l.evaluate('def putchard(x) x')
+        handle, filename = tempfile.mkstemp('.snap')
+        os.close(handle)
+        try:
+            l.compact()
+            l.save_snapshot(filename)
+            s = KaleidoscopeEvaluator()
+            s.load_snapshot(filename)
+        finally:
+            os.remove(filename)
+        self.assertEqual([s.evaluate(code) for code in ['fact3(4)', '-3', 'abs(0 - 3)']], [18, 100, 3])
+        # And so are the ones of snapshots
+        s.evaluate('def fact3(x) x')
+        self.assertEqual(s.evaluate('fact3(4)'), 4)
+
+        k = KaleidoscopeEvaluator('basiclib.kal', tiered=True, hot_threshold=5)
+        k.tiering.close()     # Promote by hand below
+        k.evaluate('def f(x) x + 1')
+        k.evaluate('def g(x) f(x) * 2')
+        k.evaluate('def run(n) for i = 0, i < n in g(i)')
+        k.evaluate('run(10)')
+        k.tiering.promote_hot()
+        self.assertEqual(k.tiering.levels()['g'], 1)
+        self.assertIn('g', k.tiering.engines)
+        k.evaluate('def f(x) x + 2')
+        self.assertEqual(k.evaluate('g(1)'), 6)
+        self.assertEqual(k.tiering.levels()['g'], 0)
+        # The tier 1 code of the previous definition is freed
+        self.assertNotIn('g', k.tiering.engines)
+        # A function defined again while compiled at tier 1 keeps its new code
+        k.evaluate('run(10)')
+        compile = k.tiering._compile
+        def redefine(funcname, *args):
+            if funcname == 'g':
+                k.evaluate('def g(x) f(x) * 3')
+            return compile(funcname, *args)
+        k.tiering._compile = redefine
+        self.assertNotIn('g', k.tiering.promote_hot())
+        del k.tiering._compile
+        self.assertEqual(k.evaluate('g(1)'), 9)
+        self.assertNotIn('g', k.tiering.engines)
+        self.assertEqual(k.tiering.levels()['g'], 0)
+
+    def test_import(self):
+        import os, tempfile
+        def write(filename, codestr):
+            with open(os.path.join(tmpdir, filename), 'w') as file:
+                file.write(codestr)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            write('a.kal', '''
+                def binary % 60 (a b) if a < b then a else (a - b) % b
+                def sq(x) x * x
+                def sumsq(n) parfor i = 0, i < n reduce + in sq(i)''')
+            write('b.kal', '''
+                import "a.kal"
+                def binary ~ 5 (a b) a + b
+                def quad(x) sq(sq(x)) % 7''')
+            cachedir = os.path.join(tmpdir, 'cache')
+            cache = UnitCache.shared(cachedir)
+            e = KaleidoscopeEvaluator('basiclib.kal', unit_cache=cachedir)
+            e.evaluate('import "{0}"'.format(os.path.join(tmpdir, 'b.kal')))
+            self.assertEqual((cache.hits, cache.misses, len(os.listdir(cachedir))), (0, 2, 2))
+            # The functions of a.kal are linked, its operators stay its own
+            self.assertEqual(e.evaluate('quad(2) ~ 1'), 3)
+            self.assertEqual([e.evaluate('sq(3)'), e.evaluate('sumsq(4)')], [9, 14])
+            with self.assertRaises(ParseError):
+                e.evaluate('5 % 3')
+            self.assertEqual(list(e.map('sq', [1, 2])), [1, 4])
+            self.assertEqual(e.call('quad', 2), 2)
+            e.evaluate('def f(x) quad(x) ~ sq(x)')
+            self.assertEqual(e.evaluate('f(2)'), 6)
+            # Their functions are shadowed, the units keeping their own
+            e.evaluate('def sq(x) x * x + 1')
+            self.assertEqual([e.evaluate('f(2)'), e.evaluate('quad(2)')], [7, 2])
+
+            # Other evaluators link the cached units, compiled or not
+            k = KaleidoscopeEvaluator('basiclib.kal', unit_cache=cachedir, interpret=False)
+            k.evaluate('import "{0}"'.format(os.path.join(tmpdir, 'b.kal')))
+            self.assertEqual((cache.hits, cache.misses), (2, 2))
+            self.assertEqual(k.evaluate('for i = 0, i < 3 reduce + in quad(i) ~ 1'), 6)
+            self.assertEqual(UnitCache(cachedir).get(k.units[os.path.join(tmpdir, 'a.kal')].key).functions,
+                k.units[os.path.join(tmpdir, 'a.kal')].functions)
+
+            # A change to the code of a file only compiles it again
+            write('a.kal', '''
+                def binary % 60 (a b) if a < b then a else (a - b) % b
+                def sq(x) x * x + 1
+                def sumsq(n) parfor i = 0, i < n reduce + in sq(i)''')
+            k = KaleidoscopeEvaluator('basiclib.kal', unit_cache=cachedir)
+            k.evaluate('import "{0}"'.format(os.path.join(tmpdir, 'b.kal')))
+            self.assertEqual((cache.hits, cache.misses), (3, 3))
+            self.assertEqual(k.evaluate('quad(2) ~ 1'), 6)
+            with self.assertRaises(CodegenError):
+                e.evaluate('import "{0}"'.format(os.path.join(tmpdir, 'b.kal')))
+            # Importing again an unchanged file changes nothing
+            k.evaluate('import "{0}"'.format(os.path.join(tmpdir, 'a.kal')))
+            self.assertEqual(k.evaluate('5 % 3'), 2)
+
+            # The imported functions go in the snapshots
+            filename = os.path.join(tmpdir, 'b.snap')
+            k.evaluate('def sq(x) x')
+            k.save_snapshot(filename)
+            s = KaleidoscopeEvaluator()
+            s.load_snapshot(filename)
+            self.assertEqual([s.evaluate('quad(2) ~ 1'), s.evaluate('sq(3)')], [6, 3])
+
+            # Without a basic library
+            write('c.kal', 'def twice(x) if x < 0 then putchard(45) else x * 2')
+            s = KaleidoscopeEvaluator(unit_cache=cachedir)
+            s.evaluate('def twice(x) x')
+            with self.assertRaises(CodegenError):
+                s.evaluate('import "{0}"'.format(os.path.join(tmpdir, 'c.kal')))
+            s = KaleidoscopeEvaluator(unit_cache=cachedir)
+            s.evaluate('import "{0}"'.format(os.path.join(tmpdir, 'c.kal')))
+            self.assertEqual(s.evaluate('twice(4)'), 8)
+
+            write('d.kal', 'import "e.kal"')
+            write('e.kal', 'import "d.kal"')
+            write('f.kal', 'def g(x) x 1 + 2')
+            write('g.kal', 'import "missing.kal"')
+            with open(os.path.join(tmpdir, 'h.kal'), 'wb') as file:
+                file.write(b'def f(x) \xff')
+            for filename in ['d.kal', 'f.kal', 'missing.kal', 'g.kal', 'h.kal', '.']:
+                with self.assertRaises(CodegenError):
+                    e.evaluate('import "{0}"'.format(os.path.join(tmpdir, filename)))
+            with self.assertRaisesRegex(CodegenError, 'Cannot import: No such file'):
+                e.evaluate('import "{0}"'.format(os.path.join(tmpdir, 'missing.kal')))
+            self.assertEqual(e.evaluate('sq(3)'), 10)
+
 if __name__ == '__main__':
 
     import kal
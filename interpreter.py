@@ -0,0 +1,309 @@
+import math
+from ast import *
+
+# Interpretation of cheap toplevel expressions.
+#
+# JIT-compiling a toplevel expression takes milliseconds, while running
+# something like max(3, 4) takes nanoseconds. The expressions estimated to be
+# cheap are rather turned into a tree of Python closures, which run at once.
+# They call the functions of the session through their native code, so only
+# the expression itself is interpreted. Python floats being IEEE doubles, the
+# results are the ones of the JIT-compiled code. The expressions computing on
+# other types are left to the JIT.
+
+class _Unsupported(Exception):
+    """The expression is left to the JIT, which reports its errors if any."""
+
+class Interpreter(object):
+    """Turns toplevel expressions into closures.
+    budget: highest estimated number of operations of an interpreted
+    expression, loop iterations included.
+    """
+    def __init__(self, budget = 1000):
+        self.budget = budget
+
+    def cost(self, node):
+        """Returns the estimated number of operations run by an expression,
+        calls to functions counting as one, or infinity for the loops whose
+        number of iterations is not known."""
+        if isinstance(node, (Number, Variable)):
+            return 1
+        if isinstance(node, Unary):
+            return 1 + self.cost(node.rhs)
+        if isinstance(node, Binary):
+            return 1 + self.cost(node.lhs) + self.cost(node.rhs)
+        if isinstance(node, Call):
+            return 1 + sum(self.cost(arg) for arg in node.args)
+        if isinstance(node, If):
+            return self.cost(node.cond_expr) + max(self.cost(node.then_expr), self.cost(node.else_expr))
+        if isinstance(node, VarIn):
+            return sum(self.cost(init) for name, init in node.vars if init) + self.cost(node.body)
+        if isinstance(node, For):
+            trips = self._trips(node)
+            iteration = self.cost(node.end_expr) + self.cost(node.body) + (
+                self.cost(node.step_expr) if node.step_expr else 2)
+            return self.cost(node.start_expr) + trips * iteration
+        return math.inf
+
+    def _trips(self, node):
+        """Returns the number of iterations of a loop counting from a number
+        up to a number by a positive number, or infinity."""
+        end, increment = node.end_expr, _increment(node.step_expr, node.id_name)
+        if not (isinstance(node.start_expr, Number) and isinstance(end, Binary) and end.op == '<'
+                and isinstance(end.lhs, Variable) and end.lhs.name == node.id_name
+                and isinstance(end.rhs, Number) and increment > 0):
+            return math.inf
+        # The counter must not be assigned by the loop itself
+        if _assigns(node.body, node.id_name):
+            return math.inf
+        start, stop = float(node.start_expr.val), float(end.rhs.val)
+        return max(0, math.ceil((stop - start) / increment))
+
+    def compile(self, node, resolve):
+        """Returns a function without arguments evaluating an expression, or
+        None when the expression is too costly or can't be interpreted.
+        resolve: returns the ctypes function running the native code of a
+        function given its name, or None."""
+        if self.cost(node) > self.budget:
+            return None
+        compiler = _ClosureCompiler(resolve)
+        try:
+            body = compiler.compile(node, {})
+        except _Unsupported:
+            return None
+        size = compiler.slots
+        return lambda: body([0.0] * size)
+
+def _increment(step, name):
+    """Returns the number added to the counter of a loop by its step, the
+    next value of the counter, or 0 when not a number."""
+    if step is None:
+        return 1.0
+    if isinstance(step, Binary) and step.op == '+':
+        for counter, number in [(step.lhs, step.rhs), (step.rhs, step.lhs)]:
+            if isinstance(counter, Variable) and counter.name == name and isinstance(number, Number):
+                return float(number.val)
+    return 0
+
+def _assigns(node, name):
+    """Whether an expression assigns the given variable."""
+    if isinstance(node, Binary):
+        if node.op == '=' and isinstance(node.lhs, Variable) and node.lhs.name == name:
+            return True
+        return _assigns(node.lhs, name) or _assigns(node.rhs, name)
+    if isinstance(node, Unary):
+        return _assigns(node.rhs, name)
+    if isinstance(node, Call):
+        return any(_assigns(arg, name) for arg in node.args)
+    if isinstance(node, If):
+        return any(_assigns(expr, name) for expr in (node.cond_expr, node.then_expr, node.else_expr))
+    if isinstance(node, For):
+        return any(_assigns(expr, name) for expr in
+            (node.start_expr, node.end_expr, node.step_expr, node.body) if expr)
+    if isinstance(node, VarIn):
+        return any(_assigns(init, name) for var, init in node.vars if init) or \
+            _assigns(node.body, name)
+    return False
+
+def _true(value):
+    """Truth of a condition, as the ordered comparison of the JIT code:
+    NaN is false."""
+    return value != 0.0 and value == value
+
+# Reductions of an accumulated value and a new one. min and max pick the new
+# value when the language's '<' does, NaNs included.
+_REDUCE = {
+    '+': lambda accumulator, value: accumulator + value,
+    '*': lambda accumulator, value: accumulator * value,
+    'min': lambda accumulator, value: accumulator if value >= accumulator else value,
+    'max': lambda accumulator, value: accumulator if accumulator >= value else value,
+}
+
+class _ClosureCompiler(object):
+    """Compiles the nodes of an expression into closures taking the frame
+    of the expression, a list holding its variables."""
+    def __init__(self, resolve):
+        self.resolve = resolve
+        self.slots = 0
+
+    def _slot(self):
+        self.slots += 1
+        return self.slots - 1
+
+    def compile(self, node, scope):
+        """scope: index in the frame of each variable in scope."""
+        method = getattr(self, '_compile_' + node.__class__.__name__, None)
+        if method is None:
+            raise _Unsupported(node)
+        return method(node, scope)
+
+    def _native(self, name, nargs):
+        function = self.resolve(name)
+        if function is None or len(function.argtypes) != nargs:
+            raise _Unsupported(name)
+        return function
+
+    def _compile_Number(self, node, scope):
+        value = float(node.val)
+        return lambda frame: value
+
+    def _compile_Variable(self, node, scope):
+        if node.name not in scope:
+            raise _Unsupported(node.name)
+        index = scope[node.name]
+        return lambda frame: frame[index]
+
+    def _compile_Assignment(self, lhs, rhs, scope):
+        if not isinstance(lhs, Variable) or lhs.name not in scope:
+            raise _Unsupported(lhs)
+        index = scope[lhs.name]
+        value = self.compile(rhs, scope)
+        def assign(frame):
+            frame[index] = result = value(frame)
+            return result
+        return assign
+
+    def _compile_Binary(self, node, scope):
+        if node.op == '=':
+            return self._compile_Assignment(node.lhs, node.rhs, scope)
+        lhs = self.compile(node.lhs, scope)
+        rhs = self.compile(node.rhs, scope)
+        if node.op == '+':
+            return lambda frame: lhs(frame) + rhs(frame)
+        elif node.op == '-':
+            return lambda frame: lhs(frame) - rhs(frame)
+        elif node.op == '*':
+            return lambda frame: lhs(frame) * rhs(frame)
+        elif node.op == '<':
+            # Unordered comparison: true when either operand is NaN
+            def less(frame):
+                a = lhs(frame)
+                return 0.0 if a >= rhs(frame) else 1.0
+            return less
+        function = self._native('binary{0}'.format(node.op), 2)
+        return lambda frame: function(lhs(frame), rhs(frame))
+
+    def _compile_Unary(self, node, scope):
+        operand = self.compile(node.rhs, scope)
+        function = self._native('unary{0}'.format(node.op), 1)
+        return lambda frame: function(operand(frame))
+
+    def _compile_Call(self, node, scope):
+        function = self._native(node.callee, len(node.args))
+        args = [self.compile(arg, scope) for arg in node.args]
+        if not args:
+            return lambda frame: function()
+        if len(args) == 1:
+            arg, = args
+            return lambda frame: function(arg(frame))
+        if len(args) == 2:
+            first, second = args
+            return lambda frame: function(first(frame), second(frame))
+        return lambda frame: function(*[arg(frame) for arg in args])
+
+    def _compile_If(self, node, scope):
+        cond = self.compile(node.cond_expr, scope)
+        then = self.compile(node.then_expr, scope)
+        otherwise = self.compile(node.else_expr, scope)
+        return lambda frame: then(frame) if _true(cond(frame)) else otherwise(frame)
+
+    def _compile_For(self, node, scope):
+        if node.id_type not in (None, DEFAULT_TYPE):
+            raise _Unsupported(node)
+        start = self.compile(node.start_expr, scope)
+        index = self._slot()
+        scope = dict(scope, **{node.id_name: index})
+        end = self.compile(node.end_expr, scope)
+        body = self.compile(node.body, scope)
+        if node.step_expr is None:
+            step = lambda frame: frame[index] + 1.0
+        else:
+            step = self.compile(node.step_expr, scope)
+        if node.reduction:
+            reduce = _REDUCE[node.reduction]
+            identity = REDUCTIONS[node.reduction]
+            def reduction(frame):
+                frame[index] = start(frame)
+                accumulator = identity
+                while _true(end(frame)):
+                    accumulator = reduce(accumulator, body(frame))
+                    frame[index] = step(frame)
+                return accumulator
+            return reduction
+        def loop(frame):
+            frame[index] = start(frame)
+            while _true(end(frame)):
+                body(frame)
+                frame[index] = step(frame)
+            # The 'for' expression returns the last value of the counter
+            return frame[index]
+        return loop
+
+    def _compile_VarIn(self, node, scope):
+        if any(type != DEFAULT_TYPE for type in node.types.values()):
+            raise _Unsupported(node)
+        scope = dict(scope)
+        inits = []
+        for name, init in node.vars:
+            # The initializer can't see the variable it initializes
+            value = self.compile(init, scope) if init is not None else (lambda frame: 0.0)
+            scope[name] = self._slot()
+            inits.append((scope[name], value))
+        body = self.compile(node.body, scope)
+        def bind(frame):
+            for index, value in inits:
+                frame[index] = value(frame)
+            return body(frame)
+        return bind
+
+#---- Some unit tests ----#
+
+import unittest
+
+class TestInterpreter(unittest.TestCase):
+    def _evaluate(self, codestr, natives = {}):
+        from parsing import Parser
+        ast = Parser().parse_toplevel(codestr)
+        closure = Interpreter().compile(ast.body, natives.get)
+        return closure() if closure else None
+
+    def test_semantics(self):
+        nan = float('nan')
+        self.assertEqual(self._evaluate('1 + 2 * 3 - 4'), 3)
+        self.assertEqual(self._evaluate('(1 < 2) + (2 < 1) + (2 < 2)'), 1)
+        self.assertEqual(self._evaluate('if 0 then 1 else 2'), 2)
+        self.assertEqual(self._evaluate('var x = 2, y = x * 3 in y - x'), 4)
+        self.assertEqual(self._evaluate('var a in for i = 0, i < 5 in a = a + i'), 5)
+        self.assertEqual(self._evaluate('var a in (for i = 0, i < 5 in a = a + i) * 0 + a'), 10)
+        self.assertEqual(self._evaluate('for i = 1, i < 10, i + 4 in 0'), 13)
+        # Interpreted loops shadow the variables of the same name
+        self.assertEqual(self._evaluate('var i = 7 in (for i = 0, i < 3 in 0) + i'), 10)
+        self.assertEqual(self._evaluate('for i = 1, i < 5 reduce * in i'), 24)
+        self.assertEqual(self._evaluate('for i = 0, i < 5 reduce max in (i - 2) * (2 - i)'), 0)
+        self.assertEqual(self._evaluate('for i = 0, i < 0 reduce min in i'), float('inf'))
+        self.assertIsNone(self._evaluate('parfor i = 0, i < 5 reduce + in i'))
+
+    def test_natives(self):
+        from ctypes import CFUNCTYPE, c_double
+        natives = {
+            'max': CFUNCTYPE(c_double, c_double, c_double)(max),
+            'binary%': CFUNCTYPE(c_double, c_double, c_double)(lambda a, b: a % b),
+            'unary!': CFUNCTYPE(c_double, c_double)(lambda a: float(not a))}
+        self.assertEqual(self._evaluate('max(3, 4) + !0', natives), 5)
+        # Unknown or mismatched functions and variables are left to the JIT
+        self.assertIsNone(self._evaluate('max(3)', natives))
+        self.assertIsNone(self._evaluate('min(3, 4)', natives))
+        self.assertIsNone(self._evaluate('x + 1', natives))
+        self.assertIsNone(self._evaluate('var x in 2 = x'))
+
+    def test_cost(self):
+        from parsing import Parser
+        def cost(codestr):
+            return Interpreter().cost(Parser().parse_toplevel(codestr).body)
+        self.assertEqual(cost('1 + 2'), 3)
+        self.assertEqual(cost('for i = 0, i < 10 in 1'), 1 + 10 * (3 + 1 + 2))
+        self.assertEqual(cost('for i = 0, i < 10, 5 + i in 1'), 1 + 2 * (3 + 1 + 3))
+        self.assertEqual(cost('for i = 0, i < 10, 5 in 1'), math.inf)
+        self.assertEqual(cost('for i = 0, i < x in 1'), math.inf)
+        self.assertEqual(cost('for i = 0, i < 10 in i = 0'), math.inf)
+        self.assertIsNone(self._evaluate('for i = 0, i < 100000 in 0'))
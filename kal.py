@@ -1,7 +1,8 @@
-from importlib import reload
-import repl
+import sys
+from importlib import import_module, reload
 
 def run(**options):
+    import repl
     while(True):
         try:
             repl.run(options)
@@ -10,6 +11,50 @@ def run(**options):
             reload(repl)
             continue
 
-if __name__ == '__main__':
+def startup_profile(basiclib_file = 'basiclib.kal'):
+    """Print the time spent importing and initializing each component, in the
+    order a session needs them."""
+    from time import perf_counter
+    modules = {}
+    steps = [
+        ('import lexer, parsing', lambda: import_module('parsing')),
+        ('import repl (colorama, termcolor)', lambda: import_module('repl')),
+        ('import llvmlite', lambda: import_module('llvmlite.binding')),
+        ('import codegen', lambda: import_module('codegen')),
+        ('import codexec', lambda: modules.setdefault('codexec', import_module('codexec'))),
+        ('LLVM initialization', lambda: modules['codexec'].initialize_llvm()),
+        ('basic library compilation', lambda: modules['codexec'].SharedLibrary.load(basiclib_file)),
+        ('evaluator creation', lambda: modules.setdefault(
+            'evaluator', modules['codexec'].KaleidoscopeEvaluator(basiclib_file))),
+        ('first expression', lambda: modules['evaluator'].evaluate('0')),
+    ]
+    total = 0
+    for name, step in steps:
+        start = perf_counter()
+        step()
+        elapsed = perf_counter() - start
+        total += elapsed
+        print('{:<36} {:8.1f} ms'.format(name, elapsed * 1000))
+    print('{:<36} {:8.1f} ms'.format('total', total * 1000))
 
+def main():
+    # kal --serve [socket path]: start an evaluation server
+    if sys.argv[1:2] == ['--serve']:
+        import server
+        server.main(sys.argv[2:])
+        return
+    if sys.argv[1:] == ['--startup-profile']:
+        startup_profile()
+        return
+    # One-shot commands go to the server named by $KAL_SERVER, when running
+    if len(sys.argv) >= 2 and not sys.argv[1].startswith(('.', '-')) \
+            and sys.argv[1] not in ['test', 'tests', 'help']:
+        import client
+        status = client.run(' '.join(sys.argv[1:]))
+        if status is not None:
+            sys.exit(status)
     run()
+
+if __name__ == '__main__':
+
+    main()
@@ -9,6 +9,7 @@ class TokenKind(Enum):
     IDENTIFIER = -4
     NUMBER = -5
     OPERATOR = -6
+    STRING = -7
     
     # Keywords are less than -100
     DEF = -101
@@ -21,10 +22,14 @@ class TokenKind(Enum):
     BINARY = -108
     UNARY = -109
     VAR = -110
+    PARFOR = -111
+    IMPORT = -112
 
 
 Token = namedtuple('Token', 'kind value')
 
+class LexError(Exception): pass
+
 def get_keyword(name):
     try:
         kind = TokenKind[name.upper()]
@@ -68,6 +73,17 @@ class Lexer(object):
                     num_str += self.lastchar
                     self._advance()
                 yield Token(kind=TokenKind.NUMBER, value=num_str)
+            # String, up to the closing quote
+            elif self.lastchar == '"':
+                self._advance()
+                str_value = ''
+                while self.lastchar and self.lastchar != '"':
+                    str_value += self.lastchar
+                    self._advance()
+                if not self.lastchar:
+                    raise LexError('Unterminated string: "' + str_value)
+                self._advance()
+                yield Token(kind=TokenKind.STRING, value=str_value)
             # Comment
             elif self.lastchar == '#':
                 self._advance()
@@ -130,6 +146,14 @@ class TestLexer(unittest.TestCase):
             list(l.tokens()),
             ['DEF', 'IDENTIFIER', 'NUMBER', 'EOF'])
 
+    def test_string(self):
+        toks = list(Lexer('import "lib/a b.kal" #"no"\n""').tokens())
+        self._assert_toks(toks, ['IMPORT', 'STRING', 'STRING', 'EOF'])
+        self.assertEqual([tok.value for tok in toks[1:3]], ['lib/a b.kal', ''])
+        for source in ['import "foo', 'import "lib/a.kal" "']:
+            with self.assertRaises(LexError):
+                list(Lexer(source).tokens())
+
 
 #---- Typical example use ----#
 
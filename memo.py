@@ -0,0 +1,145 @@
+import ctypes
+from collections import namedtuple
+
+# Memo tables.
+#
+# A memoized function keeps its results in a hash table of native memory,
+# read and filled by its JIT-compiled code, which is keyed on the bits of its
+# arguments, doubles, so that -0 and 0 are different keys and a NaN is the key
+# of itself. The table is made of 64-bit words: the numbers of hits and misses,
+# then a fixed number of entries of the form
+#
+#   {check, key..., value}
+#
+# The slot of the arguments is given by the high bits of their multiplicative
+# hash, which depend on all of their bits: an entry replaces the one of other
+# arguments at its slot, the older result being evicted. The check word of an
+# entry, which is 0 when empty, hashes its keys and value, so that the threads
+# of the parallel loops filling the table at once never read an entry half
+# written as a hit.
+
+HEADER_WORDS = 2
+HASH_SEED = 0xcbf29ce484222325
+HASH_MULTIPLIER = 0x9e3779b97f4a7c15
+MASK = (1 << 64) - 1
+
+def hash_words(words):
+    """Hashes 64-bit words as the JIT-compiled code does."""
+    h = HASH_SEED
+    for word in words:
+        h = ((h ^ word) * HASH_MULTIPLIER) & MASK
+    return h
+
+def check_word(keys, value):
+    """Returns the check word of an entry, never 0."""
+    return hash_words(list(keys) + [value]) | 1
+
+def _bits(value):
+    return ctypes.c_uint64.from_buffer(ctypes.c_double(value)).value
+
+def _double(bits):
+    return ctypes.c_double.from_buffer(ctypes.c_uint64(bits)).value
+
+class MemoTable(object):
+    """The results kept by a memoized function of nargs arguments, at most
+    capacity of them, rounded up to a power of 2."""
+    def __init__(self, nargs, capacity):
+        self.nargs = nargs
+        self.capacity = 1
+        while self.capacity < capacity:
+            self.capacity <<= 1
+        # Number of low bits of the hashes not in the slots
+        self.shift = 65 - self.capacity.bit_length()
+        self.entry_words = nargs + 2
+        self.words = (ctypes.c_uint64 * (HEADER_WORDS + self.capacity * self.entry_words))()
+        self.address = ctypes.addressof(self.words)
+
+    def slot(self, keys):
+        """Returns the slot of the entry of the given keys."""
+        return hash_words(keys) >> self.shift if self.capacity > 1 else 0
+
+    @property
+    def hits(self):
+        return self.words[0]
+
+    @property
+    def misses(self):
+        return self.words[1]
+
+    def entries(self):
+        """Returns the results kept, as a dictionary from the tuples of
+        arguments to the values."""
+        entries = {}
+        for slot in range(self.capacity):
+            start = HEADER_WORDS + slot * self.entry_words
+            entry = self.words[start:start + self.entry_words]
+            check, keys, value = entry[0], entry[1:-1], entry[-1]
+            if check and check == check_word(keys, value):
+                entries[tuple(_double(key) for key in keys)] = _double(value)
+        return entries
+
+    def __len__(self):
+        return len(self.entries())
+
+    def clear(self):
+        """Forget the results kept, and the numbers of hits and misses."""
+        ctypes.memset(self.address, 0, ctypes.sizeof(self.words))
+
+MemoEntry = namedtuple('MemoEntry', ['name', 'size', 'capacity', 'hits', 'misses'])
+
+class MemoTables(object):
+    """Keeps the tables of the memoized functions of a session."""
+    def __init__(self):
+        self.tables = {}
+
+    def address(self, funcname, nargs, capacity):
+        """Returns the address of a new table for the given function."""
+        table = self.tables[funcname] = MemoTable(nargs, capacity)
+        return table.address
+
+    def discard(self, funcname):
+        del self.tables[funcname]
+
+    def report(self):
+        """Returns a MemoEntry per memoized function, by name."""
+        return [MemoEntry(name, len(table), table.capacity, table.hits, table.misses)
+            for name, table in sorted(self.tables.items())]
+
+    def clear(self):
+        for table in self.tables.values():
+            table.clear()
+
+#---- Some unit tests ----#
+
+import unittest
+
+class TestMemo(unittest.TestCase):
+    def test_table(self):
+        table = MemoTable(2, 5)
+        self.assertEqual(table.capacity, 8)
+        self.assertEqual(len(set(table.slot([_bits(x)]) for x in range(8))), 5)
+        self.assertEqual((len(table), table.hits, table.misses), (0, 0, 0))
+        # Fill an entry as the compiled code does
+        keys, value = [_bits(1.5), _bits(-0.0)], _bits(3.0)
+        slot = table.slot(keys)
+        start = HEADER_WORDS + slot * table.entry_words
+        table.words[start + 1:start + 4] = keys + [value]
+        self.assertEqual(table.entries(), {})
+        table.words[start] = check_word(keys, value)
+        table.words[0] = 2
+        self.assertEqual(table.entries(), {(1.5, -0.0): 3.0})
+        self.assertEqual(table.hits, 2)
+        # A torn entry is no result
+        table.words[start + 3] = _bits(4.0)
+        self.assertEqual(table.entries(), {})
+        table.clear()
+        self.assertEqual((table.words[start], table.hits), (0, 0))
+
+    def test_tables(self):
+        tables = MemoTables()
+        tables.address('f', 1, 16)
+        tables.address('g', 0, 1)
+        self.assertEqual(tables.report(),
+            [MemoEntry('f', 0, 16, 0, 0), MemoEntry('g', 0, 1, 0, 0)])
+        tables.discard('g')
+        self.assertEqual(list(tables.tables), ['f'])
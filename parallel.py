@@ -0,0 +1,184 @@
+import contextvars, ctypes, os, re, threading
+from concurrent.futures import ThreadPoolExecutor
+from ast import *
+
+# Parallel loops.
+#
+# The body of a 'parfor' loop is outlined into a function computing a chunk of
+# the iterations, given their range:
+#
+#   void chunk(double* env, i64 lo, i64 hi, double* partial)
+#
+# env holds the start value of the counter then the variables of the function
+# the body uses, partial gets the reduction of the chunk values if any. The
+# loop itself becomes a call to the runtime, which splits the iterations in as
+# many chunks as it has workers and runs them at once, each on a thread of its
+# own. The runtime is reached by the JIT-compiled code through a symbol of the
+# process.
+
+RUNTIME = 'kal.parallel_for'
+
+ChunkFunction = ctypes.CFUNCTYPE(None,
+    ctypes.c_void_p, ctypes.c_int64, ctypes.c_int64, ctypes.c_void_p)
+RuntimeFunction = ctypes.CFUNCTYPE(ctypes.c_int64,
+    ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int64, ctypes.c_void_p, ctypes.c_int64)
+
+def outlined_name(funcname, index):
+    """Returns the name of the function outlined from the index-th parallel
+    loop of a function."""
+    return '{0}.parfor{1}'.format(funcname, index)
+
+def is_private(funcname):
+    """Whether a function is part of the runtime, named kal.*, or an outlined
+    loop body, which only the code generated calls."""
+    return funcname.startswith('kal.') or re.search(r'\.parfor\d+$', funcname) is not None
+
+def cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def free_variables(node, bound = frozenset()):
+    """Returns the names of the variables an expression uses without binding
+    them itself, and the ones of them it assigns."""
+    used, assigned = set(), set()
+    def visit(node, bound):
+        if isinstance(node, Variable):
+            if node.name not in bound:
+                used.add(node.name)
+        elif isinstance(node, Index):
+            # Storing an element leaves the array variable alone
+            if node.name not in bound:
+                used.add(node.name)
+            visit(node.index, bound)
+        elif isinstance(node, Unary):
+            visit(node.rhs, bound)
+        elif isinstance(node, Binary):
+            if node.op == '=' and isinstance(node.lhs, Variable) and node.lhs.name not in bound:
+                assigned.add(node.lhs.name)
+            visit(node.lhs, bound)
+            visit(node.rhs, bound)
+        elif isinstance(node, Call):
+            for arg in node.args:
+                visit(arg, bound)
+        elif isinstance(node, If):
+            for expr in (node.cond_expr, node.then_expr, node.else_expr):
+                visit(expr, bound)
+        elif isinstance(node, For):
+            visit(node.start_expr, bound)
+            bound = bound | {node.id_name}
+            for expr in (node.end_expr, node.step_expr, node.body):
+                if expr is not None:
+                    visit(expr, bound)
+        elif isinstance(node, VarIn):
+            for name, init in node.vars:
+                if init is not None:
+                    visit(init, bound)
+                bound = bound | {name}
+            visit(node.body, bound)
+    visit(node, frozenset(bound))
+    return used, assigned
+
+class ParallelRuntime(object):
+    """Runs the chunks of the parallel loops on a pool of threads, as many as
+    workers including the calling one. The JIT-compiled code calls it
+    through the ctypes function at address. The chunks being native code,
+    the threads run them at once, without the GIL.
+    """
+    def __init__(self, workers = None):
+        self.workers = workers or cpu_count()
+        self.function = RuntimeFunction(self.run)
+        self.address = ctypes.cast(self.function, ctypes.c_void_p).value
+        self._pool = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._chunks = {}
+        if hasattr(os, 'register_at_fork'):
+            # The threads of the pool don't survive a fork
+            os.register_at_fork(after_in_child=self._forget_pool)
+
+    def _forget_pool(self):
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.workers - 1)
+            return self._pool
+
+    def run(self, chunk, env, trips, partials, capacity):
+        """Runs the iterations 0 to trips - 1 of the chunk function at the
+        address chunk. Returns the number of chunks, at most capacity, whose
+        partial results were stored in the partials array."""
+        if trips <= 0:
+            return 0
+        function = self._chunks.get(chunk)
+        if function is None:
+            function = self._chunks[chunk] = ChunkFunction(chunk)
+        count = min(trips, capacity, self.workers)
+        if count == 1 or getattr(self._local, 'running', False):
+            # The loops nested in a parallel one run on its threads
+            self._run_chunk(function, env, 0, trips, partials)
+            return 1
+        bounds = [trips * k // count for k in range(count + 1)]
+        size = ctypes.sizeof(ctypes.c_double)
+        # Each chunk runs in a copy of the context of the caller, whose
+        # variables tell where to report the indexes out of bounds
+        futures = [self.pool().submit(contextvars.copy_context().run, self._run_chunk,
+                function, env, bounds[k], bounds[k + 1], partials + k * size)
+            for k in range(1, count)]
+        self._run_chunk(function, env, bounds[0], bounds[1], partials)
+        for future in futures:
+            future.result()
+        return count
+
+    def _run_chunk(self, function, env, lo, hi, partial):
+        running = getattr(self._local, 'running', False)
+        self._local.running = True
+        try:
+            function(env, lo, hi, partial)
+        finally:
+            self._local.running = running
+
+_runtime = None
+_runtime_lock = threading.Lock()
+
+def runtime():
+    """Returns the runtime of the process."""
+    global _runtime
+    with _runtime_lock:
+        if _runtime is None:
+            _runtime = ParallelRuntime()
+        return _runtime
+
+#---- Some unit tests ----#
+
+import unittest
+
+class TestParallel(unittest.TestCase):
+    def test_free_variables(self):
+        from parsing import Parser
+        def free(codestr):
+            return free_variables(Parser().parse_toplevel(codestr).body)
+        self.assertEqual(free('a + b'), ({'a', 'b'}, set()))
+        self.assertEqual(free('var x = a in x = b'), ({'a', 'b'}, set()))
+        self.assertEqual(free('for i = 0, i < n in s = s + i'), ({'n', 's'}, {'s'}))
+        self.assertEqual(free('for i = 0, i < n in xs[i] = k'), ({'n', 'xs', 'k'}, set()))
+
+    def test_runtime(self):
+        hits = (ctypes.c_double * 100)()
+        @ChunkFunction
+        def chunk(env, lo, hi, partial):
+            for i in range(lo, hi):
+                hits[i] += 1
+            ctypes.c_double.from_address(partial).value = hi - lo
+        partials = (ctypes.c_double * 4)()
+        runtime = ParallelRuntime(3)
+        address = ctypes.cast(chunk, ctypes.c_void_p).value
+        count = runtime.run(address, None, 100, ctypes.addressof(partials), 4)
+        self.assertEqual(count, 3)
+        self.assertEqual(list(partials[:3]), [33, 33, 34])
+        self.assertEqual(set(hits), {1})
+        self.assertEqual(runtime.run(address, None, 0, ctypes.addressof(partials), 4), 0)
@@ -1,6 +1,7 @@
 from lexer import *
 from ast import *
-from collections import namedtuple
+from arrays import ELEMENT_TYPES, array_type
+from collections import ChainMap, namedtuple
 
 @unique
 class Associativity(Enum):
@@ -22,20 +23,36 @@ FALSE_BINOP_INFO = BinOpInfo(-1, Associativity.UNDEFINED)
 def builtin_operators():
     return sorted(BUILTIN_OP.keys())  
 
-_binop_map = dict(BUILTIN_OP)
+def operator_table(base = BUILTIN_OP):
+    """Returns a new precedence table layered on top of base, which is never
+    modified: the operators defined with it only land in the new table."""
+    return ChainMap({}, base)
 
-def binop_info(tok):
+# Precedence table of the parsers not given their own
+_binop_map = operator_table()
+
+def user_operators(operators = None):
+    """Returns the operators defined in code, with their BinOpInfo"""
+    if operators is None:
+        operators = _binop_map
+    return {op: info for op, info in operators.items() if op not in BUILTIN_OP}
+
+def binop_info(tok, operators = None):
+    if operators is None:
+        operators = _binop_map
     kind, value = tok
     try:
-        return _binop_map[value] 
+        return operators[value] 
     except KeyError:
         if kind == TokenKind.OPERATOR and value not in Parser.PUNCTUATORS:
             raise ParseError("Undefined operator: " + value)
         # Return a false binop info that has no precedence    
         return FALSE_BINOP_INFO
 
-def set_binop_info(op, precedence, associativity):
-    _binop_map[op] = BinOpInfo(precedence, associativity)
+def set_binop_info(op, precedence, associativity, operators = None):
+    if operators is None:
+        operators = _binop_map
+    operators[op] = BinOpInfo(precedence, associativity)
 
 
 class ParseError(Exception): pass
@@ -44,12 +61,15 @@ class Parser(object):
     """Parser for the Kaleidoscope language.
     After the parser is created, invoke parse_toplevel multiple times to parse
     Kaleidoscope source into an AST.
+    The operators defined in the parsed code are added to the given precedence
+    table, or to a table shared by all such parsers if none is given.
     """
-    def __init__(self):
+    def __init__(self, operators = None):
+        self.operators = _binop_map if operators is None else operators
         self.token_generator = None
         self.cur_tok = None
 
-    # toplevel ::= definition | external | expression
+    # toplevel ::= definition | external | import | expression
     def parse_toplevel(self, buf):
         return next(self.parse_generator(buf))
 
@@ -64,11 +84,16 @@ class Parser(object):
                 yield self._parse_external()
             elif self.cur_tok.kind == TokenKind.DEF:
                 yield self._parse_definition()
+            elif self.cur_tok.kind == TokenKind.IMPORT:
+                yield self._parse_import()
             else:
                 yield self._parse_toplevel_expression()
 
     def _get_next_token(self):
-        self.cur_tok = next(self.token_generator)
+        try:
+            self.cur_tok = next(self.token_generator)
+        except LexError as err:
+            raise ParseError(str(err))
 
     def _match(self, expected_kind, expected_value=None):
         """Consume the current token; verify that it's of the expected kind.
@@ -87,12 +112,42 @@ class Parser(object):
         return (self.cur_tok.kind == TokenKind.OPERATOR and
                 self.cur_tok.value == op)
 
+    # annotation ::= (':' type)?
+    # type ::= scalar | element '[' ']'
+    # scalar ::= 'f64' | 'f32' | 'i64' | 'bool' | 'i1'
+    # element ::= 'f64' | 'f32' | 'i64' | 'u8'
+    def _parse_annotation(self):
+        """Parse an optional type annotation. Returns the type, or None."""
+        if not self._cur_tok_is_operator(':'):
+            return None
+        self._get_next_token()  # consume the ':'
+        type = TYPE_ALIASES.get(self.cur_tok.value, self.cur_tok.value)
+        if self.cur_tok.kind != TokenKind.IDENTIFIER or type not in TYPES + ELEMENT_TYPES:
+            raise ParseError('Expected a type but got "{0}"'.format(self.cur_tok.value))
+        self._get_next_token()
+        if self._cur_tok_is_operator('['):
+            self._get_next_token()
+            self._match(TokenKind.OPERATOR, ']')
+            if type not in ELEMENT_TYPES:
+                raise ParseError('No arrays of ' + type)
+            return array_type(type)
+        if type not in TYPES:
+            raise ParseError('Expected "[" after ' + type)
+        return type
+
     # identifierexpr
     #   ::= identifier
     #   ::= identifier '(' expression* ')'
+    #   ::= identifier '[' expression ']'
     def _parse_identifier_expr(self):
         id_name = self.cur_tok.value
         self._get_next_token()
+        # If followed by a '[' it's an array element
+        if self._cur_tok_is_operator('['):
+            self._get_next_token()
+            index = self._parse_expression()
+            self._match(TokenKind.OPERATOR, ']')
+            return Index(id_name, index)
         # If followed by a '(' it's a call; otherwise, a simple variable ref.
         if not self._cur_tok_is_operator('('):
             return Variable(id_name)
@@ -141,7 +196,7 @@ class Parser(object):
             return self._parse_paren_expr()
         elif self.cur_tok.kind == TokenKind.IF:
             return self._parse_if_expr()
-        elif self.cur_tok.kind == TokenKind.FOR:
+        elif self.cur_tok.kind in (TokenKind.FOR, TokenKind.PARFOR):
             return self._parse_for_expr()
         elif self.cur_tok.kind == TokenKind.VAR:
             return self._parse_var_expr()            
@@ -164,11 +219,15 @@ class Parser(object):
         else_expr = self._parse_expression()
         return If(cond_expr, then_expr, else_expr)
 
-    # forexpr ::= 'for' identifier '=' expr ',' expr (',' expr)? 'in' expr
+    # forexpr ::= ('for' | 'parfor') identifier annotation '=' expr ',' expr (',' expr)?
+    #                 ('reduce' reduction)? 'in' expr
+    # reduction ::= '+' | '*' | 'min' | 'max'
     def _parse_for_expr(self):
+        parallel = self.cur_tok.kind == TokenKind.PARFOR
         self._get_next_token()  # consume the 'for'
         id_name = self.cur_tok.value
         self._match(TokenKind.IDENTIFIER)
+        id_type = self._parse_annotation()
         self._match(TokenKind.OPERATOR, '=')
         start_expr = self._parse_expression()
         self._match(TokenKind.OPERATOR, ',')
@@ -180,14 +239,26 @@ class Parser(object):
             step_expr = self._parse_expression()
         else:
             step_expr = None
+
+        # So is the reduction of the body values
+        reduction = None
+        if self.cur_tok.kind == TokenKind.IDENTIFIER and self.cur_tok.value == 'reduce':
+            self._get_next_token()
+            reduction = self.cur_tok.value
+            if reduction not in REDUCTIONS:
+                raise ParseError('Expected a reduction operator but got "{0}"'.format(reduction))
+            self._get_next_token()
         self._match(TokenKind.IN)
         body = self._parse_expression()
-        return For(id_name, start_expr, end_expr, step_expr, body)
+        if parallel:
+            return ParFor(id_name, start_expr, end_expr, step_expr, body, reduction, id_type)
+        return For(id_name, start_expr, end_expr, step_expr, body, reduction, id_type)
 
-    # varexpr ::= 'var' ( identifier ('=' expr)? )+ 'in' expr
+    # varexpr ::= 'var' ( identifier annotation ('=' expr)? )+ 'in' expr
     def _parse_var_expr(self):
         self._get_next_token()  # consume the 'var'
         vars = []
+        types = {}
 
         # At least one variable name is required
         if self.cur_tok.kind != TokenKind.IDENTIFIER:
@@ -196,6 +267,9 @@ class Parser(object):
         while self.cur_tok.kind != TokenKind.IN:
             name = self.cur_tok.value
             self._get_next_token()  # consume the identifier
+            type = self._parse_annotation()
+            if type:
+                types[name] = type
 
             # Parse the optional initializer
             if self._cur_tok_is_operator('='):
@@ -207,7 +281,7 @@ class Parser(object):
 
         self._match(TokenKind.IN)
         body = self._parse_expression()
-        return VarIn(vars, body)
+        return VarIn(vars, body, types)
 
     # binoprhs ::= (<binop> primary)*
     def _parse_binop_rhs(self, expr_prec, lhs):
@@ -216,7 +290,7 @@ class Parser(object):
         lhs: AST of the left-hand-side.
         """
         while True:
-            cur_prec, cur_assoc = binop_info(self.cur_tok)
+            cur_prec, cur_assoc = binop_info(self.cur_tok, self.operators)
             # If this is a binary operator with precedence lower than the
             # currently parsed sub-expression, bail out. If it binds at least
             # as tightly, keep going.
@@ -228,7 +302,7 @@ class Parser(object):
             self._get_next_token()  # consume the operator
             rhs = self._parse_primary()
 
-            next_prec, next_assoc = binop_info(self.cur_tok)
+            next_prec, next_assoc = binop_info(self.cur_tok, self.operators)
             # There are four options:
             # 1. next_prec > cur_prec: we need to make a recursive call
             # 2. next_prec == cur_prec and operator is left-associative: 
@@ -262,12 +336,16 @@ class Parser(object):
         return Unary(op, rhs) 
 
     # prototype
-    #   ::= id '(' id* ')'
-    #   ::= 'binary' LETTER number? '(' id id ')'
-    #   ::= 'unary' LETTER '(' id id ')'    
-    def _parse_prototype(self):
+    #   ::= id '(' (id annotation)* ')' annotation
+    #   ::= 'binary' LETTER number? '(' id annotation id annotation ')' annotation
+    #   ::= 'unary' LETTER '(' id annotation ')' annotation
+    def _parse_prototype(self, name = None):
+        """Parse a prototype, whose name may already have been consumed."""
         prec = DEFAULT_PREC 
-        if self.cur_tok.kind == TokenKind.IDENTIFIER:
+        if name:
+            # Already consumed by the caller
+            pass
+        elif self.cur_tok.kind == TokenKind.IDENTIFIER:
             name = self.cur_tok.value
             self._get_next_token()
         elif self.cur_tok.kind == TokenKind.UNARY:
@@ -292,34 +370,60 @@ class Parser(object):
 
             # Add the new operator to our precedence table so we can properly
             # parse it.
-            set_binop_info(name[-1], prec, Associativity.LEFT)
+            set_binop_info(name[-1], prec, Associativity.LEFT, self.operators)
 
         self._match(TokenKind.OPERATOR, '(')
         argnames = []
+        argtypes = []
         while self.cur_tok.kind == TokenKind.IDENTIFIER:
             argnames.append(self.cur_tok.value)
             self._get_next_token()
+            argtypes.append(self._parse_annotation() or DEFAULT_TYPE)
         self._match(TokenKind.OPERATOR, ')')
+        return_type = self._parse_annotation()
 
         if name.startswith('binary') and len(argnames) != 2:
             raise ParseError('Expected binary operator to have 2 operands')
         elif name.startswith('unary') and len(argnames) != 1:
             raise ParseError('Expected unary operator to have one operand')
 
-        return Prototype(
-            name, argnames, name.startswith(('unary', 'binary')), prec)
+        return Prototype(name, argnames, name.startswith(('unary', 'binary')), prec,
+            argtypes, return_type)
 
     # external ::= 'extern' prototype
     def _parse_external(self):
         self._get_next_token()  # consume 'extern'
         return self._parse_prototype()
 
-    # definition ::= 'def' prototype expression
+    # definition ::= 'def' ('memo' number?)? prototype expression
     def _parse_definition(self):
         self._get_next_token()  # consume 'def'
-        proto = self._parse_prototype()
+        memo = None
+        name = None
+        if self.cur_tok.kind == TokenKind.IDENTIFIER and self.cur_tok.value == 'memo':
+            self._get_next_token()
+            # 'memo' is only an attribute before a prototype
+            if self._cur_tok_is_operator('('):
+                name = 'memo'
+            else:
+                memo = DEFAULT_MEMO_CAPACITY
+                if self.cur_tok.kind == TokenKind.NUMBER:
+                    memo = int(float(self.cur_tok.value))
+                    if not (0 < memo <= 1 << 24):
+                        raise ParseError('Invalid memo capacity', memo)
+                    self._get_next_token()
+        proto = self._parse_prototype(name)
         expr = self._parse_expression()
-        return Function(proto, expr)
+        return Function(proto, expr, memo)
+
+    # import ::= 'import' string
+    def _parse_import(self):
+        self._get_next_token()  # consume 'import'
+        if self.cur_tok.kind != TokenKind.STRING:
+            raise ParseError('Expected a file name after "import"')
+        path = self.cur_tok.value
+        self._get_next_token()
+        return Import(path)
 
     # toplevel ::= expression
     def _parse_toplevel_expression(self):
@@ -454,6 +558,101 @@ class TestParser(unittest.TestCase):
                     ['Variable', 'y'],
                     ['Binary', '+', ['Number', '10'], ['Number', '5']]]])
 
+    def test_operator_tables(self):
+        base = operator_table()
+        Parser(base).parse_toplevel('def binary~ 70(a b) a - b')
+        p1 = Parser(operator_table(base))
+        p2 = Parser(operator_table(base))
+        p1.parse_toplevel('def binary@ 50(a b) a + b')
+        # Operators defined by a parser stay in its own table
+        self.assertEqual(sorted(user_operators(p1.operators)), ['@', '~'])
+        self.assertEqual(sorted(user_operators(p2.operators)), ['~'])
+        with self.assertRaises(ParseError):
+            p2.parse_toplevel('1 @ 2')
+        self._assert_body(p2.parse_toplevel('1 + 2 ~ 3'),
+            ['Binary', '+',
+                ['Number', '1'],
+                ['Binary', '~', ['Number', '2'], ['Number', '3']]])
+
+    def test_parfor(self):
+        ast = Parser().parse_toplevel('parfor i = 0, i < n reduce max in i * i')
+        self.assertIsInstance(ast.body, ParFor)
+        self._assert_body(ast,
+            ['ParFor', 'i',
+                ['Number', '0'],
+                ['Binary', '<', ['Variable', 'i'], ['Variable', 'n']],
+                ['No step'],
+                ['Binary', '*', ['Variable', 'i'], ['Variable', 'i']],
+                'reduce', 'max'])
+        self.assertIsNone(Parser().parse_toplevel('parfor i = 0, i < n in i').body.reduction)
+        with self.assertRaises(ParseError):
+            Parser().parse_toplevel('parfor i = 0, i < n reduce - in i')
+
+    def test_reduction(self):
+        ast = Parser().parse_toplevel('for i = 0, i < n, i + 2 reduce + in i')
+        self.assertNotIsInstance(ast.body, ParFor)
+        self._assert_body(ast,
+            ['For', 'i',
+                ['Number', '0'],
+                ['Binary', '<', ['Variable', 'i'], ['Variable', 'n']],
+                ['Binary', '+', ['Variable', 'i'], ['Number', '2']],
+                ['Variable', 'i'],
+                'reduce', '+'])
+        # 'reduce' is only a keyword after the loop bounds
+        self._assert_body(Parser().parse_toplevel('reduce + 1'),
+            ['Binary', '+', ['Variable', 'reduce'], ['Number', '1']])
+
+    def test_annotations(self):
+        ast = Parser().parse_toplevel('def count(n: i64 x) : f32 var k: i1 = 1 s in x')
+        self.assertEqual(ast.proto.argtypes, ['i64', 'f64'])
+        self.assertEqual(ast.proto.return_type, 'f32')
+        self.assertTrue(ast.proto.is_typed())
+        self.assertEqual(ast.proto.flatten(), ['Prototype', 'count', '(n:i64 x)', ':f32'])
+        self._assert_body(ast,
+            ['VarIn', [['k:bool', ['Number', '1']], ['s', None]], ['Variable', 'x']])
+        ast = Parser().parse_toplevel('for i: i64 = 0, i < n in i')
+        self.assertEqual(ast.body.id_type, 'i64')
+        self.assertEqual(ast.body.flatten()[1], 'i:i64')
+        self.assertFalse(Parser().parse_toplevel('def f(x: f64) x').proto.is_typed())
+        with self.assertRaises(ParseError):
+            Parser().parse_toplevel('def f(x: int) x')
+
+    def test_arrays(self):
+        ast = Parser().parse_toplevel('def scale(xs: f64[] k) xs[i + 1] = xs[0] * k')
+        self.assertEqual(ast.proto.argtypes, ['f64[]', 'f64'])
+        self._assert_body(ast,
+            ['Binary', '=',
+                ['Index', 'xs', ['Binary', '+', ['Variable', 'i'], ['Number', '1']]],
+                ['Binary', '*', ['Index', 'xs', ['Number', '0']], ['Variable', 'k']]])
+        self.assertEqual(Parser().parse_toplevel('extern f(b: u8[])').argtypes, ['u8[]'])
+        for code in ['def f(x: bool[]) x', 'def f(x: u8) x', 'def f(x: f64[) x', 'xs[1']:
+            with self.assertRaises(ParseError):
+                Parser().parse_toplevel(code)
+
+    def test_memo(self):
+        ast = Parser().parse_toplevel('def memo fib(n) if n < 2 then n else fib(n - 1) + fib(n - 2)')
+        self.assertEqual(ast.proto.name, 'fib')
+        self.assertEqual(ast.memo, DEFAULT_MEMO_CAPACITY)
+        self.assertEqual(ast.flatten()[-1], ['memo', DEFAULT_MEMO_CAPACITY])
+        ast = Parser().parse_toplevel('def memo 100 binary% 77 (a b) a - b')
+        self.assertEqual((ast.memo, ast.proto.name, ast.proto.prec), (100, 'binary%', 77))
+        # 'memo' is only an attribute before a prototype
+        ast = Parser().parse_toplevel('def memo(x) x')
+        self.assertEqual((ast.memo, ast.proto.name), (None, 'memo'))
+        self.assertEqual(len(ast.flatten()), 3)
+        for code in ['def memo 0 f(x) x', 'def memo memo f(x) x']:
+            with self.assertRaises(ParseError):
+                Parser().parse_toplevel(code)
+
+    def test_import(self):
+        asts = list(Parser().parse_generator('import "lib.kal" f(1)'))
+        self.assertIsInstance(asts[0], Import)
+        self.assertEqual(asts[0].flatten(), ['Import', 'lib.kal'])
+        self._assert_body(asts[1], ['Call', 'f', [['Number', '1']]])
+        for code in ['import lib', 'import "lib.kal']:
+            with self.assertRaises(ParseError):
+                Parser().parse_toplevel(code)
+
 #---- Typical example use ----#
 
 if __name__ == '__main__':
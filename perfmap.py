@@ -0,0 +1,181 @@
+import ctypes, mmap, os, platform, struct, tempfile, threading, time, weakref
+
+# Descriptions of the JIT-compiled functions for the linux perf tool.
+#
+# A perf map (/tmp/perf-<pid>.map) only gives the name of each code range, and
+# is read by perf report as is. A jitdump file (jit-<pid>.dump) also keeps a
+# copy of the code: once recorded with `perf record -k mono`, the samples are
+# turned into symbolized ones by `perf inject --jit`.
+
+def function_sizes(buffer):
+    """Returns the size of each function defined in an object file, given as
+    bytes. Only 64 bits little endian ELF objects are read, others give an
+    empty dict."""
+    if buffer[:4] != b'\x7fELF' or buffer[4:6] != b'\x02\x01':
+        return {}
+    shoff, = struct.unpack_from('<Q', buffer, 0x28)
+    shentsize, shnum = struct.unpack_from('<HH', buffer, 0x3A)
+    # name, type, flags, addr, offset, size, link, info, addralign, entsize
+    sections = [struct.unpack_from('<IIQQQQIIQQ', buffer, shoff + i * shentsize)
+        for i in range(shnum)]
+    sizes = {}
+    for section in sections:
+        if section[1] != 2:     # SHT_SYMTAB
+            continue
+        offset, size, link, entsize = section[4], section[5], section[6], section[9]
+        strings = sections[link][4]
+        for pos in range(offset, offset + size, entsize):
+            name, info, other, shndx, value, symsize = struct.unpack_from('<IBBHQQ', buffer, pos)
+            if info & 0xf == 2:     # STT_FUNC
+                start = strings + name
+                sizes[buffer[start:buffer.index(b'\0', start)].decode()] = symsize
+    return sizes
+
+class PerfMap(object):
+    """Appends a line per function to a perf map file."""
+    def __init__(self, path = None):
+        self.path = path or '/tmp/perf-{0}.map'.format(os.getpid())
+        self.file = open(self.path, 'a')
+
+    def write(self, name, address, size):
+        self.file.write('{0:x} {1:x} {2}\n'.format(address, size, name))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+# ELF machine of the host, for the jitdump header
+_ELF_MACHINES = {'x86_64': 62, 'amd64': 62, 'aarch64': 183, 'arm64': 183, 'i386': 3, 'i686': 3}
+
+class JitDump(object):
+    """Writes a jitdump file, with a code load record per function."""
+    MAGIC = 0x4A695444
+    VERSION = 1
+    CODE_LOAD = 0
+
+    def __init__(self, directory = None):
+        self.path = os.path.join(
+            directory or tempfile.gettempdir(), 'jit-{0}.dump'.format(os.getpid()))
+        self.file = open(self.path, 'w+b')
+        self.index = 0
+        header = struct.pack('<IIIIIIQQ', self.MAGIC, self.VERSION, 40,
+            _ELF_MACHINES.get(platform.machine().lower(), 0), 0, os.getpid(), self._timestamp(), 0)
+        self.file.write(header)
+        self.file.flush()
+        # perf record finds the file through an executable mapping of it
+        self.marker = mmap.mmap(self.file.fileno(), len(header),
+            flags=mmap.MAP_PRIVATE, prot=mmap.PROT_READ | mmap.PROT_EXEC)
+
+    def _timestamp(self):
+        return time.clock_gettime_ns(time.CLOCK_MONOTONIC)
+
+    def write(self, name, address, size):
+        name = name.encode() + b'\0'
+        code = ctypes.string_at(address, size)
+        record = struct.pack('<IIQ', self.CODE_LOAD, 56 + len(name) + size, self._timestamp())
+        record += struct.pack('<IIQQQQ', os.getpid(), threading.get_native_id(),
+            address, address, size, self.index)
+        self.file.write(record + name + code)
+        self.file.flush()
+        self.index += 1
+
+    def close(self):
+        self.marker.close()
+        self.file.close()
+
+# Writers in use, which are closed once no evaluator holds them
+_writers = weakref.WeakValueDictionary()
+_lock = threading.Lock()
+
+def writer(cls, location = None):
+    """Returns the writer of the given class and location of the process,
+    shared by all its evaluators."""
+    key = (cls, location, os.getpid())
+    with _lock:
+        reporter = _writers.get(key)
+        if reporter is None:
+            output = cls(location)
+            reporter = _writers[key] = _Reporter(output)
+            weakref.finalize(reporter, output.close)
+        return reporter
+
+class _Reporter(object):
+    """Writes each function once, whatever the number of evaluators
+    reporting it, until its code is released."""
+    def __init__(self, output):
+        self.output = output
+        self.reported = set()
+        self.lock = threading.Lock()
+
+    def report(self, name, address, size):
+        with self.lock:
+            if (name, address) not in self.reported:
+                self.reported.add((name, address))
+                self.output.write(name, address, size)
+
+    def release(self, name, address):
+        """Forget a function whose code was freed, so that new code placed
+        at its address is written again."""
+        with self.lock:
+            self.reported.discard((name, address))
+
+#---- Some unit tests ----#
+
+import unittest
+
+class TestPerfMap(unittest.TestCase):
+    def test_function_sizes(self):
+        import llvmlite.binding as llvm
+        llvm.initialize()
+        llvm.initialize_native_target()
+        llvm.initialize_native_asmprinter()
+        llvmmod = llvm.parse_assembly('''
+            define double @"binary:"(double %a, double %b) {
+              ret double %b
+            }
+            define double @sq(double %a) {
+              %r = fmul double %a, %a
+              ret double %r
+            }''')
+        buffers = []
+        with llvm.create_mcjit_compiler(
+                llvmmod, llvm.Target.from_default_triple().create_target_machine()) as ee:
+            ee.set_object_cache(lambda module, buffer: buffers.append(buffer))
+            ee.finalize_object()
+        sizes = function_sizes(buffers[0])
+        self.assertEqual(set(sizes), {'binary:', 'sq'})
+        self.assertTrue(all(size > 0 for size in sizes.values()))
+        self.assertEqual(function_sizes(b'not an object'), {})
+
+    def test_jitdump(self):
+        code = ctypes.create_string_buffer(b'\x90\x90\xc3')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dump = JitDump(tmpdir)
+            dump.write('binary:', ctypes.addressof(code), 3)
+            dump.close()
+            with open(dump.path, 'rb') as file:
+                data = file.read()
+        magic, version, size = struct.unpack_from('<III', data)
+        self.assertEqual((magic, version, size), (JitDump.MAGIC, 1, 40))
+        kind, size = struct.unpack_from('<II', data, 40)
+        self.assertEqual((kind, size, len(data)), (JitDump.CODE_LOAD, 56 + 8 + 3, 40 + size))
+        self.assertEqual(data[40 + 56:], b'binary:\0\x90\x90\xc3')
+
+    def test_writers(self):
+        import gc
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'perf.map')
+            reporter = writer(PerfMap, path)
+            self.assertIs(writer(PerfMap, path), reporter)
+            reporter.report('f', 16, 4)
+            reporter.report('f', 16, 4)
+            reporter.release('f', 16)
+            reporter.report('f', 16, 4)
+            output = reporter.output
+            del reporter
+            gc.collect()
+            # Closed once unused
+            self.assertTrue(output.file.closed)
+            self.assertNotIn((PerfMap, path, os.getpid()), _writers)
+            with open(path) as file:
+                self.assertEqual(file.read(), '10 4 f\n' * 2)
@@ -0,0 +1,42 @@
+import ctypes
+from collections import namedtuple
+
+class ProfileCounters(ctypes.Structure):
+    """Counters of a profiled function, updated by its JIT-compiled code: the
+    number of calls, of loop iterations, and of processor cycles spent in the
+    function and its callees. The depth of recursion at which the function is
+    running keeps the cycles of recursive calls from being counted twice."""
+    _fields_ = [
+        ('calls', ctypes.c_uint64),
+        ('trips', ctypes.c_uint64),
+        ('cycles', ctypes.c_uint64),
+        ('depth', ctypes.c_uint64)]
+
+ProfileEntry = namedtuple('ProfileEntry', ['name', 'calls', 'trips', 'cycles'])
+
+class Profiler(object):
+    """Keeps the counters of the profiled functions of a session.
+    cycles: whether the profiled functions read the processor cycle counter.
+    """
+    def __init__(self, cycles = True):
+        self.cycles = cycles
+        self.counters = {}
+
+    def address(self, funcname):
+        """Returns the address of new counters for the given function."""
+        counters = self.counters[funcname] = ProfileCounters()
+        return ctypes.addressof(counters)
+
+    def discard(self, funcname):
+        del self.counters[funcname]
+
+    def report(self):
+        """Returns a ProfileEntry per function called, the most time consuming
+        first, or the most called without cycle counts."""
+        entries = [ProfileEntry(name, counters.calls, counters.trips, counters.cycles)
+            for name, counters in self.counters.items() if counters.calls]
+        return sorted(entries, key=lambda entry: (entry.cycles, entry.calls), reverse=True)
+
+    def clear(self):
+        for counters in self.counters.values():
+            counters.calls = counters.trips = counters.cycles = 0
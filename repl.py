@@ -1,8 +1,100 @@
-import copy, colorama, llvmlite, sys
+import copy, colorama, os, sys, threading
 from importlib import reload
 from termcolor import colored, cprint
 colorama.init()
-import lexer, parsing, codegen, codexec
+import lexer, parsing
+
+# The modules needing LLVM are only imported by the commands using them
+COMPILER_MODULES = ['codegen', 'snapshot', 'codexec']
+
+def import_compiler():
+    global codegen, snapshot, codexec
+    import codegen, snapshot, codexec
+
+# Errors of each backend after which its evaluator goes on as is
+EVAL_ERRORS = {'codegen': 'CodegenError', 'bytecode': 'BytecodeError'}
+
+def eval_errors():
+    return tuple(getattr(sys.modules[name], error)
+        for name, error in EVAL_ERRORS.items() if name in sys.modules)
+
+# Commands only available with the JIT backend
+JIT_COMMANDS = ['functions', 'memory', 'compact', 'save', 'load', 'tiers', 'memo']
+
+class LazyEvaluator(object):
+    """Stands for the evaluator until a command needs it, so that LLVM and
+    the basic library are only loaded by the commands using them.
+    The evaluator can also be loaded in the background, with start(): the
+    first command needing it then only waits for what is left to do."""
+    def __init__(self, basiclib_file):
+        self.basiclib_file = basiclib_file
+        # KAL_BACKEND=vm runs the code with the bytecode interpreter, without LLVM
+        self.backend = os.environ.get('KAL_BACKEND', 'jit')
+        self.evaluator = None
+        self.parse_operators = None
+        self.thread = None
+        self.error = None
+
+    def _create(self):
+        if self.backend == 'vm':
+            global bytecode
+            import bytecode
+            return bytecode.BytecodeEvaluator(self.basiclib_file)
+        import_compiler()
+        # KAL_PERF=map,jitdump describes the JIT-compiled code to linux perf
+        perf = os.environ.get('KAL_PERF', '').split(',')
+        # KAL_TIERED=<calls> recompiles the functions called that often
+        tiered = os.environ.get('KAL_TIERED', '')
+        # KAL_FASTMATH=fast or KAL_FASTMATH=<flag>,... selects fast-math flags
+        # KAL_UNIT_CACHE=<directory> keeps the compiled imported files there
+        return codexec.KaleidoscopeEvaluator(
+            self.basiclib_file, perf_map='map' in perf, jitdump='jitdump' in perf,
+            tiered=bool(tiered), hot_threshold=int(tiered) if tiered.isdigit() else 1000,
+            fastmath=os.environ.get('KAL_FASTMATH', ''),
+            unit_cache=os.environ.get('KAL_UNIT_CACHE') or None)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._warm_up, daemon=True)
+        self.thread.start()
+
+    def _warm_up(self):
+        try:
+            k = self._create()
+            # Have the backend compile and run an expression before the
+            # first command does
+            k.evaluate('0')
+            self.evaluator = k
+        except Exception as err:
+            # Raised by the first command needing the evaluator
+            self.error = err
+
+    def load(self):
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+        if self.evaluator is None:
+            self.evaluator = self._create()
+        return self.evaluator
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def parse_generator(self, code):
+        """Parse code, without loading the evaluator if not done yet."""
+        if self.evaluator:
+            return parsing.Parser(self.evaluator.operators).parse_generator(code)
+        if self.parse_operators is None:
+            # Only the operators of the basic library are needed
+            self.parse_operators = parsing.operator_table()
+            try:
+                with open(self.basiclib_file) as file:
+                    for ast in parsing.Parser(self.parse_operators).parse_generator(file.read()): pass
+            except FileNotFoundError:
+                pass
+        return parsing.Parser(self.parse_operators).parse_generator(code)
 
 class ReloadException(Exception): pass
 
@@ -23,14 +115,24 @@ USAGE = """
 USAGE: From the K> prompt, either type some kaleidoscope code or 
     enter one the following special commands (all preceded by a dot sign):
 
+    .compact      : Release the IR of the functions already compiled.
     .example      : Run some code examples.
     .exit or exit : Stop and exit the program.
+    .fastmath <f> : Compile with the fast-math flags f: fast for all of them, or
+                    some of reassoc,contract,nnan,ninf,nsz,arcp. .fastmath toggles all.
     .functions    : List all available language functions and operators 
     .help or help : Show this message. 
+    .load <file>  : Restore a session saved with .save
+    .memo         : Print the results kept by each memoized function. .memo clear forgets them.
+    .memory       : Print the memory held by the session.
     .options      : Print the actual options settings. 
+    .profile      : Toggle the profiling of the functions defined from then on.
     .reload or .. : Reload the python code and restart the REPL from scratch. 
-    .reset        : Reset the interpreting engine. 
+    .reset        : Reset the interpreting engine (to the last loaded session if any). 
+    .save <file>  : Save the compiled session for a fast restore with .load
     .test or test : Run unit tests.       
+    .tiers        : Print the compilation tier and call count of each function.
+    .timeit <expr>: Time the native code of a toplevel expression.
     .version      : Print version information.      
     .<file>       : Run the given file .kal        
     .<option>     : Toggle the given option on/off.
@@ -45,9 +147,18 @@ On the command line, the initial dot sign can be replaced with a double dash:
     
     kal --test
     kal --myfile.kal
-    """
+    kal --startup-profile          (time spent importing and initializing each component)
+    KAL_PERF=map,jitdump kal ...   (describe the JIT-compiled code to linux perf)
+    KAL_TIERED=1000 kal ...        (optimize fully the functions once called 1000 times)
+    KAL_FASTMATH=fast kal ...      (compile with fast-math flags, all of them or the ones listed)
+    KAL_BACKEND=vm kal ...         (run the code with the bytecode interpreter, without LLVM)
+    KAL_UNIT_CACHE=~/.kal kal ...  (keep the compiled files imported in a directory, for later runs)
+
+A long-lived evaluation server keeps warm evaluators for those commands: 
 
-history = []
+    kal --serve /tmp/kal.sock      (JSON lines; no path to use stdin/stdout)
+    KAL_SERVER=/tmp/kal.sock kal 2 + 3
+    """
 
 def errprint(msg):
     cprint(msg, 'red', file=sys.stderr)
@@ -55,13 +166,18 @@ def errprint(msg):
 def print_eval(k, code, options = dict()):
     """Evaluate the given code with evaluator engine k using the given options.
     Print the evaluation results. """
+    if options.get('parseonly'):
+        try:
+            for ast in k.parse_generator(code):
+                cprint(ast.dump(), 'green')
+        except parsing.ParseError as err:
+            errprint('Parse error: ' + str(err))
+        return
     results = k.eval_generator(code, options);
     try:
         for result in results :
             if not result.value is None:
                 cprint(result.value, 'green')
-            else:
-                history.append(result.ast)
                     
             if options.get('verbose'):
                 print()
@@ -72,14 +188,24 @@ def print_eval(k, code, options = dict()):
                 print()
     except parsing.ParseError as err:
         errprint('Parse error: ' + str(err))                    
-    except codegen.CodegenError as err:
+    except eval_errors() as err:
+        # The evaluator drops the faulty definition, so it can go on as is.
         errprint('Eval error: ' + str(err))
-        # Reset the interpreter because codegen is now corrupted.
-        k.reset(history)
     except Exception as err:
         errprint(str(type(err)) + ' : ' + str(err))
         print(' Aborting... ')
         raise
+    if options.get('profile') and getattr(k, 'backend', 'jit') == 'jit':
+        print_profile(k)
+
+def print_profile(k):
+    """Print the counters of the profiled functions, then clear them."""
+    entries = k.profiler.report()
+    if entries:
+        cprint('{:<20} {:>12} {:>14} {:>16}'.format('function', 'calls', 'loop trips', 'cycles'), 'blue')
+    for entry in entries:
+        print('{:<20} {:>12} {:>14} {:>16}'.format(entry.name, entry.calls, entry.trips, entry.cycles))
+    k.profiler.clear()
 
 def run_tests():
     import unittest
@@ -87,10 +213,10 @@ def run_tests():
     unittest.TextTestRunner().run(tests)
 
 
-def print_funlist(funlist):
+def print_funlist(funlist, prebuilt):
     for func in funlist:
         description = "{:>6} {:<20} ({})".format(
-            'extern' if func.is_declaration else '   def',
+            'extern' if func.is_declaration and func.name not in prebuilt else '   def',
             func.name,
             ' '.join((arg.name for arg in func.args)) 
         )
@@ -101,21 +227,96 @@ def print_functions(k):
     # Operators
     print(colored('\nBuiltin operators:', 'blue'), *parsing.builtin_operators())
 
-    # User vs extern functions
-    sorted_functions = sorted(k.codegen.module.functions, key=lambda fun: fun.name)
-    user_functions = filter(lambda f : not f.is_declaration, sorted_functions)
-    extern_functions = filter(lambda f : f.is_declaration, sorted_functions)
+    # User vs extern functions, their SIMD variants and parallel loop
+    # bodies left out
+    from simd import variant_width
+    from parallel import is_private
+    sorted_functions = sorted((f for f in k.codegen.module.functions
+            if not (variant_width(f.name) or is_private(f.name))),
+        key=lambda fun: fun.name)
+    prebuilt = k.codegen.prebuilt
+    user_functions = filter(lambda f : not f.is_declaration or f.name in prebuilt, sorted_functions)
+    extern_functions = filter(lambda f : f.is_declaration and f.name not in prebuilt 
+        and not f.name.startswith('llvm.'), sorted_functions)
 
     cprint('\nUser defined functions and operators:\n', 'blue')
-    print_funlist(user_functions)
+    print_funlist(user_functions, prebuilt)
 
     cprint('\nExtern functions:\n', 'blue')
-    print_funlist(extern_functions)
+    print_funlist(extern_functions, prebuilt)
+
+def print_memory(k):
+    usage = k.memory_usage()
+    print('functions :', usage.functions)
+    print('IR        :', usage.ir_bytes, 'bytes')
+    print('bitcode   :', usage.bitcode_bytes, 'bytes')
+    print('JIT code  :', usage.jit_bytes, 'bytes')
+    if usage.heap_bytes is not None:
+        print('heap      :', usage.heap_bytes, 'bytes')
+
+def print_memo(k, clear = False):
+    if clear:
+        k.memo.clear()
+    for entry in k.memo.report():
+        print('{:<20} {:>8} / {:<8} results {:>12} hits {:>12} misses'.format(*entry))
+
+def print_tiers(k):
+    if not k.tiering:
+        errprint('Tiered compilation is off, see KAL_TIERED in help')
+        return
+    for name, level in sorted(k.tiering.levels().items()):
+        print('{:<20} tier {}  {:>12} calls'.format(name, level, k.tiering.tiers[name].slot.calls))
+
+def format_duration(seconds):
+    for unit, scale in [('s', 1), ('ms', 1e3), ('us', 1e6)]:
+        if seconds * scale >= 1:
+            return '{:.3g} {}'.format(seconds * scale, unit)
+    return '{:.3g} ns'.format(seconds * 1e9)
+
+def print_timing(k, code, options):
+    try:
+        timing = k.timeit(code, optimize=options['optimize'], fastmath=options.get('fastmath'))
+    except parsing.ParseError as err:
+        errprint('Parse error: ' + str(err))
+        return
+    except eval_errors() as err:
+        errprint('Eval error: ' + str(err))
+        return
+    cprint(timing.value, 'green')
+    print('compile :', format_duration(timing.compile_time))
+    print('runs    :', timing.runs)
+    print('min     :', format_duration(timing.min))
+    print('median  :', format_duration(timing.median))
+    print('p95     :', format_duration(timing.p95))
+
+def run_snapshot_command(k, verb, filename):
+    try:
+        if verb == 'save':
+            k.save_snapshot(filename)
+            print('Session saved in', filename)
+        else:
+            restored = k.load_snapshot(filename)
+            print('Session restored from', filename, 
+                '(native code)' if restored.native_compatible() else '(bitcode)')
+    except (OSError, codexec.SnapshotError) as err:
+        errprint('Snapshot error: ' + str(err))
+
+def set_fastmath(options, flags):
+    """Select the fast-math flags of the code compiled from then on."""
+    import_compiler()
+    try:
+        options['fastmath'] = ','.join(codegen.fastmath_flags(flags.strip())) or False
+    except ValueError as err:
+        errprint(str(err))
+        return
+    print('fastmath', '=', options['fastmath'])
 
 def run_repl_command(k, command, options):
     if command in options:
         options[command] = not options[command]
         print(command, '=', options[command])
+    elif command.partition(' ')[0] in JIT_COMMANDS and getattr(k, 'backend', 'jit') != 'jit':
+        errprint('.{0} needs the jit backend'.format(command.partition(' ')[0]))
     elif command in ['example', 'examples']:
         run_examples(k, EXAMPLES, options)
     elif command in ['functions']:
@@ -124,21 +325,37 @@ def run_repl_command(k, command, options):
         print(USAGE)                  
     elif command in ['options']:
         print(options)                  
+    elif command in ['memory']:
+        print_memory(k)
+    elif command in ['tiers']:
+        print_tiers(k)
+    elif command in ['memo', 'memo clear']:
+        print_memo(k, command == 'memo clear')
+    elif command in ['compact']:
+        k.compact()
+        print_memory(k)
+    elif command.startswith('fastmath '):
+        set_fastmath(options, command[len('fastmath '):])
+    elif command.startswith('timeit '):
+        print_timing(k, command[len('timeit '):], options)
+    elif command.startswith(('save ', 'load ')):
+        verb, filename = command.split(None, 1)
+        run_snapshot_command(k, verb, filename.strip())
     elif command in ['quit', 'exit', 'stop']:
         sys.exit()
     elif command in ['reload', '.']:
         reload(lexer)
         reload(parsing)
-        reload(codegen)
-        reload(codexec)
+        for name in COMPILER_MODULES + ['bytecode']:
+            if name in sys.modules:
+                reload(sys.modules[name])
         raise ReloadException()
     elif command in ['reset']:
-        reload(parsing)
         k.reset()
-        history = []
     elif command in ['test', 'tests']:
         run_tests()
     elif command in ['version']:
+        import llvmlite.binding
         print('Python :', sys.version)
         print('LLVM   :', '.'.join((str(n) for n in llvmlite.binding.llvm_version_info)))
         print('pykal  :', VERSION)
@@ -169,17 +386,19 @@ def run_examples(k, commands, options):
         print('K>', command)
         print_eval(k, command, options)    
 
-def run(optimize = True, llvmdump = False, noexec = False, parseonly = False, verbose = False):
+def run(optimize = True, llvmdump = False, noexec = False, parseonly = False, verbose = False, profile = False,
+        fastmath = None):
 
     options = locals()
-    k = codexec.KaleidoscopeEvaluator('basiclib.kal')
+    k = LazyEvaluator('basiclib.kal')
 
     # If some arguments passed in, run that command then exit        
     if len(sys.argv) >= 2 :
         command = ' '.join(sys.argv[1:]).replace('--', '.')
         run_command(k, command, options)
     else:    
-        # Enter a REPL loop
+        # Enter a REPL loop, the evaluator being loaded while waiting for input
+        k.start()
         cprint('Type help or a command to be interpreted', 'green')
         command = ""
         while not command in ['exit', 'quit']:
@@ -0,0 +1,131 @@
+from collections import OrderedDict
+from ast import *
+
+# Result cache.
+#
+# The values of the toplevel expressions without side effects are kept by
+# the evaluator, so that evaluating the same expression again skips the code
+# generation and the JIT compilation. An expression is known by its structure,
+# its flattened AST, and by the versions of the definitions it transitively
+# calls, numbers bumped on each definition of a name: redefining a function
+# makes the keys of the expressions calling it stale, and drops their values.
+
+def references(node):
+    """Returns the names of the functions and user operators an expression
+    calls directly."""
+    names = set()
+    def visit(node):
+        if isinstance(node, Call):
+            names.add(node.callee)
+            for arg in node.args:
+                visit(arg)
+        elif isinstance(node, Binary):
+            if node.op not in ('+', '-', '*', '<', '='):
+                names.add('binary' + node.op)
+            visit(node.lhs)
+            visit(node.rhs)
+        elif isinstance(node, Unary):
+            names.add('unary' + node.op)
+            visit(node.rhs)
+        elif isinstance(node, Index):
+            visit(node.index)
+        elif isinstance(node, If):
+            for expr in (node.cond_expr, node.then_expr, node.else_expr):
+                visit(expr)
+        elif isinstance(node, For):
+            for expr in (node.start_expr, node.end_expr, node.step_expr, node.body):
+                if expr is not None:
+                    visit(expr)
+        elif isinstance(node, VarIn):
+            for name, init in node.vars:
+                if init is not None:
+                    visit(init)
+            visit(node.body)
+    visit(node)
+    return names
+
+def result_key(node, versions, options = ()):
+    """Returns the key of the value of an expression calling functions of
+    the given versions, a sequence of (name, version), and computed with the
+    given options."""
+    return (repr(node.flatten()), tuple(sorted(versions)), tuple(options))
+
+class ResultCache(object):
+    """Keeps the values of at most capacity expressions, the least recently
+    used ones being evicted first, with the numbers of hits and misses."""
+    def __init__(self, capacity = 256):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        # Value and names of the functions called of each key, by use
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """Returns the value kept for key, or None."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, dependencies):
+        """Keep the value of an expression calling the given functions,
+        directly or not."""
+        if self.capacity <= 0:
+            return
+        self._entries[key] = (value, frozenset(dependencies))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, name):
+        """Drop the values of the expressions calling the given function."""
+        for key in [key for key, (value, dependencies) in self._entries.items()
+                if name in dependencies]:
+            del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+#---- Some unit tests ----#
+
+import unittest
+
+class TestResultCache(unittest.TestCase):
+    def test_references(self):
+        from parsing import Parser
+        ast = Parser().parse_toplevel('f(1) + (for i = 0, i < n in g(-i)) - var x = h() in x')
+        self.assertEqual(references(ast.body), {'f', 'g', 'h', 'unary-'})
+        parser = Parser()
+        parser.parse_toplevel('def binary% 50 (a b) a - b')
+        self.assertEqual(references(parser.parse_toplevel('1 % 2 < 3').body), {'binary%'})
+
+    def test_key(self):
+        from parsing import Parser
+        def key(codestr, versions = ()):
+            return result_key(Parser().parse_toplevel(codestr).body, versions)
+        self.assertEqual(key('f(1 + 2)'), key('f( 1+2 )'))
+        self.assertNotEqual(key('f(1 + 2)'), key('f(1 + 3)'))
+        self.assertNotEqual(key('f(1)', [('f', 1)]), key('f(1)', [('f', 2)]))
+
+    def test_lru(self):
+        cache = ResultCache(2)
+        cache.put('a', 1, {'f'})
+        cache.put('b', 2, {'g'})
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3, {'f', 'g'})
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((len(cache), cache.hits, cache.misses), (2, 1, 1))
+        cache.invalidate('f')
+        self.assertEqual(len(cache), 0)
+        cache.clear()
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
+        cache = ResultCache(0)
+        cache.put('a', 1, ())
+        self.assertIsNone(cache.get('a'))
@@ -0,0 +1,285 @@
+import json, os, queue, socket, socketserver, sys, threading
+from ast import *
+from parsing import *
+from codegen import *
+from codexec import KaleidoscopeEvaluator
+
+# Long-lived evaluation server.
+#
+# Requests and responses are JSON objects, one per line:
+#
+#   {"id": 1, "code": "def sq(x) x * x  sq(3)", "session": "s1"}
+#   {"id": 1, "values": [null, 9.0]}
+#
+#   {"id": 2, "code": "def ("}
+#   {"id": 2, "error": {"type": "ParseError", "message": "..."}}
+#
+# Requests naming a session are always served by the same evaluator, so that
+# its definitions remain available to the next requests of that session.
+# Requests without a session are one-shot: they are served by a fresh
+# evaluator, thrown away afterwards. Other operations are given by "op":
+#
+#   {"op": "close", "session": "s1"}  forget a session
+#   {"op": "stats"}                   pool and session counts
+#
+# The output of the code itself (putchard...) goes to the server stdout, or
+# to its stderr when the requests come from stdin.
+
+class ServerError(Exception): pass
+
+# The basic library next to this file, wherever the server is started from
+BASICLIB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'basiclib.kal')
+
+class _Session(object):
+    def __init__(self, evaluator):
+        self.evaluator = evaluator
+        self.lock = threading.Lock()
+
+class EvaluatorPool(object):
+    """Pool of evaluators with the basic library already compiled, so that a
+    new session or a one-shot request does not pay for it. A replacement is
+    warmed up in the background each time an evaluator is taken out. When
+    the warm-up fails, the error is raised to the request taking it."""
+    def __init__(self, basiclib_file = None, size = 2):
+        self.basiclib_file = basiclib_file
+        self.size = size
+        self.ready = queue.Queue()
+        self.sessions = {}
+        self.lock = threading.Lock()
+        for i in range(size):
+            self._refill()
+
+    def _warm(self):
+        try:
+            k = KaleidoscopeEvaluator(self.basiclib_file)
+            # Have the engine compile something before the first request does
+            k.evaluate('0')
+        except Exception as err:
+            self.ready.put(err)
+        else:
+            self.ready.put(k)
+
+    def _refill(self):
+        threading.Thread(target=self._warm, daemon=True).start()
+
+    def acquire(self):
+        """Take a warm evaluator out of the pool."""
+        k = self.ready.get()
+        self._refill()
+        if isinstance(k, Exception):
+            raise k
+        return k
+
+    def check(self):
+        """Wait for the first warm evaluator, raising the error of its
+        warm-up if it failed. The evaluator stays in the pool."""
+        k = self.acquire()
+        self.ready.put(k)
+
+    def session(self, name):
+        with self.lock:
+            session = self.sessions.get(name)
+        if session is None:
+            k = self.acquire()
+            with self.lock:
+                session = self.sessions.setdefault(name, _Session(k))
+        return session
+
+    def close_session(self, name):
+        with self.lock:
+            return self.sessions.pop(name, None) is not None
+
+    def evaluate(self, codestr, session = None, options = dict()):
+        """Evaluates all top level expressions in codestr, in the given session
+        or in a fresh evaluator. Returns the list of their values."""
+        if session is None:
+            k = self.acquire()
+            return [result.value for result in k.eval_generator(codestr, options)]
+        session = self.session(session)
+        with session.lock:
+            return [result.value for result in session.evaluator.eval_generator(codestr, options)]
+
+    def stats(self):
+        with self.lock:
+            return {'ready': self.ready.qsize(), 'sessions': len(self.sessions)}
+
+_REQUIRED = object()
+
+def _field(request, name, kind, default = _REQUIRED):
+    """Returns a field of a request, checking it is of the given kind."""
+    if name not in request or (request[name] is None and default is None):
+        if default is _REQUIRED:
+            raise ServerError('Missing field: {0}'.format(name))
+        return default
+    value = request[name]
+    if not isinstance(value, kind):
+        raise ServerError('Field {0} must be a {1}'.format(name, 
+            {str: 'string', dict: 'object'}[kind]))
+    return value
+
+def handle(pool, request):
+    """Serve a single request, given as a dict. Returns the response dict.
+    Any error is turned into the error of the response."""
+    response = {}
+    try:
+        if 'id' in request:
+            response['id'] = request['id']
+        op = _field(request, 'op', str, 'eval')
+        if op == 'eval':
+            response['values'] = pool.evaluate(_field(request, 'code', str),
+                _field(request, 'session', str, None), _field(request, 'options', dict, {}))
+        elif op == 'close':
+            response['closed'] = pool.close_session(_field(request, 'session', str))
+        elif op == 'stats':
+            response.update(pool.stats())
+        else:
+            raise ServerError('Unknown operation: {0}'.format(op))
+    except Exception as err:
+        response['error'] = {'type': type(err).__name__, 'message': str(err)}
+    return response
+
+def handle_line(pool, line):
+    """Serve a request given as a JSON line. Returns the response line."""
+    try:
+        request = json.loads(line)
+        if not isinstance(request, dict):
+            raise ValueError('Request must be an object')
+    except ValueError as err:
+        response = {'error': {'type': 'ServerError', 'message': 'Bad request: {0}'.format(err)}}
+    else:
+        response = handle(pool, request)
+    return json.dumps(response) + '\n'
+
+def serve_stream(pool, infile, outfile):
+    """Serve the requests read from infile until its end, one at a time."""
+    for line in infile:
+        if line.strip():
+            outfile.write(handle_line(pool, line))
+            outfile.flush()
+
+def serve_stdio(pool):
+    """Serve the requests read from stdin. The native code output is sent to
+    stderr, to keep it out of the responses."""
+    sys.stdout.flush()
+    outfile = os.fdopen(os.dup(sys.stdout.fileno()), 'w', encoding='utf-8')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    serve_stream(pool, sys.stdin, outfile)
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            line = line.decode('utf-8')
+            if line.strip():
+                self.wfile.write(handle_line(self.server.pool, line).encode('utf-8'))
+
+if hasattr(socket, 'AF_UNIX'):
+    class UnixServer(socketserver.ThreadingUnixStreamServer):
+        """Serves each connection in its own thread."""
+        daemon_threads = True
+
+        def __init__(self, path, pool):
+            if os.path.exists(path):
+                os.unlink(path)
+            super().__init__(path, _Handler)
+            self.pool = pool
+
+        def server_close(self):
+            super().server_close()
+            if os.path.exists(self.server_address):
+                os.unlink(self.server_address)
+
+def main(args, basiclib_file = BASICLIB_FILE):
+    """kal --serve [socket path]: serve the requests on the given unix socket,
+    or on stdin/stdout when no path is given."""
+    pool = EvaluatorPool(basiclib_file)
+    try:
+        pool.check()
+    except Exception as err:
+        sys.exit('Cannot start the server: {0}: {1}'.format(type(err).__name__, err))
+    if not args:
+        serve_stdio(pool)
+        return
+    with UnixServer(args[0], pool) as server:
+        print('Serving on {0}'.format(args[0]), file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+#---- Some unit tests ----#
+
+import io, tempfile, unittest
+import client
+
+class TestServer(unittest.TestCase):
+    def test_sessions(self):
+        pool = EvaluatorPool(size=1)
+        self.assertEqual(handle(pool, {'id': 1, 'code': 'def sq(x) x * x  sq(3)', 'session': 'a'}),
+                         {'id': 1, 'values': [None, 9]})
+        self.assertEqual(handle(pool, {'code': 'sq(4)', 'session': 'a'}), {'values': [16]})
+        # Other sessions and one-shot requests do not see the definition
+        self.assertEqual(handle(pool, {'code': 'sq(4)', 'session': 'b'})['error']['type'], 'CodegenError')
+        self.assertEqual(handle(pool, {'code': 'sq(4)'})['error']['type'], 'CodegenError')
+        self.assertEqual(handle(pool, {'op': 'stats'})['sessions'], 2)
+        self.assertEqual(handle(pool, {'op': 'close', 'session': 'a'}), {'closed': True})
+        self.assertEqual(handle(pool, {'code': 'sq(4)', 'session': 'a'})['error']['type'], 'CodegenError')
+
+    def test_bad_requests(self):
+        pool = EvaluatorPool(size=1)
+        self.assertEqual(handle(pool, {'code': 'def ('})['error']['type'], 'ParseError')
+        self.assertEqual(handle(pool, {'op': 'close'})['error']['type'], 'ServerError')
+        self.assertEqual(handle(pool, {'op': 'foo'})['error']['type'], 'ServerError')
+        self.assertEqual(json.loads(handle_line(pool, '[1'))['error']['type'], 'ServerError')
+        self.assertEqual(handle(pool, {'code': 5})['error'],
+            {'type': 'ServerError', 'message': 'Field code must be a string'})
+        self.assertEqual(handle(pool, {'code': '1', 'options': []})['error']['type'], 'ServerError')
+        self.assertEqual(handle(pool, {'code': '1', 'options': {'fastmath': 'bogus'}})['error']['type'],
+            'ValueError')
+        self.assertEqual(handle(pool, {'code': '1', 'options': {'bogus': 1}})['error']['type'], 'TypeError')
+        # The server goes on serving after any of them
+        lines = ['{"code": 5}', '{"code": "import \\"nope.kal\\""}', '{"code": "1", "session": null}']
+        outfile = io.StringIO()
+        serve_stream(pool, io.StringIO('\n'.join(lines) + '\n'), outfile)
+        responses = [json.loads(line) for line in outfile.getvalue().splitlines()]
+        self.assertEqual([sorted(response) for response in responses], [['error'], ['error'], ['values']])
+
+    def test_warm_failure(self):
+        # The requests get the error of the warm-up rather than waiting
+        pool = EvaluatorPool('missing.kal', size=1)
+        self.assertEqual(handle(pool, {'id': 1, 'code': '1'})['error']['type'], 'FileNotFoundError')
+        self.assertEqual(handle(pool, {'code': '1', 'session': 's'})['error']['type'], 'FileNotFoundError')
+        with self.assertRaises(FileNotFoundError):
+            pool.check()
+        with self.assertRaises(SystemExit):
+            main([], 'missing.kal')
+        self.assertTrue(os.path.isabs(BASICLIB_FILE) and os.path.exists(BASICLIB_FILE))
+
+    def test_stream(self):
+        pool = EvaluatorPool(size=1)
+        infile = io.StringIO('{"code": "1 + 2"}\n\n{"code": "2 * 3"}\n')
+        outfile = io.StringIO()
+        serve_stream(pool, infile, outfile)
+        self.assertEqual(outfile.getvalue().splitlines(), ['{"values": [3.0]}', '{"values": [6.0]}'])
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'unix sockets not available')
+    def test_unix_socket(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'kal.sock')
+            with UnixServer(path, EvaluatorPool(size=1)) as server:
+                thread = threading.Thread(target=server.serve_forever, daemon=True)
+                thread.start()
+                try:
+                    self.assertIsNone(client.evaluate(path, 'def cube(x) x * x * x', 's')[0])
+                    self.assertEqual(client.evaluate(path, 'cube(2)', 's'), [8])
+                    with self.assertRaises(client.ServerError):
+                        client.evaluate(path, 'cube(2)')
+                    # The exit status of the one-shot commands
+                    from unittest import mock
+                    from contextlib import redirect_stdout, redirect_stderr
+                    with mock.patch.dict(os.environ, {client.SERVER_ENV: path}), \
+                            redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+                        self.assertEqual([client.run('1 + 1'), client.run('cube(2)')], [0, 1])
+                finally:
+                    server.shutdown()
+                    thread.join()
+            self.assertFalse(os.path.exists(path))
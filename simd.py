@@ -0,0 +1,497 @@
+import re
+import llvmlite.ir as ir
+import llvmlite.binding as llvm
+from ast import *
+
+# SIMD variants of the pure functions.
+#
+# A function is pure when it only computes on its arguments: it calls neither
+# putchard nor an extern not known to be pure, and only pure functions. Such a
+# function gets a variant computing as many values at once as there are
+# doubles in a vector register of the host, one per lane. The lanes may take
+# different paths through an 'if' or a loop: each branch runs under the mask
+# of the lanes taking it, and is skipped when none does, which ends the
+# recursions. The batch drivers run a function over arrays, through its
+# variant when it has one.
+
+# The math functions of the C library declared by the basic library, which
+# have no side effects. The ones with an LLVM intrinsic run on whole vectors,
+# the others once per lane.
+PURE_EXTERNS = frozenset([
+    'fabs', 'fmod', 'fmax', 'fmin', 'exp', 'exp2', 'log', 'log2', 'log10',
+    'sqrt', 'cbrt', 'hypot', 'power', 'sin', 'cos', 'tan', 'asin', 'acos',
+    'atan', 'ceil', 'floor', 'trunc', 'round'])
+
+INTRINSICS = {
+    'fabs': 'llvm.fabs', 'sqrt': 'llvm.sqrt', 'ceil': 'llvm.ceil',
+    'floor': 'llvm.floor', 'trunc': 'llvm.trunc', 'round': 'llvm.round',
+    'fmin': 'llvm.minnum', 'fmax': 'llvm.maxnum'}
+
+def simd_name(funcname, width):
+    """Returns the name of the SIMD variant of a function computing width
+    values at once."""
+    return '{0}.simd{1}'.format(funcname, width)
+
+def variant_width(funcname):
+    """Returns the width of a SIMD variant given its name, or None when the
+    name is not the one of a variant."""
+    match = re.search(r'\.simd(\d+)$', funcname)
+    return int(match.group(1)) if match else None
+
+def batch_name(funcname):
+    """Returns the name of the driver running a function over arrays."""
+    return '{0}.batch'.format(funcname)
+
+def host_width():
+    """Returns the number of doubles held by a vector register of the host."""
+    try:
+        features = llvm.get_host_cpu_features()
+    except RuntimeError:
+        return 2
+    if features.get('avx512f'):
+        return 8
+    if features.get('avx'):
+        return 4
+    return 2
+
+def host_target_machine(target, opt = 2):
+    """Returns a target machine generating code for the host processor, its
+    vector extensions included."""
+    try:
+        features = llvm.get_host_cpu_features().flatten()
+    except RuntimeError:
+        features = ''
+    return target.create_target_machine(
+        cpu=llvm.get_host_cpu_name(), features=features, opt=opt)
+
+def variant_type(nargs, width):
+    """Returns the type of a variant: it takes the mask of the lanes to
+    compute, then a vector per argument, and returns a vector."""
+    vector = ir.VectorType(ir.DoubleType(), width)
+    return ir.FunctionType(vector, [ir.VectorType(ir.IntType(1), width)] + [vector] * nargs)
+
+def is_pure(node, funcname, pure_callee, lanes = False):
+    """Whether an expression of the function funcname has no side effects:
+    it writes to no array and only calls itself and the functions for which
+    pure_callee(name) is true.
+    lanes: whether the expression must also fit the lanes of a variant."""
+    def pure(node):
+        if isinstance(node, Call):
+            return (node.callee == funcname or pure_callee(node.callee)) and \
+                all(pure(arg) for arg in node.args)
+        if isinstance(node, Binary):
+            if node.op == '=' and isinstance(node.lhs, Index):
+                return False
+            return (node.op in ('+', '-', '*', '<', '=') or 'binary' + node.op == funcname
+                    or pure_callee('binary' + node.op)) and pure(node.lhs) and pure(node.rhs)
+        if isinstance(node, Unary):
+            return ('unary' + node.op == funcname or pure_callee('unary' + node.op)) and pure(node.rhs)
+        if isinstance(node, Index):
+            return not lanes and pure(node.index)
+        if isinstance(node, If):
+            return all(pure(expr) for expr in (node.cond_expr, node.then_expr, node.else_expr))
+        if isinstance(node, For):
+            # The iterations of a parallel loop already run on threads of
+            # their own, and the lanes only hold doubles
+            if lanes and (isinstance(node, ParFor) or node.id_type not in (None, DEFAULT_TYPE)):
+                return False
+            return all(pure(expr) for expr in
+                (node.start_expr, node.end_expr, node.step_expr, node.body) if expr)
+        if isinstance(node, VarIn):
+            if lanes and any(type != DEFAULT_TYPE for type in node.types.values()):
+                return False
+            return all(pure(init) for name, init in node.vars if init) and pure(node.body)
+        return True
+    return pure(node)
+
+def is_pure_extern(module, name, prebuilt = ()):
+    """Whether a function of the module is a pure extern of the C library,
+    taking and returning doubles."""
+    func = module.globals.get(name)
+    return name in PURE_EXTERNS and isinstance(func, ir.Function) \
+        and func.is_declaration and name not in prebuilt \
+        and func.function_type == ir.FunctionType(
+            ir.DoubleType(), [ir.DoubleType()] * len(func.args))
+
+class VariantGenerator(object):
+    """Generates the SIMD variants of the pure functions into a module.
+    prebuilt: names of the functions whose code comes from elsewhere, and
+    which are thus not known to be pure externs.
+    fastmath: fast-math flags of the function. The inactive lanes computing
+    on garbage, the variants leave out nnan and ninf, which would turn their
+    values into poison, and with them the masks.
+    """
+    def __init__(self, module, width, prebuilt = (), fastmath = ()):
+        self.module = module
+        self.width = width
+        self.prebuilt = prebuilt
+        self.fastmath = tuple(flag for flag in fastmath if flag not in ('nnan', 'ninf'))
+        self.vector = ir.VectorType(ir.DoubleType(), width)
+        self.builder = None
+        self.symtab = {}
+        self.mask = None
+        # While emitting a function whose tail calls are loop iterations: its
+        # name, the addresses of its arguments and of its result, and the
+        # mask of the lanes making a tail call.
+        self.funcname = None
+        self.arguments = []
+        self.result = None
+        self.again = None
+
+    def is_pure(self, node, funcname):
+        """Whether an expression of the function funcname only calls pure
+        functions, itself, the ones with a variant, and the pure externs,
+        and only computes on doubles, which the lanes hold."""
+        return is_pure(node, funcname, self._pure_callee, lanes=True)
+
+    def _pure_callee(self, name):
+        return simd_name(name, self.width) in self.module.globals \
+            or is_pure_extern(self.module, name, self.prebuilt)
+
+    def generate(self, node):
+        """Returns the variant of a named function already generated into the
+        module, or None when the function is not pure."""
+        funcname = node.proto.name
+        if node.proto.is_typed() or not self.is_pure(node.body, funcname):
+            return None
+        func = ir.Function(self.module, variant_type(len(node.proto.argnames), self.width),
+            simd_name(funcname, self.width))
+        func.args[0].name = '.mask'
+        for arg, argname in zip(func.args[1:], node.proto.argnames):
+            arg.name = argname
+        self.builder = ir.IRBuilder(func.append_basic_block('entry'))
+        self.symtab = {}
+        for arg in func.args[1:]:
+            alloca = self._alloca(arg.name)
+            self.builder.store(arg, alloca)
+            self.symtab[arg.name] = alloca
+        self.mask = func.args[0]
+        if _has_tail_call(node.body, funcname):
+            self._codegen_loop(node)
+        else:
+            self.builder.ret(self._codegen(node.body))
+        return func
+
+    def _alloca(self, name, type = None):
+        with self.builder.goto_entry_block():
+            return self.builder.alloca(type or self.vector, size=None, name=name)
+
+    def _codegen_loop(self, node):
+        """Emit the body of a function calling itself in tail position as a
+        loop, each tail call being an iteration: the lanes making such a call
+        go on with their new arguments, the others keep their result."""
+        self.funcname = node.proto.name
+        self.arguments = [self.symtab[argname] for argname in node.proto.argnames]
+        self.result = self._alloca('result')
+        self.again = self._alloca('again', self.mask.type)
+        loop_bb = ir.Block(self.builder.function, 'tailloop')
+        after_bb = ir.Block(self.builder.function, 'tailafter')
+        entry_bb = self.builder.block
+        self.builder.branch(loop_bb)
+
+        self.builder.function.basic_blocks.append(loop_bb)
+        self.builder.position_at_start(loop_bb)
+        active = self.builder.phi(self.mask.type, 'active')
+        active.add_incoming(self.mask, entry_bb)
+        self.builder.store(ir.Constant(self.mask.type, [0] * self.width), self.again)
+        self.mask = active
+        self._codegen_tail(node.body)
+        again = self.builder.load(self.again)
+        active.add_incoming(again, self.builder.block)
+        self.builder.cbranch(self._any(again), loop_bb, after_bb)
+
+        self.builder.function.basic_blocks.append(after_bb)
+        self.builder.position_at_start(after_bb)
+        self.builder.ret(self.builder.load(self.result))
+
+    def _codegen_tail(self, node):
+        """Emit an expression in tail position of a loop emitted by
+        _codegen_loop."""
+        if isinstance(node, If):
+            cond = self._true(self._codegen(node.cond_expr))
+            self._masked(self.builder.and_(self.mask, cond), node.then_expr, tail=True)
+            self._masked(self.builder.and_(self.mask, self.builder.not_(cond)), node.else_expr, tail=True)
+        elif isinstance(node, Call) and node.callee == self.funcname:
+            args = [self._codegen(arg) for arg in node.args]
+            for address, value in zip(self.arguments, args):
+                self._store_masked(value, address)
+            self.builder.store(self.builder.or_(self.builder.load(self.again), self.mask), self.again)
+        else:
+            self._store_masked(self._codegen(node), self.result)
+
+    def _store_masked(self, value, address):
+        """Store the lanes of value under the mask."""
+        old = self.builder.load(address)
+        self.builder.store(self.builder.select(self.mask, value, old), address)
+
+    def _splat(self, value):
+        return ir.Constant(self.vector, [value] * self.width)
+
+    def _any(self, mask):
+        """Returns whether any lane of a mask is set."""
+        bits = self.builder.bitcast(mask, ir.IntType(self.width))
+        return self.builder.icmp_unsigned('!=', bits, ir.Constant(bits.type, 0))
+
+    def _true(self, value):
+        """Returns the mask of the lanes of a condition that are true."""
+        return self.builder.fcmp_ordered('!=', value, self._splat(0.0))
+
+    def _codegen(self, node):
+        return getattr(self, '_codegen_' + node.__class__.__name__)(node)
+
+    def _codegen_Number(self, node):
+        return self._splat(float(node.val))
+
+    def _codegen_Variable(self, node):
+        return self.builder.load(self.symtab[node.name], node.name)
+
+    def _codegen_Binary(self, node):
+        if node.op == '=':
+            # Only the lanes running the assignment see it
+            value = self._codegen(node.rhs)
+            self._store_masked(value, self.symtab[node.lhs.name])
+            return value
+        lhs = self._codegen(node.lhs)
+        rhs = self._codegen(node.rhs)
+        if node.op == '+':
+            return self.builder.fadd(lhs, rhs, 'addop', self.fastmath)
+        elif node.op == '-':
+            return self.builder.fsub(lhs, rhs, 'subop', self.fastmath)
+        elif node.op == '*':
+            return self.builder.fmul(lhs, rhs, 'multop', self.fastmath)
+        elif node.op == '<':
+            cmp = self.builder.fcmp_unordered('<', lhs, rhs, 'ltop')
+            return self.builder.uitofp(cmp, self.vector, 'ltoptodouble')
+        return self._call('binary' + node.op, [lhs, rhs])
+
+    def _codegen_Unary(self, node):
+        return self._call('unary' + node.op, [self._codegen(node.rhs)])
+
+    def _codegen_Call(self, node):
+        return self._call(node.callee, [self._codegen(arg) for arg in node.args])
+
+    def _call(self, name, args):
+        variant = self.module.globals.get(simd_name(name, self.width))
+        if variant is not None:
+            return self.builder.call(variant, [self.mask] + args, 'calltmp')
+        if name in INTRINSICS:
+            intrinsic = '{0}.v{1}f64'.format(INTRINSICS[name], self.width)
+            func = self.module.globals.get(intrinsic)
+            if func is None:
+                func = ir.Function(self.module,
+                    ir.FunctionType(self.vector, [self.vector] * len(args)), intrinsic)
+            return self.builder.call(func, args, 'calltmp', fastmath=self.fastmath)
+        # An extern computing one lane at a time
+        func = self.module.globals[name]
+        result = ir.Constant(self.vector, ir.Undefined)
+        for lane in range(self.width):
+            index = ir.Constant(ir.IntType(32), lane)
+            value = self.builder.call(func,
+                [self.builder.extract_element(arg, index) for arg in args], 'lanetmp')
+            result = self.builder.insert_element(result, value, index)
+        return result
+
+    def _masked(self, mask, node, tail = False):
+        """Emit an expression running under a mask, skipped when no lane of
+        the mask is set. Its lanes are 0 when skipped. Returns nothing for an
+        expression in tail position of a loop."""
+        run_bb = ir.Block(self.builder.function, 'masked')
+        done_bb = ir.Block(self.builder.function, 'endmasked')
+        skip_bb = self.builder.block
+        self.builder.cbranch(self._any(mask), run_bb, done_bb)
+
+        self.builder.function.basic_blocks.append(run_bb)
+        self.builder.position_at_start(run_bb)
+        outer, self.mask = self.mask, mask
+        if tail:
+            self._codegen_tail(node)
+        else:
+            value = self._codegen(node)
+        self.mask = outer
+        self.builder.branch(done_bb)
+        run_bb = self.builder.block
+
+        self.builder.function.basic_blocks.append(done_bb)
+        self.builder.position_at_start(done_bb)
+        if tail:
+            return None
+        phi = self.builder.phi(self.vector, 'maskedval')
+        phi.add_incoming(value, run_bb)
+        phi.add_incoming(self._splat(0.0), skip_bb)
+        return phi
+
+    def _codegen_If(self, node):
+        cond = self._true(self._codegen(node.cond_expr))
+        then_mask = self.builder.and_(self.mask, cond)
+        else_mask = self.builder.and_(self.mask, self.builder.not_(cond))
+        then_val = self._masked(then_mask, node.then_expr)
+        else_val = self._masked(else_mask, node.else_expr)
+        return self.builder.select(cond, then_val, else_val, 'ifval')
+
+    def _codegen_For(self, node):
+        # The loop runs while any lane does: the mask of the running lanes
+        # loses the lanes whose end condition is false, their counters stop.
+        cond_bb = ir.Block(self.builder.function, 'loopcond')
+        body_bb = ir.Block(self.builder.function, 'loopbody')
+        after_bb = ir.Block(self.builder.function, 'loopafter')
+
+        var_addr = self._alloca(node.id_name)
+        self.builder.store(self._codegen(node.start_expr), var_addr)
+        header_bb = self.builder.block
+        self.builder.branch(cond_bb)
+
+        self.builder.function.basic_blocks.append(cond_bb)
+        self.builder.position_at_start(cond_bb)
+        active = self.builder.phi(self.mask.type, 'active')
+        active.add_incoming(self.mask, header_bb)
+        if node.reduction:
+            accumulator = self.builder.phi(self.vector, 'accumulator')
+            accumulator.add_incoming(self._splat(REDUCTIONS[node.reduction]), header_bb)
+        oldval = self.symtab.get(node.id_name)
+        self.symtab[node.id_name] = var_addr
+        outer, self.mask = self.mask, active
+        running = self.builder.and_(active, self._true(self._codegen(node.end_expr)))
+        self.builder.cbranch(self._any(running), body_bb, after_bb)
+
+        self.builder.function.basic_blocks.append(body_bb)
+        self.builder.position_at_start(body_bb)
+        self.mask = running
+        body_val = self._codegen(node.body)
+        if node.reduction:
+            # The lanes done with the loop keep their reduction
+            body_val = self.builder.select(running,
+                self._reduce(node.reduction, accumulator, body_val), accumulator)
+        step = node.step_expr or Binary('+', Variable(node.id_name), Number(1.0))
+        nextval = self._codegen(step)
+        self._store_masked(nextval, var_addr)
+        active.add_incoming(running, self.builder.block)
+        if node.reduction:
+            accumulator.add_incoming(body_val, self.builder.block)
+        self.builder.branch(cond_bb)
+
+        self.builder.function.basic_blocks.append(after_bb)
+        self.builder.position_at_start(after_bb)
+        self.mask = outer
+        if oldval is None:
+            del self.symtab[node.id_name]
+        else:
+            self.symtab[node.id_name] = oldval
+        if node.reduction:
+            return accumulator
+        return self.builder.load(var_addr)
+
+    def _reduce(self, reduction, accumulator, value):
+        if reduction == '+':
+            return self.builder.fadd(accumulator, value, 'reduceop', self.fastmath)
+        elif reduction == '*':
+            return self.builder.fmul(accumulator, value, 'reduceop', self.fastmath)
+        elif reduction == 'min':
+            less = self.builder.fcmp_unordered('<', value, accumulator)
+        else:
+            less = self.builder.fcmp_unordered('<', accumulator, value)
+        return self.builder.select(less, value, accumulator, 'reduceop')
+
+    def _codegen_VarIn(self, node):
+        old_bindings = []
+        for name, init in node.vars:
+            init_val = self._codegen(init) if init is not None else self._splat(0.0)
+            var_addr = self._alloca(name)
+            self.builder.store(init_val, var_addr)
+            old_bindings.append(self.symtab.get(name))
+            self.symtab[name] = var_addr
+        body_val = self._codegen(node.body)
+        for (name, _), old in zip(node.vars, old_bindings):
+            if old is not None:
+                self.symtab[name] = old
+            else:
+                del self.symtab[name]
+        return body_val
+
+def _has_tail_call(node, funcname):
+    """Whether an expression calls the function funcname in tail position."""
+    if isinstance(node, If):
+        return _has_tail_call(node.then_expr, funcname) or _has_tail_call(node.else_expr, funcname)
+    return isinstance(node, Call) and node.callee == funcname
+
+def batch_IR(callee, funcname, width = None):
+    """Returns the IR of the driver running a function over arrays:
+        void @"<funcname>.batch"(double* out, i64 n, double* arg, ...)
+    stores in out[i] the value of the function for the i-th element of each
+    argument array. callee is the IR function called, the SIMD variant of the
+    function when width is given, or the function itself."""
+    double = ir.DoubleType()
+    i64 = ir.IntType(64)
+    module = ir.Module()
+    callee = ir.Function(module, callee.function_type, callee.name)
+    nargs = len(callee.args) - (1 if width else 0)
+    driver = ir.Function(module, ir.FunctionType(ir.VoidType(),
+        [double.as_pointer(), i64] + [double.as_pointer()] * nargs), batch_name(funcname))
+    out, n, arrays = driver.args[0], driver.args[1], driver.args[2:]
+    builder = ir.IRBuilder(driver.append_basic_block('entry'))
+    entry_bb = builder.block
+    cond_bb = driver.append_basic_block('loopcond')
+    body_bb = driver.append_basic_block('loopbody')
+    after_bb = driver.append_basic_block('loopafter')
+    builder.branch(cond_bb)
+
+    builder.position_at_start(cond_bb)
+    index = builder.phi(i64, 'index')
+    index.add_incoming(ir.Constant(i64, 0), entry_bb)
+    if width is None:
+        builder.cbranch(builder.icmp_signed('<', index, n), body_bb, after_bb)
+        builder.position_at_start(body_bb)
+        args = [builder.load(builder.gep(array, [index])) for array in arrays]
+        builder.store(builder.call(callee, args), builder.gep(out, [index]))
+        next_index = builder.add(index, ir.Constant(i64, 1))
+        index.add_incoming(next_index, body_bb)
+        builder.branch(cond_bb)
+        builder.position_at_start(after_bb)
+        builder.ret_void()
+        return str(driver)
+
+    # Whole vectors first, then the last elements under a mask
+    vector = ir.VectorType(double, width)
+    pointer = vector.as_pointer()
+    masktype = ir.VectorType(ir.IntType(1), width)
+    next_index = builder.add(index, ir.Constant(i64, width))
+    builder.cbranch(builder.icmp_signed('<=', next_index, n), body_bb, after_bb)
+
+    builder.position_at_start(body_bb)
+    def vector_at(array):
+        return builder.bitcast(builder.gep(array, [index]), pointer)
+    args = [builder.load(vector_at(array), align=8) for array in arrays]
+    everything = ir.Constant(masktype, [1] * width)
+    builder.store(builder.call(callee, [everything] + args), vector_at(out), align=8)
+    index.add_incoming(next_index, body_bb)
+    builder.branch(cond_bb)
+
+    builder.position_at_start(after_bb)
+    lanes = ir.VectorType(i64, width)
+    def splat(value):
+        lane0 = builder.insert_element(
+            ir.Constant(lanes, ir.Undefined), value, ir.Constant(ir.IntType(32), 0))
+        return builder.shuffle_vector(lane0, ir.Constant(lanes, ir.Undefined),
+            ir.Constant(ir.VectorType(ir.IntType(32), width), [0] * width))
+    remaining = builder.icmp_signed('<',
+        builder.add(splat(index), ir.Constant(lanes, list(range(width)))), splat(n))
+    bits = builder.bitcast(remaining, ir.IntType(width))
+    tail_bb = driver.append_basic_block('tail')
+    done_bb = driver.append_basic_block('done')
+    builder.cbranch(builder.icmp_unsigned('!=', bits, ir.Constant(bits.type, 0)), tail_bb, done_bb)
+
+    builder.position_at_start(tail_bb)
+    load = ir.Function(module, ir.FunctionType(vector,
+            [pointer, ir.IntType(32), masktype, vector]),
+        'llvm.masked.load.v{0}f64.p0v{0}f64'.format(width))
+    store = ir.Function(module, ir.FunctionType(ir.VoidType(),
+            [vector, pointer, ir.IntType(32), masktype]),
+        'llvm.masked.store.v{0}f64.p0v{0}f64'.format(width))
+    align = ir.Constant(ir.IntType(32), 8)
+    zeros = ir.Constant(vector, [0.0] * width)
+    args = [builder.call(load, [vector_at(array), align, remaining, zeros]) for array in arrays]
+    builder.call(store, [builder.call(callee, [remaining] + args), vector_at(out), align, remaining])
+    builder.branch(done_bb)
+
+    builder.position_at_start(done_bb)
+    builder.ret_void()
+    return '\n'.join([str(load), str(store), str(driver)])
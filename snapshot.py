@@ -0,0 +1,124 @@
+import json, struct
+from collections import namedtuple
+import llvmlite.binding as llvm
+from parsing import Associativity, BinOpInfo
+
+# A snapshot freezes the state of an evaluator session: the compiled module as
+# LLVM bitcode, the same module as native object code when it can be reused on
+# this host, the prototypes of all the functions it holds, and the operator
+# precedences the parser needs to read code using them. Restoring a snapshot
+# skips parsing and code generation entirely.
+#
+# A snapshot file only holds data, never code run when reading it: a prefix
+# with a magic number, the format version and the size of a JSON header, the
+# header, then the bitcode and the object code, whose sizes it gives.
+
+SNAPSHOT_MAGIC = b'KALSNAP\0'
+SNAPSHOT_VERSION = 3
+_PREFIX = struct.Struct('<8sII')
+
+# types: the types of the result and of the arguments, or None when they are
+# all f64
+# pure: whether the function was generated without side effects, which the
+# code calling it relies on
+FunctionInfo = namedtuple('FunctionInfo', ['name', 'argnames', 'is_declaration', 'types', 'pure'],
+    defaults=[None, False])
+
+class SnapshotError(Exception): pass
+
+def host_signature():
+    """Identify the native code produced on this host. Object code is only
+    reused on a host with the exact same signature."""
+    return (
+        llvm.get_process_triple(),
+        llvm.get_host_cpu_name(),
+        llvm.get_host_cpu_features().flatten(),
+        tuple(llvm.llvm_version_info))
+
+class Snapshot(object):
+    def __init__(self, bitcode, objcode, signature, functions, operators):
+        self.bitcode = bitcode
+        self.objcode = objcode
+        self.signature = signature
+        # A list of FunctionInfo
+        self.functions = functions
+        # Maps operators to their parsing.BinOpInfo
+        self.operators = operators
+
+    @classmethod
+    def from_module(klass, llvmmod, target_machine, functions, operators):
+        """Build a snapshot from an optimized and verified llvm module."""
+        return klass(
+            llvmmod.as_bitcode(),
+            target_machine.emit_object(llvmmod),
+            host_signature(),
+            functions,
+            operators)
+
+    def native_compatible(self):
+        """Tells if the object code can be loaded as is on this host."""
+        return self.objcode is not None and self.signature == host_signature()
+
+    def save(self, filename):
+        header = json.dumps(self._header()).encode()
+        with open(filename, 'wb') as file:
+            file.write(_PREFIX.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header)))
+            file.write(header)
+            file.write(self.bitcode)
+            file.write(self.objcode or b'')
+
+    def _header(self):
+        """Returns the fields of the snapshot, but its code, as JSON data."""
+        return {
+            'signature': self.signature,
+            'functions': [list(info) for info in self.functions],
+            'operators': {op: [info.precedence, info.associativity.name]
+                for op, info in self.operators.items()},
+            'bitcode': len(self.bitcode),
+            'objcode': None if self.objcode is None else len(self.objcode)}
+
+    @classmethod
+    def _restore(klass, header, bitcode, objcode):
+        """Returns the snapshot of the fields read from a file."""
+        return klass(bitcode, objcode, *klass._decode(header))
+
+    @staticmethod
+    def _decode(header):
+        """Returns the signature, functions and operators of a header."""
+        signature = header['signature']
+        if signature is not None:
+            signature = tuple(tuple(item) if isinstance(item, list) else item
+                for item in signature)
+        functions = [FunctionInfo(str(name), [str(arg) for arg in argnames], bool(is_declaration),
+                types and [str(type) for type in types], bool(pure))
+            for name, argnames, is_declaration, types, pure in header['functions']]
+        operators = {str(op): BinOpInfo(int(precedence), Associativity[associativity])
+            for op, (precedence, associativity) in header['operators'].items()}
+        return signature, functions, operators
+
+    @classmethod
+    def load(klass, filename):
+        """Read a snapshot saved with save(). The file only holds data:
+        a JSON header followed by the bitcode and the object code."""
+        with open(filename, 'rb') as file:
+            data = file.read()
+        try:
+            magic, version, size = _PREFIX.unpack_from(data)
+        except struct.error:
+            magic = None
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotError('Not a snapshot file: ' + filename)
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotError('Unsupported snapshot version: {0}'.format(version))
+        try:
+            start = _PREFIX.size + size
+            header = json.loads(data[_PREFIX.size:start].decode())
+            bitcode = data[start:start + header['bitcode']]
+            objcode = None
+            if header['objcode'] is not None:
+                objcode = data[start + len(bitcode):]
+            if len(bitcode) != header['bitcode'] or len(objcode or b'') != (header['objcode'] or 0):
+                raise ValueError('truncated')
+            return klass._restore(header, bitcode, objcode)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise SnapshotError('Damaged snapshot file: ' + filename)
@@ -0,0 +1,277 @@
+import ctypes, threading, time, weakref
+import llvmlite.binding as llvm
+import perfmap
+from simd import host_target_machine
+
+# Tiered compilation.
+#
+# Functions are first compiled quickly, with few optimizations: this is tier 0.
+# The calls to a session function then go through a small stub counting the
+# calls and jumping to the code held by the slot of the function. Once called
+# often enough, a function is compiled again in the background, with full
+# optimizations and its callees inlined: this is tier 1. Its slot then gets
+# the address of the new code, so that all the calls made from then on run it.
+#
+# The tier 1 modules are parsed, linked and optimized in an LLVM context of
+# their own, not in the global one the evaluators use meanwhile, which is not
+# thread safe. The compilers of all the evaluators share that context, and
+# take their turns using it.
+
+_context = None
+# Reentrant, for the engines freed by the garbage collector of a thread
+# already holding it
+_context_lock = threading.RLock()
+
+def _tier1_context():
+    """Returns the LLVM context of the tier 1 modules. Only used under
+    _context_lock, it lives as long as the process, as do the modules the
+    tier 1 engines own."""
+    global _context
+    if _context is None:
+        _context = llvm.create_context()
+    return _context
+
+def _close_engines(engines):
+    """Free the tier 1 engines of a compiler."""
+    with _context_lock:
+        for engine, symbol, address in engines.values():
+            engine.close()
+        engines.clear()
+
+class TierSlot(ctypes.Structure):
+    """Address of the code to run for a function, and its number of calls."""
+    _fields_ = [
+        ('code', ctypes.c_void_p),
+        ('calls', ctypes.c_uint64)]
+
+def tier_name(funcname, level):
+    """Returns the symbol of the code of a function at a given tier."""
+    return '{0}.tier{1}'.format(funcname, level)
+
+def stub_IR(funcname, functype, slot):
+    """Returns the IR of the stub standing for a function of the given IR
+    function type in the modules calling it: it counts the call and jumps to
+    the code of the slot, given by its address."""
+    result = functype.return_type
+    args = ', '.join('{0} %a{1}'.format(type, i) for i, type in enumerate(functype.args))
+    calls = slot + TierSlot.calls.offset
+    return '\n'.join([
+        'define internal {0} @"{1}"({2}) {{'.format(result, funcname, args),
+        '  %calls = load i64, i64* inttoptr (i64 {0} to i64*)'.format(calls),
+        '  %calls1 = add i64 %calls, 1',
+        '  store i64 %calls1, i64* inttoptr (i64 {0} to i64*)'.format(calls),
+        '  %code = load {0}*, {0}** inttoptr (i64 {1} to {0}**)'.format(functype, slot),
+        '  %result = tail call {0} %code({1})'.format(result, args),
+        '  ret {0} %result'.format(result),
+        '}'])
+
+class _Tier(object):
+    def __init__(self, funcname):
+        self.name = funcname
+        self.slot = TierSlot()
+        self.level = None
+        # IR of the unit of the function, without stubs, the names of the
+        # session functions it depends on, and the addresses of the functions
+        # it calls that are compiled elsewhere.
+        self.source = None
+        self.dependencies = ()
+        self.prebuilt = {}
+        # Whether the function may be compiled at tier 1
+        self.promotable = True
+
+class TieredCompiler(object):
+    """Keeps the slots of the functions of a session, and compiles the hot
+    ones again at tier 1, on a thread of its own.
+    threshold: number of calls making a function hot.
+    interval: seconds between two looks at the call counts.
+    reporters: perf map writers the tier 1 code is described to.
+    symbol: maps the names of the functions to the symbols of their code in
+    the engines given to link(), by default the names themselves.
+    """
+    def __init__(self, target, threshold = 1000, interval = 0.01, reporters = (), symbol = None):
+        self.target = target
+        self.reporters = reporters
+        self.symbol = symbol or (lambda name: name)
+        self.threshold = threshold
+        self.interval = interval
+        self.tiers = {}
+        # Engine holding the tier 1 code of each function, with its symbol
+        # and address, freed along with the compiler
+        self.engines = {}
+        weakref.finalize(self, _close_engines, self.engines)
+        pmb = llvm.create_pass_manager_builder()
+        pmb.opt_level = 3
+        pmb.inlining_threshold = 275
+        pmb.loop_vectorize = True
+        pmb.slp_vectorize = True
+        self.pass_manager = llvm.create_module_pass_manager()
+        # The vectorizers need the costs of the host instructions
+        self.target_machine = host_target_machine(target, opt=3)
+        self.target_machine.add_analysis_passes(self.pass_manager)
+        pmb.populate(self.pass_manager)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.closed = False
+
+    def slot(self, funcname):
+        """Returns the address of the slot of a function."""
+        tier = self.tiers.get(funcname)
+        if tier is None:
+            tier = self.tiers[funcname] = _Tier(funcname)
+        return ctypes.addressof(tier.slot)
+
+    def stub(self, funcname, functype):
+        return stub_IR(funcname, functype, self.slot(funcname))
+
+    def compiled(self, funcname, source, dependencies, prebuilt):
+        """Register the tier 0 compilation of a function, given what is
+        needed to compile it at tier 1: the IR of its unit without stubs, the
+        session functions it depends on, and the names of the functions it
+        calls whose code comes from elsewhere."""
+        with self.lock:
+            self.slot(funcname)
+            tier = self.tiers[funcname]
+            tier.source = source
+            tier.dependencies = dependencies
+            tier.prebuilt = dict.fromkeys(prebuilt)
+            tier.level = 0
+
+    def reset(self, funcname):
+        """Forget the code of a function defined again, until its new tier 0
+        code is compiled and linked. Its tier 1 code is freed."""
+        with self.lock:
+            tier = self.tiers.get(funcname)
+            if tier is not None:
+                tier.level = None
+                tier.source = None
+                tier.slot.code = None
+                tier.slot.calls = 0
+                tier.promotable = True
+            promoted = self.engines.pop(funcname, None)
+        if promoted:
+            engine, symbol, address = promoted
+            with _context_lock:
+                engine.close()
+            for reporter in self.reporters:
+                reporter.release(symbol, address)
+
+    def link(self, engine):
+        """Fill the slots of the functions compiled at tier 0 by engine."""
+        with self.lock:
+            for tier in list(self.tiers.values()):
+                if tier.level == 0 and not tier.slot.code:
+                    tier.prebuilt = {name: engine.get_function_address(self.symbol(name))
+                        for name in tier.prebuilt}
+                    tier.slot.code = engine.get_function_address(self.symbol(tier_name(tier.name, 0)))
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=_poll, args=(weakref.ref(self), self.interval), daemon=True)
+            self.thread.start()
+
+    def levels(self):
+        """Returns the tier of each compiled function."""
+        return {name: tier.level for name, tier in self.tiers.items() if tier.level is not None}
+
+    def promote_hot(self):
+        """Compile the hot functions at tier 1. Returns their names. They are
+        compiled without holding self.lock, so that the evaluator goes on
+        meanwhile: a function defined again by then keeps its new code."""
+        with self.lock:
+            hot = []
+            for tier in list(self.tiers.values()):
+                if tier.level == 0 and tier.promotable and tier.slot.code \
+                        and tier.slot.calls >= self.threshold:
+                    try:
+                        hot.append((tier, tier.source) + self._unit(tier))
+                    except RuntimeError:
+                        # Left at tier 0, which works as well
+                        tier.promotable = False
+        promoted = []
+        for tier, source, sources, prebuilt in hot:
+            try:
+                with _context_lock:
+                    engine, address, size = self._compile(tier.name, sources, prebuilt)
+            except RuntimeError:
+                with self.lock:
+                    if tier.source is source:
+                        tier.promotable = False
+                continue
+            symbol = tier_name(tier.name, 1)
+            with self.lock:
+                current = tier.source is source and tier.level == 0
+                if current:
+                    self.engines[tier.name] = (engine, symbol, address)
+                    # A single aligned store: the calls see either the old
+                    # or the new code
+                    tier.slot.code = address
+                    tier.level = 1
+            if not current:
+                # Defined again, or promoted by another thread, meanwhile
+                with _context_lock:
+                    engine.close()
+                continue
+            for reporter in self.reporters:
+                reporter.report(symbol, address, size)
+            promoted.append(tier.name)
+        return promoted
+
+    def _unit(self, tier):
+        """Returns the IR sources a function is compiled from at tier 1, its
+        own first, and the addresses of the functions they call that are
+        compiled elsewhere."""
+        # The function is compiled along with private copies of the
+        # functions it depends on, free to be inlined.
+        sources = [tier.source]
+        prebuilt = dict(tier.prebuilt)
+        for name in tier.dependencies:
+            dependency = self.tiers[name]
+            if not dependency.slot.code:
+                raise RuntimeError('Dependency not compiled yet: ' + name)
+            sources.append(dependency.source)
+            prebuilt.update(dependency.prebuilt)
+        return sources, prebuilt
+
+    def _compile(self, funcname, sources, prebuilt):
+        """Compile a function at tier 1, under _context_lock. Returns its
+        engine, the address of its code and its size."""
+        context = _tier1_context()
+        llvmmod = llvm.parse_assembly(sources[0], context)
+        for source in sources[1:]:
+            llvmmod.link_in(llvm.parse_assembly(source, context))
+        for func in llvmmod.functions:
+            if func.is_declaration:
+                continue
+            if func.name == funcname:
+                func.name = tier_name(funcname, 1)
+            else:
+                func.linkage = 'internal'
+        llvmmod.verify()
+        self.pass_manager.run(llvmmod)
+
+        target_machine = host_target_machine(self.target, opt=3)
+        engine = llvm.create_mcjit_compiler(llvmmod, target_machine)
+        buffers = []
+        if self.reporters:
+            engine.set_object_cache(lambda module, buffer: buffers.append(buffer))
+        for func in llvmmod.functions:
+            if func.is_declaration and func.name in prebuilt:
+                engine.add_global_mapping(func, prebuilt[func.name])
+        engine.finalize_object()
+        symbol = tier_name(funcname, 1)
+        address = engine.get_function_address(symbol)
+        size = sum(perfmap.function_sizes(buffer).get(symbol, 0) for buffer in buffers)
+        return engine, address, size
+
+    def close(self):
+        self.closed = True
+
+def _poll(ref, interval):
+    """Promote the hot functions of a TieredCompiler, until it is closed or
+    dropped."""
+    while True:
+        time.sleep(interval)
+        compiler = ref()
+        if compiler is None or compiler.closed:
+            return
+        compiler.promote_hot()
+        del compiler
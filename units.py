@@ -0,0 +1,183 @@
+import hashlib, os, tempfile, threading
+from lexer import LexError, Lexer, TokenKind
+from snapshot import Snapshot, SnapshotError, host_signature
+
+# Compilation units.
+#
+# A file imported with `import "lib.kal"` is compiled on its own, into a unit:
+# the native object code of its definitions, the prototypes of the functions
+# it defines or declares, and the precedences of the operators it defines,
+# which it exports to the code importing it. A unit is parsed with the
+# operators of the basic library and of the units it imports only, whatever
+# the code importing it defined.
+#
+# Units are kept in a cache, by key: a hash of the source of the file, of the
+# options it is compiled with, and of the interfaces (prototypes and
+# operators) of the units it imports, which it calls by name. A change to the
+# body of a function only changes the key of its own unit: the units
+# importing it are linked, unchanged, to its new code.
+
+UNIT_VERSION = 2
+
+def unit_imports(source):
+    """Returns the paths imported by a source, without parsing it. The
+    imports past a lexing error are left to the parser to report."""
+    paths = []
+    tokens = Lexer(source + '\n').tokens()
+    try:
+        for token in tokens:
+            if token.kind == TokenKind.IMPORT:
+                token = next(tokens)
+                if token.kind == TokenKind.STRING:
+                    paths.append(token.value)
+    except LexError:
+        pass
+    return paths
+
+def interface(functions, operators):
+    """Returns the digest of the prototypes and operators of a unit."""
+    return hashlib.sha256(repr((
+        sorted(functions), sorted((op, tuple(info)) for op, info in operators.items()))
+        ).encode()).hexdigest()
+
+def unit_key(source, imports, options = ()):
+    """Returns the key of the unit of a source, importing units of the given
+    interfaces, and compiled with the given options."""
+    h = hashlib.sha256(repr((UNIT_VERSION, host_signature(), tuple(options), tuple(imports))).encode())
+    h.update(source.encode())
+    return h.hexdigest()
+
+class Unit(Snapshot):
+    """A compiled file, with its path and key."""
+    def __init__(self, path, key, bitcode, objcode, signature, functions, operators):
+        super().__init__(bitcode, objcode, signature, functions, operators)
+        self.path = path
+        self.key = key
+        self.interface = interface(functions, operators)
+
+    @classmethod
+    def from_module(klass, path, key, llvmmod, target_machine, functions, operators):
+        """Build a unit from an optimized and verified llvm module."""
+        snapshot = Snapshot.from_module(llvmmod, target_machine, functions, operators)
+        return klass(path, key, snapshot.bitcode, snapshot.objcode, snapshot.signature,
+            functions, operators)
+
+    def _header(self):
+        header = super()._header()
+        header.update(path=self.path, key=self.key)
+        return header
+
+    @classmethod
+    def _restore(klass, header, bitcode, objcode):
+        return klass(str(header['path']), str(header['key']), bitcode, objcode,
+            *klass._decode(header))
+
+class UnitCache(object):
+    """Units by key, kept in memory and, when given a directory, in files
+    of that directory named by their keys, which other processes reuse."""
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, directory = None):
+        """Returns the cache of the process for the given directory."""
+        key = directory and os.path.abspath(directory)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(directory)
+            return cls._shared[key]
+
+    def __init__(self, directory = None):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._units = {}
+        self._lock = threading.Lock()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + '.unit')
+
+    def get(self, key):
+        """Returns the unit of the given key, or None."""
+        with self._lock:
+            unit = self._units.get(key)
+            if unit is None and self.directory:
+                try:
+                    unit = Unit.load(self._filename(key))
+                except (OSError, SnapshotError):
+                    pass
+                else:
+                    self._units[key] = unit
+            if unit is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return unit
+
+    def put(self, unit):
+        with self._lock:
+            self._units[unit.key] = unit
+            if self.directory:
+                # Written aside then renamed, so that other processes never
+                # read a unit half written
+                os.makedirs(self.directory, exist_ok=True)
+                fd, filename = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+                os.close(fd)
+                try:
+                    unit.save(filename)
+                    os.replace(filename, self._filename(unit.key))
+                except OSError:
+                    os.unlink(filename)
+                    raise
+
+    def __len__(self):
+        return len(self._units)
+
+    def clear(self):
+        """Forget the units kept in memory."""
+        with self._lock:
+            self._units.clear()
+            self.hits = self.misses = 0
+
+#---- Some unit tests ----#
+
+import unittest
+
+class TestUnits(unittest.TestCase):
+    def test_imports(self):
+        self.assertEqual(unit_imports('import "a.kal" # import "b.kal"\nimport "c/d.kal" def f(x) x'),
+            ['a.kal', 'c/d.kal'])
+        self.assertEqual(unit_imports('import "a.kal" import "b.kal'), ['a.kal'])
+
+    def test_key(self):
+        from snapshot import FunctionInfo
+        a = interface([FunctionInfo('f', ['x'], False)], {})
+        self.assertEqual(unit_key('def g(x) f(x)', [a]), unit_key('def g(x) f(x)', [a]))
+        self.assertNotEqual(unit_key('def g(x) f(x)', [a]), unit_key('def g(x) f(x) ', [a]))
+        self.assertNotEqual(unit_key('def g(x) f(x)', [a]), unit_key('def g(x) f(x)', [a], [8]))
+        b = interface([FunctionInfo('f', ['x', 'y'], False)], {})
+        self.assertNotEqual(unit_key('def g(x) f(x)', [a]), unit_key('def g(x) f(x)', [b]))
+
+    def test_cache(self):
+        from snapshot import FunctionInfo
+        from parsing import Associativity, BinOpInfo
+        unit = Unit('a.kal', 'k' * 64, b'bitcode', b'objcode', host_signature(),
+            [FunctionInfo('f', ['n'], False, ['i64', 'i64']), FunctionInfo('g', [], True)],
+            {'%': BinOpInfo(60, Associativity.LEFT)})
+        with tempfile.TemporaryDirectory() as directory:
+            cache = UnitCache(directory)
+            self.assertIsNone(cache.get(unit.key))
+            cache.put(unit)
+            self.assertIs(cache.get(unit.key), unit)
+            self.assertEqual(os.listdir(directory), [unit.key + '.unit'])
+            # Another process finds it in the directory
+            loaded = UnitCache(directory).get(unit.key)
+            self.assertEqual((loaded.path, loaded.objcode, loaded.functions, loaded.operators),
+                (unit.path, unit.objcode, unit.functions, unit.operators))
+            self.assertEqual((loaded.interface, loaded.native_compatible()), (unit.interface, True))
+            # A damaged file is a miss
+            with open(os.path.join(directory, 'x.unit'), 'wb') as file:
+                file.write(b'damaged')
+            self.assertIsNone(cache.get('x'))
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertIs(UnitCache.shared(), UnitCache.shared())
@@ -0,0 +1,388 @@
+from ast import *
+from parsing import *
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Vectorized evaluation with NumPy.
+#
+# Expressions are evaluated over whole arrays at once, each element being a
+# lane of its own, without any compilation. Every value is an array of the
+# shape of the inputs, and a mask tells the lanes still running: a branch of an
+# 'if' only runs for the lanes taking it, a 'for' loop iterates until none of
+# its lanes goes on, and the self calls in tail position, as in
+# mandelconverger, become such loops rather than Python recursion. Python and
+# NumPy floats being IEEE doubles, the lanes get the values of the JIT-compiled
+# code.
+
+class VectorizedError(Exception): pass
+
+def _c_round(x):
+    # Halfway cases away from zero, as round() in C
+    whole = np.trunc(x)
+    return np.where(np.abs(x - whole) >= 0.5, whole + np.copysign(1.0, x), whole)
+
+# Functions the extern declarations are bound to, as the JIT binds them to
+# the ones of the C library
+UFUNCS = {
+    'fabs': 'fabs', 'fmod': 'fmod', 'fmax': 'fmax', 'fmin': 'fmin',
+    'exp': 'exp', 'exp2': 'exp2', 'log': 'log', 'log2': 'log2', 'log10': 'log10',
+    'sqrt': 'sqrt', 'cbrt': 'cbrt', 'hypot': 'hypot', 'pow': 'power',
+    'sin': 'sin', 'cos': 'cos', 'tan': 'tan', 'asin': 'arcsin', 'acos': 'arccos',
+    'atan': 'arctan', 'atan2': 'arctan2', 'ceil': 'ceil', 'floor': 'floor', 'trunc': 'trunc',
+}
+
+def _true(value):
+    """Truth of conditions, as the ordered comparison of the JIT code: NaN
+    is false."""
+    value = np.asarray(value)
+    return (value != 0.0) & (value == value)
+
+def _reduce(reduction, accumulator, value):
+    """Reduction of the accumulated values and new ones. min and max pick
+    the new value when the language's '<' does."""
+    if reduction == '+':
+        return np.add(accumulator, value)
+    elif reduction == '*':
+        return np.multiply(accumulator, value)
+    elif reduction == 'min':
+        return np.where(np.greater_equal(value, accumulator), accumulator, value)
+    return np.where(np.greater_equal(accumulator, value), accumulator, value)
+
+class _Cell(object):
+    """Values of a variable, shared by the scopes seeing it."""
+    def __init__(self, value):
+        self.value = value
+
+class VectorizedEvaluator(object):
+    """Evaluates the code over arrays with NumPy. The definitions are kept as
+    they are parsed, and only checked like the code generator does."""
+    def __init__(self, basiclib_file = None):
+        if np is None:
+            raise ImportError('The vectorized evaluator needs NumPy')
+        self.basiclib_file = basiclib_file
+        self.reset()
+
+    def reset(self):
+        # Number of arguments of each function, and the definitions
+        self.arities = {'putchard': 1}
+        self.functions = {}
+        # Names of the functions having self calls in tail position
+        self.tail_recursive = set()
+        self.operators = operator_table()
+        if self.basiclib_file:
+            with open(self.basiclib_file) as file:
+                for value in self.eval_generator(file.read()): pass
+
+    def evaluate(self, codestr, **arrays):
+        """Evaluates the first top level expression of codestr, its free
+        variables being given as arrays, or anything convertible to arrays.
+        Returns an array of their broadcast shape, or None for a definition."""
+        return next(self.eval_generator(codestr, **arrays))
+
+    def eval_generator(self, codestr, **arrays):
+        for ast in Parser(self.operators).parse_generator(codestr):
+            yield self._eval_ast(ast, arrays)
+
+    def _eval_ast(self, ast, arrays):
+        if isinstance(ast, Import):
+            raise VectorizedError('Imports are only supported by the JIT: ' + ast.path)
+        if isinstance(ast, Prototype):
+            self._declare(ast)
+            return None
+        if ast.is_anonymous():
+            self._check(ast.body, set(arrays))
+            return self._run(ast.body, list(arrays), list(arrays.values()))
+        was_declared = ast.proto.name in self.arities
+        self._declare(ast.proto)
+        try:
+            self._check(ast.body, set(ast.proto.argnames))
+        except VectorizedError:
+            if not was_declared:
+                del self.arities[ast.proto.name]
+            raise
+        self.functions[ast.proto.name] = ast
+        if self._has_tail_call(ast.body, ast.proto.name):
+            self.tail_recursive.add(ast.proto.name)
+        return None
+
+    def call(self, funcname, *args):
+        """Calls a function over arrays. Returns an array of their broadcast
+        shape."""
+        if self.arities.get(funcname) != len(args):
+            raise VectorizedError('Call argument length mismatch', funcname)
+        names = ['_arg{0}'.format(i) for i in range(len(args))]
+        return self._run(Call(funcname, [Variable(name) for name in names]), names, args)
+
+    def _run(self, node, names, values):
+        values = np.broadcast_arrays(*[np.asarray(value, dtype=np.float64) for value in values])
+        shape = values[0].shape if values else ()
+        env = {name: _Cell(value.copy()) for name, value in zip(names, values)}
+        # The inactive lanes compute garbage, which may overflow
+        with np.errstate(all='ignore'):
+            result = self._eval(node, env, np.ones(shape, dtype=bool))
+        return np.broadcast_to(np.asarray(result, dtype=np.float64), shape).copy()
+
+    # Checks, with the errors of the code generator
+
+    def _declare(self, proto):
+        if proto.is_typed():
+            raise VectorizedError('Only f64 values are vectorized: ' + proto.name)
+        nargs = len(proto.argnames)
+        if proto.name in self.functions:
+            raise VectorizedError('Redifinition of {0}'.format(proto.name))
+        if self.arities.get(proto.name, nargs) != nargs:
+            raise VectorizedError('Redifinition with different number of arguments')
+        self.arities[proto.name] = nargs
+
+    def _check(self, node, scope):
+        if isinstance(node, Variable):
+            if node.name not in scope:
+                raise VectorizedError("Undefined variable: " + node.name)
+        elif isinstance(node, Index):
+            raise VectorizedError('Only f64 values are vectorized: ' + node.name)
+        elif isinstance(node, Unary):
+            self._check(node.rhs, scope)
+            if 'unary' + node.op not in self.arities:
+                raise VectorizedError("Undefined unary operator: " + node.op)
+        elif isinstance(node, Binary):
+            if node.op == '=' and not isinstance(node.lhs, Variable):
+                raise VectorizedError('lhs of "=" must be a variable')
+            self._check(node.lhs, scope)
+            self._check(node.rhs, scope)
+            if node.op not in '=+-*<' and 'binary' + node.op not in self.arities:
+                raise VectorizedError('Unknown binary operator', node.op)
+        elif isinstance(node, Call):
+            if node.callee not in self.arities:
+                raise VectorizedError('Call to unknown function', node.callee)
+            if self.arities[node.callee] != len(node.args):
+                raise VectorizedError('Call argument length mismatch', node.callee)
+            for arg in node.args:
+                self._check(arg, scope)
+        elif isinstance(node, If):
+            for expr in (node.cond_expr, node.then_expr, node.else_expr):
+                self._check(expr, scope)
+        elif isinstance(node, For):
+            if node.id_type not in (None, DEFAULT_TYPE):
+                raise VectorizedError('Only f64 values are vectorized: ' + node.id_name)
+            self._check(node.start_expr, scope)
+            scope = scope | {node.id_name}
+            for expr in (node.end_expr, node.step_expr, node.body):
+                if expr is not None:
+                    self._check(expr, scope)
+        elif isinstance(node, VarIn):
+            for name, type in node.types.items():
+                if type != DEFAULT_TYPE:
+                    raise VectorizedError('Only f64 values are vectorized: ' + name)
+            scope = set(scope)
+            for name, init in node.vars:
+                if init is not None:
+                    self._check(init, scope)
+                scope.add(name)
+            self._check(node.body, scope)
+
+    def _has_tail_call(self, node, funcname):
+        if isinstance(node, Call):
+            return node.callee == funcname
+        if isinstance(node, If):
+            return self._has_tail_call(node.then_expr, funcname) or \
+                self._has_tail_call(node.else_expr, funcname)
+        if isinstance(node, VarIn):
+            return self._has_tail_call(node.body, funcname)
+        return False
+
+    # Evaluation: mask holds the lanes running the node
+
+    def _eval(self, node, env, mask):
+        return getattr(self, '_eval_' + node.__class__.__name__)(node, env, mask)
+
+    def _eval_Number(self, node, env, mask):
+        return float(node.val)
+
+    def _eval_Variable(self, node, env, mask):
+        return env[node.name].value
+
+    def _eval_Binary(self, node, env, mask):
+        if node.op == '=':
+            cell = env[node.lhs.name]
+            value = self._eval(node.rhs, env, mask)
+            cell.value = np.where(mask, value, cell.value)
+            return value
+        lhs = self._eval(node.lhs, env, mask)
+        rhs = self._eval(node.rhs, env, mask)
+        if node.op == '+':
+            return np.add(lhs, rhs)
+        elif node.op == '-':
+            return np.subtract(lhs, rhs)
+        elif node.op == '*':
+            return np.multiply(lhs, rhs)
+        elif node.op == '<':
+            # Unordered comparison: true when either operand is NaN
+            return np.where(np.greater_equal(lhs, rhs), 0.0, 1.0)
+        return self._call('binary' + node.op, [lhs, rhs], mask)
+
+    def _eval_Unary(self, node, env, mask):
+        return self._call('unary' + node.op, [self._eval(node.rhs, env, mask)], mask)
+
+    def _eval_Call(self, node, env, mask):
+        return self._call(node.callee, [self._eval(arg, env, mask) for arg in node.args], mask)
+
+    def _eval_If(self, node, env, mask):
+        truth = _true(self._eval(node.cond_expr, env, mask))
+        # A branch only runs for its lanes, if any
+        then_mask = mask & truth
+        else_mask = mask & ~truth
+        then_val = self._eval(node.then_expr, env, then_mask) if then_mask.any() else 0.0
+        else_val = self._eval(node.else_expr, env, else_mask) if else_mask.any() else 0.0
+        return np.where(truth, then_val, else_val)
+
+    def _eval_For(self, node, env, mask):
+        counter = _Cell(np.where(mask, self._eval(node.start_expr, env, mask), 0.0))
+        env = dict(env)
+        env[node.id_name] = counter
+        if node.reduction:
+            accumulator = np.full(mask.shape, REDUCTIONS[node.reduction])
+        active = mask
+        while True:
+            active = active & _true(self._eval(node.end_expr, env, active))
+            if not active.any():
+                break
+            value = self._eval(node.body, env, active)
+            if node.reduction:
+                accumulator = np.where(active, _reduce(node.reduction, accumulator, value), accumulator)
+            if node.step_expr is None:
+                step = counter.value + 1.0
+            else:
+                step = self._eval(node.step_expr, env, active)
+            counter.value = np.where(active, step, counter.value)
+        # The 'for' expression returns the last value of the counter, or the
+        # reduction of the body values
+        return accumulator if node.reduction else counter.value
+
+    # The iterations of a parallel loop run one after the other
+    _eval_ParFor = _eval_For
+
+    def _eval_VarIn(self, node, env, mask):
+        env = dict(env)
+        for name, init in node.vars:
+            value = self._eval(init, env, mask) if init is not None else 0.0
+            env[name] = _Cell(np.where(mask, value, 0.0))
+        return self._eval(node.body, env, mask)
+
+    def _call(self, funcname, args, mask):
+        function = self.functions.get(funcname)
+        if function is None:
+            return self._call_host(funcname, args, mask)
+        names = function.proto.argnames
+        if funcname not in self.tail_recursive:
+            env = {name: _Cell(arg) for name, arg in zip(names, args)}
+            return self._eval(function.body, env, mask)
+        # Each self call in tail position starts another iteration for its
+        # lanes, until all of them return
+        result = np.zeros(mask.shape)
+        active = mask
+        while active.any():
+            env = {name: _Cell(arg) for name, arg in zip(names, args)}
+            value, again, next_args = self._eval_tail(function.body, env, active, function)
+            result = np.where(active & ~again, value, result)
+            args = [np.where(again, new, old) for new, old in zip(next_args, args)]
+            active = active & again
+        return result
+
+    def _eval_tail(self, node, env, mask, function):
+        """Evaluates the body of a function having self calls in tail
+        position. Returns the values of the lanes returning, the lanes
+        calling the function again, and the arguments of those calls."""
+        funcname = function.proto.name
+        no_args = [0.0] * len(function.proto.argnames)
+        if isinstance(node, Call) and node.callee == funcname:
+            args = [self._eval(arg, env, mask) for arg in node.args]
+            return 0.0, mask, args
+        if isinstance(node, If) and self._has_tail_call(node, funcname):
+            truth = _true(self._eval(node.cond_expr, env, mask))
+            branches = []
+            for expr, lanes in [(node.then_expr, mask & truth), (node.else_expr, mask & ~truth)]:
+                if lanes.any():
+                    branches.append(self._eval_tail(expr, env, lanes, function))
+                else:
+                    branches.append((0.0, lanes, no_args))
+            (then_val, then_again, then_args), (else_val, else_again, else_args) = branches
+            return (np.where(truth, then_val, else_val), np.where(truth, then_again, else_again),
+                [np.where(truth, a, b) for a, b in zip(then_args, else_args)])
+        if isinstance(node, VarIn) and self._has_tail_call(node, funcname):
+            inner = dict(env)
+            for name, init in node.vars:
+                value = self._eval(init, inner, mask) if init is not None else 0.0
+                inner[name] = _Cell(np.where(mask, value, 0.0))
+            return self._eval_tail(node.body, inner, mask, function)
+        return self._eval(node, env, mask), np.zeros(mask.shape, dtype=bool), no_args
+
+    def _call_host(self, funcname, args, mask):
+        if funcname == 'putchard':
+            import sys
+            codes = np.broadcast_to(args[0], mask.shape)[mask]
+            # As putchar(), only the low byte of the character code counts
+            sys.stdout.write(''.join(chr(int(code) & 0xff) for code in codes))
+            return 0.0
+        if funcname == 'round':
+            return _c_round(args[0])
+        if funcname in UFUNCS:
+            return getattr(np, UFUNCS[funcname])(*args)
+        raise VectorizedError('Call to undefined function: ' + funcname)
+
+#---- Some unit tests ----#
+
+import unittest
+
+@unittest.skipIf(np is None, 'NumPy is not installed')
+class TestVectorizedEvaluator(unittest.TestCase):
+    def test_arithmetic(self):
+        e = VectorizedEvaluator()
+        x = np.array([0.0, 1.0, 2.0, np.nan])
+        self.assertEqual(list(e.evaluate('x * x + 1 - x', x=x)[:3]), [1, 1, 3])
+        self.assertEqual(list(e.evaluate('x < 1', x=x)), [1, 0, 0, 1])
+        self.assertEqual(list(e.evaluate('if x then 1 else 2', x=x)), [2, 1, 1, 2])
+        self.assertEqual(e.evaluate('3 + 4').shape, ())
+
+    def test_masked_loops(self):
+        e = VectorizedEvaluator('basiclib.kal')
+        e.evaluate('def count(n) var c in (for i = 0, i < n in c = c + 1) * 0 + c')
+        self.assertEqual(list(e.call('count', [0, 3, 5, 2.5])), [0, 3, 5, 3])
+        self.assertEqual(list(e.evaluate('for i = 0, i < n, i + 2 in 0', n=[1, 4])), [2, 4])
+        self.assertEqual(list(e.evaluate('parfor i = 0, i < n reduce + in i', n=[0, 3, 5])), [0, 3, 10])
+        self.assertEqual(list(e.evaluate('parfor i = 0, i < n reduce max in 0 - i', n=[0, 3])),
+            [-np.inf, 0])
+        e.evaluate('def fib(n) if n < 2 then n else fib(n - 1) + fib(n - 2)')
+        self.assertEqual(list(e.call('fib', np.arange(8))), [0, 1, 1, 2, 3, 5, 8, 13])
+        self.assertEqual(list(e.evaluate('max(a, b) + abs(-a) + sqrt(b)', a=[1, -2], b=[4, 9])),
+            [4 + 1 + 2, 9 + 2 + 3])
+
+    def test_tail_recursion(self):
+        from bytecode import BytecodeEvaluator
+        e = VectorizedEvaluator('basiclib.kal')
+        k = BytecodeEvaluator('basiclib.kal')
+        with open('mandelbrot.kal') as file:
+            for ast in Parser(e.operators).parse_generator(file.read()):
+                if not (isinstance(ast, Function) and ast.is_anonymous()):
+                    e._eval_ast(ast, {})
+                    k._eval_ast(ast)
+        self.assertIn('mandelconverger', e.tail_recursive)
+        real, imag = np.meshgrid(np.arange(-46, 32) / 20, np.arange(-26, 22) / 20)
+        iterations = e.call('mandelconverge', real, imag)
+        self.assertEqual(iterations.shape, (48, 78))
+        self.assertEqual(iterations.max(), 256)
+        # The counts of the bytecode interpreter, point by point
+        for (i, j) in [(0, 0), (12, 20), (10, 25), (24, 39), (30, 50), (26, 60)]:
+            self.assertEqual(iterations[i, j], k.evaluate(
+                'mandelconverge({0!r}, {1!r})'.format(float(real[i, j]), float(imag[i, j]))))
+
+    def test_errors(self):
+        e = VectorizedEvaluator()
+        e.evaluate('def foo(x) x + 1')
+        for code in ['def foo(x) x', 'def bar(x) y', 'bar(1)', 'foo(1, 2)', 'z + 1',
+                'def half(x: f32) x', 'for i: i64 = 0, i < 2 in i', 'def first(xs) xs[0]']:
+            with self.assertRaises(VectorizedError):
+                e.evaluate(code)
+        with self.assertRaises(VectorizedError):
+            e.call('foo', 1, 2)